@@ -1,25 +1,116 @@
-from flask import Flask, render_template, request, jsonify
-import json, os, requests
-from dotenv import load_dotenv
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
+import json, os
+import csv, io
+import queue
+import hashlib
 import uuid
-import re
-from flask import send_file
+import time
+from werkzeug.http import is_resource_modified
 from datetime import datetime, timezone, date
-from pathlib import Path
+from urllib.parse import urlencode
+import sessions
+from sessions import SessionCache, SESSION_COOKIE, SESSION_MAX_AGE
+from upstream import UpstreamClient, UpstreamError, CircuitOpenError
+from storage import CorruptFileError
+from scheduler import DeliveryScheduler
+from stores import Query, decode_cursor
+from response_cache import ResponseCache, context_fingerprint
+from context_builder import ContextBuilder, Turn
+# reply formatting, name extraction and follow-ups (precompiled, see textproc.py)
+from textproc import format_reply, StreamingFormatter, INVALID_NAMES, store_name, choose_followup
+from intents import IntentRouter
+from ratelimit import Coalescer, FairLimiter, RateLimited
+from capture import ChatCapture
+from notify import Notifier
+import metrics
+from metrics import REGISTRY, HTTP_REQUESTS, HTTP_SECONDS, LLM_SECONDS, FORMAT_SECONDS
 
 # --- Load environment variables ---
-load_dotenv()
+# python-dotenv (~10 ms to import) only when there is a .env to read: next to
+# app.py or in the working directory (it doesn't search parent directories)
+DOTENV_PATH = next((p for p in (os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"), ".env")
+                    if os.path.isfile(p)), None)
+if DOTENV_PATH:
+    from dotenv import load_dotenv
+    load_dotenv(DOTENV_PATH)
 PERPLEXITY_KEY = os.getenv("PERPLEXITY_API_KEY")
 
 app = Flask(__name__)
 
-# --- Chat history ---
+# one pooled keep-alive client per worker (timeouts/retries configurable via env)
+upstream = UpstreamClient.from_env(api_key=PERPLEXITY_KEY)
+# per-session + global token buckets in front of it, fair queueing when the quota runs low
+upstream_limiter = FairLimiter.from_env()
+# duplicate (session, message) turns from double-clicks/retries share one result
+coalescer = Coalescer(linger=float(os.getenv("COALESCE_LINGER", "2")))
+# CHAT_CAPTURE=1: append sanitized chat turns to requests.jsonl for bench/replay.py (see capture.py)
+chat_capture = ChatCapture.from_env()
+
+# --- Per-user sessions ---
+# single-user files from before sessions; copied once into a new private session (sessions.LEGACY_SESSION_FILE)
 HISTORY_FILE = "chat_history.json"
-if os.path.exists(HISTORY_FILE):
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        chat_history = json.load(f)
-else:
-    chat_history = []
+HISTORY_DIR = os.getenv("HISTORY_DIR", "chat_history_log")
+USER_FILE = "user.json"
+PLANNER_FILE = "planner.json"
+TIME_MESSAGES_FILE = "time_messages.json"
+
+def prepare_data():
+    """
+    One-off data work before serving. gunicorn.conf.py runs it from
+    when_ready, once in the master before any worker forks; every other way
+    of starting the app (flask run, uvicorn asgi:app, GUNICORN_PRELOAD=0)
+    runs it on import.
+    """
+    sessions.migrate_legacy_files(HISTORY_FILE, HISTORY_DIR, USER_FILE, PLANNER_FILE, TIME_MESSAGES_FILE)
+    # STORAGE_BACKEND=sqlite: pull any per-session planner/time capsule JSON into the database, once
+    sessions.migrate_to_sqlite()
+    # history/profile writes a crashed worker had journaled but not yet written
+    sessions.recover_write_behind()
+
+if os.environ.get("SAATHI_PRELOAD") != "1":
+    prepare_data()
+
+session_cache = SessionCache(int(os.getenv("SESSION_CACHE_SIZE", "512")))
+
+def current_user():
+    """UserState for this request's session cookie; a new session is started if missing."""
+    if "user" not in g:
+        sid = request.cookies.get(SESSION_COOKIE)
+        if not sessions.valid_session_id(sid):
+            sid = sessions.new_session_id()
+            g.new_sid = sid
+        g.user = session_cache.get(sid)
+    return g.user
+
+@app.after_request
+def set_session_cookie(response):
+    if g.get("new_sid"):
+        response.set_cookie(SESSION_COOKIE, g.new_sid, max_age=SESSION_MAX_AGE, httponly=True, samesite="Lax")
+    return response
+
+# --- Metrics and tracing (see metrics.py; TRACE_FILE=... turns tracing on) ---
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace = metrics.tracer.start(f"{request.method} {route}", route=route, method=request.method)
+
+@app.after_request
+def record_request_metrics(response):
+    start, trace = g.get("metrics_start"), g.get("trace")
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method, status = request.method, response.status_code
+
+    def done():
+        # on close, so streamed responses count until their last byte
+        HTTP_SECONDS.observe(time.perf_counter() - start, route=route, method=method)
+        HTTP_REQUESTS.inc(route=route, method=method, status=status)
+        metrics.tracer.finish(trace, status=status)
+
+    response.call_on_close(done)
+    return response
 
 # --- System prompt ---
 system_prompt = """
@@ -29,130 +120,93 @@ Do NOT address the user by their name except once when you first meet them (use
 Always end with a short follow-up question to keep the conversation going.
 """
 
+# one system message per request, recent turns within a token budget, older turns
+# as a rolling summary (see context_builder.py; budget configurable via env)
+context_builder = ContextBuilder.from_env(system_prompt)
+
 # --- Ask AI / Perplexity ---
-def ask_perplexity(user_input):
+def build_payload(turn, user=None):
+    """Chat payload for `turn` (a Turn from start_turn, or a bare message)."""
+    user = user or current_user()
+    if isinstance(turn, str):
+        turn = Turn(turn)
+    messages = context_builder.build(user.history, turn, user.context)
+    return {"model": "sonar-pro", "messages": messages, "temperature": 0.7, "max_tokens": 250}
+
+def reply_from_result(result):
+    if "choices" in result and len(result["choices"]) > 0:
+        return result["choices"][0]["message"]["content"]
+    return "(Offline Mode) Perplexity API returned no choices."
+
+def offline_reply(error):
+    """Map an upstream failure to the (Offline Mode) reply shown to the student."""
+    if isinstance(error, RateLimited):
+        return "(Offline Mode) Saathi is getting a lot of messages right now. Please try again in a few seconds."
+    if isinstance(error, CircuitOpenError):
+        return "(Offline Mode) Perplexity API is unavailable right now."
+    print("Perplexity API error:", error)
+    if isinstance(error, UpstreamError) and error.status_code:
+        return f"(Offline Mode) Perplexity API error: {error.status_code}"
+    return "(Offline Mode) Could not connect to Perplexity API."
+
+def ask_perplexity(turn, user=None, payload=None):
     if not PERPLEXITY_KEY:
         return "(Offline Mode) API key not set."
 
-    messages = [{"role": "system", "content": system_prompt}]
-    for msg in chat_history[-10:]:
-        if msg["role"] in ["user", "assistant"]:
-            messages.append(msg)
-    messages.append({"role": "user", "content": user_input})
-
-    headers = {"Authorization": f"Bearer {PERPLEXITY_KEY}", "Content-Type": "application/json"}
-    payload = {"model": "sonar-pro", "messages": messages, "temperature": 0.7, "max_tokens": 250}
+    user = user or current_user()
+    payload = payload or build_payload(turn, user)
 
+    started = time.perf_counter()
     try:
-        r = requests.post("https://api.perplexity.ai/chat/completions", headers=headers, json=payload)
-        if r.status_code == 200:
-            result = r.json()
-            if "choices" in result and len(result["choices"]) > 0:
-                return result["choices"][0]["message"]["content"]
-            else:
-                return "(Offline Mode) Perplexity API returned no choices."
-        else:
-            print("Perplexity API error:", r.status_code, r.text)
-            return f"(Offline Mode) Perplexity API error: {r.status_code}"
+        upstream_limiter.acquire(user.sid)
+        reply = reply_from_result(upstream.chat_completion(payload))
+        metrics.record(LLM_SECONDS, started, "llm.call", mode="complete", outcome="ok")
+        chat_capture.upstream(payload["messages"], started)
+        return reply
     except Exception as e:
-        print("Perplexity API exception:", e)
-        return "(Offline Mode) Could not connect to Perplexity API."
-
-# --- Format AI reply to HTML ---
-def format_reply(ai_text, max_sentences: int = 7, followup: str = None, end_conversation: bool = False):
-    """
-    Clean AI text, limit to `max_sentences`, convert simple markdown (bold)
-    and list lines to safe HTML paragraphs / lists.
-    If end_conversation is True, do not append any follow-up question.
-    """
-    import re
-
-    if not ai_text:
-        return "<p>Sorry, I couldn't generate a reply right now.</p>"
-
-    # remove citation-style markers and convert simple markdown
-    text = re.sub(r'(?:\s*\[\d+\])+', '', ai_text)
-    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
-    text = text.replace('*', '')
-
-    # split into sentences (keeps punctuation)
-    sentences = re.split(r'(?<=[\.!\?…])\s+', text.strip())
-    # filter out empty
-    sentences = [s.strip() for s in sentences if s.strip()]
-
-    truncated = sentences[:max_sentences]
-    truncated_text = " ".join(truncated).strip()
+        metrics.record(LLM_SECONDS, started, "llm.call", mode="complete", outcome="offline")
+        chat_capture.upstream(payload["messages"], started, ok=False)
+        return offline_reply(e)
 
-    # Ensure we end cleanly with punctuation
-    if truncated_text and truncated_text[-1] not in ".!?…":
-        truncated_text = truncated_text + "."
-
-    # if original had more sentences, append an ellipsis to show continuation
-    if len(sentences) > max_sentences:
-        truncated_text = truncated_text.rstrip() + " …"
-
-    # ensure there is a follow-up question unless this is an end-of-conversation reply
-    has_question = bool(re.search(r'\?\s*$', truncated_text))
-    if not has_question and not end_conversation:
-        if followup:
-            truncated_text = truncated_text + " " + followup
-        else:
-            truncated_text = truncated_text + " Would you like to tell me more?"
-
-    # Convert simple lists / paragraphs into HTML
-    lines = truncated_text.splitlines()
-    out = []
-    in_list = False
-    for line in lines:
-        line = line.strip()
-        if re.match(r'^(-|\d+\.)\s+', line):
-            if not in_list:
-                in_list = True
-                out.append("<ul>")
-            item = re.sub(r'^(-|\d+\.)\s+', '', line)
-            out.append(f'<li>{item}</li>')
-        else:
-            if in_list:
-                out.append("</ul>")
-                in_list = False
-            if line:
-                out.append(f"<p>{line}</p>")
-    if in_list:
-        out.append("</ul>")
-
-    html = "\n".join(out) if out else f"<p>{truncated_text}</p>"
-    return html
+# Streaming variant: yields reply text as it arrives; offline replies are yielded whole.
+# `outcome["complete"]` is set once the whole reply arrived.
+def stream_perplexity(turn, user=None, outcome=None, payload=None):
+    if not PERPLEXITY_KEY:
+        yield "(Offline Mode) API key not set."
+        return
 
-INVALID_NAMES = {
-    "no","yes","ok","okay","maybe","nah","nope",
-    "i","me","my","mine","student","everyone","none",
-    # common emotion/adjective words — don't treat these as names
-    "happy","sad","angry","anxious","excited","stressed","calm","lonely",
-    "relaxed","tired","bored","scared","afraid","depressed","upset",
-    # common short replies / fillers/affirmations that should never become names
-    "yeah","yep","yup","sure","right","okey","okeydokey","kk","k","thanks","thankyou","thank","cool","nice"
-}
-
-# --- Persisted user name ---
-USER_FILE = "user.json"
-user_data = {}
-if os.path.exists(USER_FILE):
+    user = user or current_user()
+    payload = payload or build_payload(turn, user)
+    got_text = False
+    started = time.perf_counter()
     try:
-        with open(USER_FILE, "r", encoding="utf-8") as f:
-            user_data = json.load(f) or {}
-    except Exception:
-        user_data = {}
+        upstream_limiter.acquire(user.sid)
+        for chunk in upstream.stream_chat_completion(payload):
+            got_text = True
+            yield chunk
+        if outcome is not None:
+            outcome["complete"] = True
+        metrics.record(LLM_SECONDS, started, "llm.stream", mode="stream", outcome="ok")
+        chat_capture.upstream(payload["messages"], started)
+    except Exception as e:
+        metrics.record(LLM_SECONDS, started, "llm.stream", mode="stream", outcome="offline")
+        chat_capture.upstream(payload["messages"], started, ok=False)
+        reply = offline_reply(e)
+        # keep a partial reply rather than appending an error to it
+        if not got_text:
+            yield reply
+
+# --- Persisted user name (per session, cached by user.profile) ---
+def load_profile(user=None):
+    user = user or current_user()
+    data = user.profile.get()
     # auto-clear invalid saved name
-    saved = (user_data.get("name") or "").strip().lower()
+    saved = (data.get("name") or "").strip().lower()
     if saved in INVALID_NAMES:
-        try:
-            os.remove(USER_FILE)
-        except Exception:
-            pass
-        user_data = {}
+        return {}
+    return data
 
-def set_user_name(name: str):
-    global user_data
+def set_user_name(name: str, user=None):
     if not name:
         return False
     name_clean = name.strip()
@@ -160,162 +214,417 @@ def set_user_name(name: str):
     if name_clean.lower() in INVALID_NAMES or len(name_clean) < 2:
         return False
     name_clean = name_clean.capitalize()
-    user_data = {"name": name_clean, "greeted": False}
+    user = user or current_user()
     try:
-        with open(USER_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        user.profile.replace({"name": name_clean, "greeted": False})
     except Exception as e:
         print("Could not save user name:", e)
     return True
 
-def get_user_name():
-    # always reload to avoid stale memory
-    if os.path.exists(USER_FILE):
-        try:
-            with open(USER_FILE, "r", encoding="utf-8") as f:
-                d = json.load(f) or {}
-                return d.get("name")
-        except Exception:
-            pass
-    return user_data.get("name")
+def get_user_name(user=None):
+    return load_profile(user).get("name")
 
-def set_user_greeted():
-    global user_data
-    user_data["greeted"] = True
+def set_user_greeted(user=None):
+    user = user or current_user()
     try:
-        with open(USER_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        user.profile.update(greeted=True)
     except Exception:
         pass
 
-def user_was_greeted():
-    if os.path.exists(USER_FILE):
-        try:
-            with open(USER_FILE, "r", encoding="utf-8") as f:
-                d = json.load(f) or {}
-                return bool(d.get("greeted"))
-        except Exception:
-            pass
-    return bool(user_data.get("greeted"))
+def user_was_greeted(user=None):
+    return bool(load_profile(user).get("greeted"))
+
+# --- Response cache ---
+# near-duplicate messages at the same point of a conversation reuse an earlier
+# AI reply; hits still go through finish_turn (format_reply + choose_followup)
+response_cache = ResponseCache.from_env()
+
+def reply_cache_context(user_input, user_name, user, payload):
+    """
+    Cache context for this turn's reply (see context_fingerprint), built from
+    the `payload` about to be sent, or None if the reply must not be cached.
+    """
+    if not response_cache.cacheable(user_input):
+        return None
+    if user_name and not user_was_greeted(user):
+        return None  # the prompt carries the student's name
+    # a summary or recent turns are this student's conversation: keep the reply theirs
+    private = bool(user.context.recent or user.context.summary)
+    return context_fingerprint(payload["messages"][:-1], owner=user.sid if private else None)
+
+def cached_reply(user_input, context):
+    return response_cache.get(user_input, context) if context else None
+
+def remember_reply(user_input, context, ai_text):
+    if context and ai_text and not ai_text.startswith("(Offline Mode)"):
+        response_cache.put(user_input, ai_text, context)
+
+# --- Local intents ---
+# greetings, thanks, goodbyes and tip/breathing/motivation requests are answered
+# locally when the classifier is confident (INTENT_LOG=1 prints each decision)
+intent_router = IntentRouter.from_env()
 
 # --- Chatbot response ---
-def chatbot_response(user_input):
+def chatbot_response(user_input, user=None):
     """
     Persist name if detected. Greet by name only once; afterwards do NOT address user by name.
     Prompt AI to produce short, student-focused replies (<=7 sentences) and end with a follow-up question.
     """
-    # reload persisted name
-    user_name = get_user_name()
+    user = user or current_user()
+    capture = chat_capture.begin(user.sid, user_input, "chat")
+    greeting, turn, user_name = start_turn(user_input, user)
+    if greeting:
+        chat_capture.end(capture, greeting, "local", user_name)
+        return greeting
+
+    payload = build_payload(turn, user)
+    context = reply_cache_context(user_input, user_name, user, payload)
+    ai_text = cached_reply(user_input, context)
+    path = "cache"
+    if ai_text is None:
+        path = "ai"
+        ai_text = ask_perplexity(turn, user, payload)
+        remember_reply(user_input, context, ai_text)
+    html = finish_turn(user_input, user_name, ai_text, user)
+    chat_capture.end(capture, html, path, user_name, ai_text)
+    return html
+
+def start_turn(user_input, user=None):
+    """
+    Name detection and prompt building for a turn.
+    Returns (greeting_html, None, name) when the name greeting or a local intent
+    answers the turn without the AI, otherwise (None, turn, user_name) where
+    turn is a Turn.
+    """
+    user = user or current_user()
+    # one profile lookup for the whole turn (a stat when the cache is warm)
+    profile = load_profile(user)
+    user_name = profile.get("name")
+    greeted = bool(profile.get("greeted"))
+
+    # "hi", "thanks", "give me a breathing exercise": answer locally (and never take them for a name)
+    routed = intent_router.route(user_input)
+    if routed:
+        html = finish_turn(user_input, user_name, routed.reply, user, end_conversation=routed.end_conversation)
+        return html, None, user_name
 
     # Try detect + persist name (first time)
     if not user_name:
         detected = store_name(user_input)
         if detected:
-            set_user_name(detected)
-            # greet once immediately (do not call AI for this simple greeting)
-            set_user_greeted()  # mark greeted so future replies won't use name
+            # name + greeted flag go to disk in one write
+            with user.profile.batch():
+                set_user_name(detected, user)
+                # greet once immediately (do not call AI for this simple greeting)
+                set_user_greeted(user)  # mark greeted so future replies won't use name
             reply_text = f"Nice to meet you, {detected}! How are you feeling today?"
-            return format_reply(reply_text)
+            return format_reply(reply_text), None, detected
 
     # Build AI instruction: explicitly tell AI not to use name if already greeted
-    instruction = (
-        "You are Saathi, a friendly, caring, empathetic mental health chatbot for students. "
-        "Answer supportively and concisely (limit to 7 sentences). "
-        "End with a short follow-up question to keep the conversation going. "
-    )
-    if user_was_greeted():
+    # (persona and follow-up question already come from system_prompt)
+    instruction = "Limit your reply to 7 sentences. "
+    if greeted:
         instruction += "Do NOT address the user by name in your reply."
     else:
         instruction += "You may use the user's name once to greet them, but do not use the name repeatedly."
 
-    name_line = f"User name: {user_name}." if user_name and not user_was_greeted() else ""
-
-    final_prompt = f"{system_prompt}\n{instruction}\n{name_line}\nUser: {user_input}"
+    name_line = f"\nUser name: {user_name}." if user_name and not greeted else ""
 
-    ai_text = ask_perplexity(final_prompt)
+    return None, Turn(user_input, instruction + name_line), user_name
 
+def finish_turn(user_input, user_name, ai_text, user=None, end_conversation=False):
+    """Format the AI reply, update the greeted flag and persist the turn."""
+    user = user or current_user()
     # build a contextual followup based on user's latest message
     followup = choose_followup(user_input)
 
     # format and enforce sentence limit, append followup if needed
-    html = format_reply(ai_text, max_sentences=7, followup=followup)
+    with metrics.timed(FORMAT_SECONDS, "format_reply"):
+        html = format_reply(ai_text, max_sentences=7, followup=followup, end_conversation=end_conversation)
 
     # After generating a reply, if user wasn't greeted but we included a greeting, mark greeted.
     # Conservative approach: if user_name exists and not greeted, mark greeted so AI won't reuse it.
-    if user_name and not user_was_greeted():
-        set_user_greeted()
+    if user_name and not user_was_greeted(user):
+        set_user_greeted(user)
 
-    # save to chat history (existing logic)
+    # save to chat history (one append for the whole turn)
     try:
-        chat_history.append({"role": "user", "content": user_input, **({"name": user_name} if user_name else {})})
-        chat_history.append({"role": "assistant", "content": ai_text})
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(chat_history, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
+        ts = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        user.history.append_many([
+            {"role": "user", "content": user_input, **({"name": user_name} if user_name else {}), "ts": ts},
+            {"role": "assistant", "content": ai_text, "ts": ts},
+        ])
+    except Exception as e:
+        print("Could not save chat history:", e)
 
     return html
 
-# --- Planner storage ---
-PLANNER_FILE = "planner.json"
-if os.path.exists(PLANNER_FILE):
-    with open(PLANNER_FILE, "r", encoding="utf-8") as f:
-        try:
-            planner_items = json.load(f)
-        except Exception:
-            planner_items = []
-else:
-    planner_items = []
+# --- Listing: filters, sorting, cursor pagination, conditional GET ---
+MAX_PAGE_SIZE = 200
 
-def save_planner():
-    with open(PLANNER_FILE, "w", encoding="utf-8") as f:
-        json.dump(planner_items, f, ensure_ascii=False, indent=2)
+def parse_bool(value):
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    raise ValueError(f"expected true or false, got {value!r}")
+
+def list_query(store, args, default_sort):
+    """stores.Query from the request args; ValueError for anything malformed."""
+    flags = {f: parse_bool(args[f]) for f in store.flag_fields if args.get(f)}
+    date_from, date_to = args.get("date_from") or None, args.get("date_to") or None
+    for d in (date_from, date_to):
+        if d:
+            date.fromisoformat(d)  # YYYY-MM-DD
+    sort = args.get("sort") or default_sort
+    if sort.lstrip("-") not in store.sorts:
+        raise ValueError(f"sort must be one of {', '.join(sorted(store.sorts))}")
+    limit = args.get("limit")
+    if limit is not None:
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    after = decode_cursor(args["cursor"]) if args.get("cursor") else None
+    return Query(flags=flags, date_from=date_from, date_to=date_to, sort=sort, after=after, limit=limit)
+
+def list_response(store, q):
+    """
+    One page as a JSON array. The next page's cursor is in X-Next-Cursor and a
+    Link header; a matching If-None-Match / If-Modified-Since gets a 304 before
+    anything is read beyond the collection's version.
+    """
+    token, modified = store.version()
+    etag = hashlib.blake2b(f"{token}|{request.query_string.decode('latin-1')}".encode("utf-8"),
+                           digest_size=12).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=modified):
+        response = Response(status=304)
+    else:
+        items, next_cursor = store.query(q)
+        response = jsonify(items)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+            args = request.args.to_dict()
+            args["cursor"] = next_cursor
+            response.headers["Link"] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+    response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = modified
+    # per-user data: the browser may keep it, but must revalidate every time
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
 
 # --- Planner API ---
+# ?completed=true|false &date_from=&date_to=YYYY-MM-DD &sort=created|date|-date &limit=&cursor=
 @app.route("/planner_items", methods=["GET"])
 def get_planner_items():
-    return jsonify(planner_items)
-
-@app.route("/planner_items", methods=["POST"])
-def add_planner_item():
-    data = request.get_json(silent=True) or {}
-    title = (data.get("title") or "").strip()
+    store = current_user().planner
+    try:
+        q = list_query(store, request.args, default_sort="created")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(store, q)
+
+def new_planner_item(data):
+    """Planner item from request fields; ValueError if it has no title."""
+    title = str(data.get("title") or "").strip()
     if not title:
-        return jsonify({"error": "Title required"}), 400
-    item = {
+        raise ValueError("Title required")
+    return {
         "id": str(uuid.uuid4()),
         "title": title,
-        "date": data.get("date", "").strip(),
-        "time": data.get("time", "").strip(),
-        "notes": data.get("notes", "").strip(),
+        "date": str(data.get("date") or "").strip(),
+        "time": str(data.get("time") or "").strip(),
+        "notes": str(data.get("notes") or "").strip(),
         "completed": False
     }
-    planner_items.append(item)
-    save_planner()
+
+def planner_edit(data):
+    """fn(item) for store.edit that applies the fields present in `data`."""
+    def edit(it):
+        if "completed" in data:
+            it["completed"] = bool(data["completed"])
+        if "title" in data: it["title"] = (data.get("title") or "").strip()
+        if "date" in data: it["date"] = (data.get("date") or "").strip()
+        if "time" in data: it["time"] = (data.get("time") or "").strip()
+        if "notes" in data: it["notes"] = (data.get("notes") or "").strip()
+        return it
+    return edit
+
+@app.route("/planner_items", methods=["POST"])
+def add_planner_item():
+    data = request.get_json(silent=True) or {}
+    try:
+        item = new_planner_item(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    current_user().planner.add(item)
     return jsonify(item), 201
 
 @app.route("/planner_items/<item_id>", methods=["DELETE"])
 def delete_planner_item(item_id):
-    global planner_items
-    planner_items = [i for i in planner_items if i.get("id") != item_id]
-    save_planner()
+    current_user().planner.delete(item_id)
     return jsonify({"ok": True})
 
 @app.route("/planner_items/<item_id>", methods=["PATCH"])
 def update_planner_item(item_id):
     data = request.get_json(silent=True) or {}
-    for it in planner_items:
-        if it.get("id") == item_id:
-            if "completed" in data:
-                it["completed"] = bool(data["completed"])
-            if "title" in data: it["title"] = (data.get("title") or "").strip()
-            if "date" in data: it["date"] = (data.get("date") or "").strip()
-            if "time" in data: it["time"] = (data.get("time") or "").strip()
-            if "notes" in data: it["notes"] = (data.get("notes") or "").strip()
-            save_planner()
-            return jsonify(it)
+    it = current_user().planner.edit(item_id, planner_edit(data))
+    if it is not None:
+        return jsonify(it)
     return jsonify({"error": "Not found"}), 404
 
+# --- Planner batch, export and import ---
+MAX_BATCH_OPS = 1000
+IMPORT_BATCH = 1000  # imported rows per store write
+PLANNER_FIELDS = ("id", "title", "date", "time", "notes", "completed")
+
+def batch_op(op):
+    """Store op for one entry of a /planner_items/batch request; ValueError if malformed."""
+    if not isinstance(op, dict):
+        raise ValueError("each op must be an object")
+    for field in ("title", "date", "time", "notes"):
+        if op.get(field) is not None and not isinstance(op[field], str):
+            raise ValueError(f"{field} must be a string")
+    if "completed" in op and not isinstance(op["completed"], bool):
+        raise ValueError("completed must be true or false")
+    kind = op.get("op")
+    if kind == "create":
+        return ("add", new_planner_item(op))
+    if kind not in ("update", "complete", "delete"):
+        raise ValueError("op must be create, update, complete or delete")
+    if not isinstance(op.get("id"), str) or not op["id"]:
+        raise ValueError(f"{kind} needs an id")
+    if kind == "delete":
+        return ("delete", op["id"])
+    if kind == "complete":
+        return ("edit", op["id"], planner_edit({"completed": op.get("completed", True)}))
+    return ("edit", op["id"], planner_edit(op))
+
+# {"ops": [{"op": "create", "title": ...}, {"op": "update", "id": ..., "notes": ...},
+#          {"op": "complete", "id": ...}, {"op": "delete", "id": ...}]}
+# all applied in order with one write; one result per op
+@app.route("/planner_items/batch", methods=["POST"])
+def planner_batch():
+    ops = (request.get_json(silent=True) or {}).get("ops")
+    if not isinstance(ops, list) or not ops:
+        return jsonify({"error": "ops must be a non-empty list"}), 400
+    if len(ops) > MAX_BATCH_OPS:
+        return jsonify({"error": f"at most {MAX_BATCH_OPS} ops per batch"}), 400
+    store_ops = []
+    for n, op in enumerate(ops):
+        try:
+            store_ops.append(batch_op(op))
+        except ValueError as e:
+            # nothing is applied unless every op is valid
+            return jsonify({"error": f"op {n}: {e}"}), 400
+    results = []
+    for op, result in zip(store_ops, current_user().planner.apply(store_ops)):
+        if op[0] == "delete":
+            results.append({"ok": result})
+        elif result is None:
+            results.append({"error": "Not found"})
+        else:
+            results.append(result)
+    return jsonify({"results": results})
+
+def in_chunks(pieces, size=1 << 16):
+    """Join a stream of small strings into ~`size` pieces, so a big download isn't one write per line."""
+    buf, n = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield "".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield "".join(buf)
+
+def download(pieces, mimetype, filename):
+    # the store is resolved before streaming starts; the generator only reads from it
+    return Response(in_chunks(pieces), mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "private, no-cache",
+    })
+
+def planner_text_lines(items):
+    empty = True
+    for idx, it in enumerate(items, start=1):
+        empty = False
+        lines = [f"Item {idx}",
+                 f"Title : {it.get('title','')}",
+                 f"Date  : {it.get('date','')}",
+                 f"Time  : {it.get('time','')}"]
+        notes = (it.get('notes') or "").strip()
+        if notes:
+            # preserve newlines in notes by indenting subsequent lines
+            note_lines = notes.splitlines()
+            lines.append(f"Notes : {note_lines[0]}")
+            for nl in note_lines[1:]:
+                lines.append(f"        {nl}")
+        else:
+            lines.append("Notes : ")
+        lines.append(f"Status: {'Completed' if it.get('completed') else 'Pending'}")
+        lines.append("-" * 40)
+        yield "\n".join(lines) + "\n"
+    if empty:
+        yield "Planner is empty.\n"
+
+class _Echo:
+    """File-like object for csv.writer that hands each row back instead of storing it."""
+    def write(self, value):
+        return value
+
+def planner_csv_lines(items):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(PLANNER_FIELDS)
+    for it in items:
+        yield writer.writerow([str(it.get("completed", False)).lower() if f == "completed" else it.get(f, "")
+                               for f in PLANNER_FIELDS])
+
+def ics_text(value):
+    return (str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def ics_line(line):
+    """One content line, folded at 75 octets (RFC 5545 3.1)."""
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line + "\r\n"
+    parts, start, limit = [], 0, 75
+    while start < len(raw):
+        end = min(start + limit, len(raw))
+        while end < len(raw) and (raw[end] & 0xC0) == 0x80:
+            end -= 1  # don't split a UTF-8 sequence
+        parts.append(raw[start:end].decode("utf-8"))
+        start, limit = end, 74  # continuation lines start with a space
+    return "\r\n ".join(parts) + "\r\n"
+
+def planner_ics_lines(items):
+    """Dated items as all-day or timed (floating local time) events, the rest as to-dos."""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield ics_line("BEGIN:VCALENDAR") + ics_line("VERSION:2.0") + ics_line("PRODID:-//Saathi//Planner//EN")
+    for it in items:
+        try:
+            day = date.fromisoformat(str(it.get("date") or ""))
+        except ValueError:
+            day = None
+        lines = [f"UID:{it.get('id')}@saathi", f"DTSTAMP:{stamp}", f"SUMMARY:{ics_text(it.get('title', ''))}"]
+        if it.get("notes"):
+            lines.append(f"DESCRIPTION:{ics_text(it['notes'])}")
+        if day is None:
+            kind = "VTODO"
+            lines.append("STATUS:" + ("COMPLETED" if it.get("completed") else "NEEDS-ACTION"))
+        else:
+            kind = "VEVENT"
+            try:
+                at = datetime.strptime(str(it.get("time") or ""), "%H:%M").time()
+                lines.append(f"DTSTART:{datetime.combine(day, at).strftime('%Y%m%dT%H%M%S')}")
+            except ValueError:
+                lines.append(f"DTSTART;VALUE=DATE:{day.strftime('%Y%m%d')}")
+            if it.get("completed"):
+                lines.append("X-SAATHI-COMPLETED:TRUE")
+        yield "".join(ics_line(line) for line in [f"BEGIN:{kind}", *lines, f"END:{kind}"])
+    yield ics_line("END:VCALENDAR")
+
 # Download planner file (returns planner.json as attachment)
 @app.route("/download_planner", methods=["GET"])
 def download_planner():
@@ -325,60 +634,81 @@ def download_planner():
 # new: download planner as structured plain text
 @app.route("/download_planner_text", methods=["GET"])
 def download_planner_text():
-    # Build a readable plain-text export of planner_items
-    lines = []
-    if not planner_items:
-        lines.append("Planner is empty.")
-    else:
-        for idx, it in enumerate(planner_items, start=1):
-            lines.append(f"Item {idx}")
-            lines.append(f"Title : {it.get('title','')}")
-            lines.append(f"Date  : {it.get('date','')}")
-            lines.append(f"Time  : {it.get('time','')}")
-            notes = (it.get('notes') or "").strip()
-            if notes:
-                # preserve newlines in notes by indenting subsequent lines
-                note_lines = notes.splitlines()
-                lines.append(f"Notes : {note_lines[0]}")
-                for nl in note_lines[1:]:
-                    lines.append(f"        {nl}")
-            else:
-                lines.append("Notes : ")
-            lines.append(f"Status: {'Completed' if it.get('completed') else 'Pending'}")
-            lines.append("-" * 40)
-    body = "\n".join(lines) + "\n"
-    headers = {
-        "Content-Type": "text/plain; charset=utf-8",
-        "Content-Disposition": 'attachment; filename="planner.txt"'
-    }
-    return (body, 200, headers)
-
-# --- Time Capsule storage ---
-TIME_MESSAGES_FILE = "time_messages.json"
-
-def load_time_messages():
-    p = Path(TIME_MESSAGES_FILE)
-    if p.exists():
-        try:
-            return json.loads(p.read_text(encoding="utf-8")) or []
-        except Exception:
-            return []
-    return []
-
-def save_time_messages(items):
+    # streamed item by item, so the export never sits in memory whole
+    items = current_user().planner.iter_items()
+    return download(planner_text_lines(items), "text/plain; charset=utf-8", "planner.txt")
+
+@app.route("/download_planner_csv", methods=["GET"])
+def download_planner_csv():
+    items = current_user().planner.iter_items()
+    return download(planner_csv_lines(items), "text/csv; charset=utf-8", "planner.csv")
+
+@app.route("/download_planner_ics", methods=["GET"])
+def download_planner_ics():
+    items = current_user().planner.iter_items()
+    return download(planner_ics_lines(items), "text/calendar; charset=utf-8", "planner.ics")
+
+def import_rows(stream, fmt):
+    """Dicts from an uploaded CSV (header row as in /download_planner_csv) or NDJSON body, read as it arrives."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="" if fmt == "csv" else None)
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError("not valid JSON")
+            if not isinstance(row, dict):
+                raise ValueError("each line must be a JSON object")
+            yield row
+
+def imported_item(row):
+    item = new_planner_item(row)  # a fresh id: importing the same file twice adds the items twice
+    completed = row.get("completed")
+    item["completed"] = completed is True or str(completed).strip().lower() in ("true", "1", "yes")
+    return item
+
+# POST a CSV export (Content-Type: text/csv) or one JSON item per line (application/x-ndjson);
+# items are appended in batches of IMPORT_BATCH, so the upload is never held whole
+@app.route("/planner_items/import", methods=["POST"])
+def import_planner_items():
+    fmt = request.args.get("format") or ("csv" if request.mimetype == "text/csv" else "ndjson")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+    store = current_user().planner
+    imported, batch, read = 0, [], 0
     try:
-        Path(TIME_MESSAGES_FILE).write_text(json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8")
-    except Exception as e:
-        print("Could not save time messages:", e)
-
-# API: list scheduled messages (pending + delivered optional ?query=all)
+        for row in import_rows(request.stream, fmt):
+            batch.append(("add", imported_item(row)))
+            read += 1
+            if len(batch) >= IMPORT_BATCH:
+                store.apply(batch)
+                imported += len(batch)
+                batch = []
+    except (ValueError, csv.Error, UnicodeDecodeError) as e:
+        # earlier batches are kept; the reply says how far the import got
+        return jsonify({"error": f"item {read + 1}: {e}", "imported": imported}), 400
+    if batch:
+        store.apply(batch)
+        imported += len(batch)
+    return jsonify({"imported": imported}), 201
+
+# --- Time Capsule API (per session, see stores.py) ---
+# API: list scheduled messages
+# ?delivered=true|false (or q=pending) &date_from=&date_to= &sort=created|scheduled_date &limit=&cursor=
 @app.route("/time_messages", methods=["GET"])
 def get_time_messages():
-    items = load_time_messages()
-    q = request.args.get("q", "")
-    if q == "pending":
-        items = [i for i in items if not i.get("delivered")]
-    return jsonify(items)
+    store = current_user().time_messages
+    args = request.args.to_dict()
+    if args.get("q") == "pending":
+        args["delivered"] = "false"
+    try:
+        q = list_query(store, args, default_sort="created")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(store, q)
 
 # API: create scheduled message
 @app.route("/time_messages", methods=["POST"])
@@ -398,7 +728,6 @@ def create_time_message():
         except Exception:
             return jsonify({"error":"invalid scheduled_date, use ISO format (YYYY-MM-DD or full ISO)"}), 400
 
-    items = load_time_messages()
     item = {
         "id": str(uuid.uuid4()),
         "message": msg,
@@ -407,98 +736,225 @@ def create_time_message():
         "delivered": False,
         "delivered_at": None
     }
-    items.append(item)
-    save_time_messages(items)
+    user = current_user()
+    user.time_messages.add(item)
+    delivery_scheduler.schedule(user.sid, item["id"], sched)
     return jsonify(item), 201
 
 # API: edit scheduled message
 @app.route("/time_messages/<msg_id>", methods=["PATCH"])
 def update_time_message(msg_id):
     data = request.get_json(silent=True) or {}
-    items = load_time_messages()
-    for it in items:
-        if it.get("id") == msg_id and not it.get("delivered"):
-            if "message" in data: it["message"] = (data.get("message") or "").strip()
-            if "scheduled_date" in data:
-                it["scheduled_date"] = (data.get("scheduled_date") or "").strip()
-            save_time_messages(items)
-            return jsonify(it)
+    def edit(it):
+        if it.get("delivered"):
+            return None
+        if "message" in data: it["message"] = (data.get("message") or "").strip()
+        if "scheduled_date" in data:
+            it["scheduled_date"] = (data.get("scheduled_date") or "").strip()
+        return it
+    user = current_user()
+    it = user.time_messages.edit(msg_id, edit)
+    if it is not None:
+        if "scheduled_date" in data:
+            delivery_scheduler.schedule(user.sid, msg_id, it["scheduled_date"])
+        return jsonify(it)
     return jsonify({"error":"not found or already delivered"}), 404
 
 # API: delete scheduled message
 @app.route("/time_messages/<msg_id>", methods=["DELETE"])
 def delete_time_message(msg_id):
-    items = load_time_messages()
-    new = [i for i in items if i.get("id") != msg_id]
-    save_time_messages(new)
+    current_user().time_messages.delete(msg_id)
     return jsonify({"ok": True})
 
-# Delivery logic: find due messages and mark delivered, append to chat_history.json
-def deliver_due_messages():
-    items = load_time_messages()
-    now = datetime.now(timezone.utc)
-    changed = False
-    delivered_msgs = []
-    for it in items:
-        if it.get("delivered"):
-            continue
-        # interpret scheduled_date flexibly
+# --- Search ---
+# ?q=words "a phrase" prefix* &role=user|assistant &source=chat|time_capsule
+# &date_from=&date_to=YYYY-MM-DD &sort=relevance|recent &limit=
+@app.route("/search", methods=["GET"])
+def search_history():
+    args = request.args
+    q = (args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "q required"}), 400
+    role, source = args.get("role") or None, args.get("source") or None
+    date_from, date_to = args.get("date_from") or None, args.get("date_to") or None
+    sort = args.get("sort") or "relevance"
+    try:
+        if role not in (None, "user", "assistant"):
+            raise ValueError("role must be user or assistant")
+        if source not in (None, "chat", "time_capsule"):
+            raise ValueError("source must be chat or time_capsule")
+        if sort not in ("relevance", "recent"):
+            raise ValueError("sort must be relevance or recent")
+        for d in (date_from, date_to):
+            if d:
+                date.fromisoformat(d)  # YYYY-MM-DD
+        limit = max(1, min(int(args.get("limit") or 20), MAX_PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    started = time.perf_counter()
+    result = current_user().search.search(q, role=role, source=source, date_from=date_from, date_to=date_to,
+                                          sort=sort, limit=limit)
+    result["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    response = jsonify(result)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+# --- Push notifications (see notify.py) ---
+notifier = Notifier.from_env(os.path.join(sessions.DATA_DIR, "notify"))
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))  # seconds between keep-alive comments
+SSE_QUEUE = 100  # events held for one slow connection before newer ones are dropped
+
+@app.route("/events")
+def events():
+    """
+    Server-Sent Events for this session: "ready" once connected, then
+    "delivered" whenever time capsule messages are delivered, by any worker.
+    Each open connection holds a worker thread here, so a single-threaded
+    worker (gunicorn's sync class) answers 204, which tells the browser not
+    to reconnect. Threaded workers (gthread, as gunicorn.conf.py sets up)
+    stream; under asgi.py a
+    connection is only a coroutine, which is what many idle clients need.
+    """
+    if not request.environ.get("wsgi.multithread"):
+        return Response(status=204)
+    sid = current_user().sid
+
+    def generate():
+        pending = queue.Queue(SSE_QUEUE)
+
+        def on_event(event, data):
+            try:
+                pending.put_nowait((event, data))
+            except queue.Full:
+                pass
+        token = notifier.subscribe(sid, on_event)
         try:
-            scheduled = datetime.fromisoformat(it["scheduled_date"])
-        except Exception:
-            # date-only fallback
-            scheduled = datetime.fromisoformat(it["scheduled_date"] + "T00:00:00")
-        # compare in UTC: deliver when scheduled <= now
-        if scheduled.replace(tzinfo=timezone.utc) <= now:
-            it["delivered"] = True
-            it["delivered_at"] = now.isoformat()
-            changed = True
-            delivered_msgs.append(it)
-    if changed:
-        save_time_messages(items)
-        # append each delivered message into chat_history.json as assistant notification
+            yield "retry: 5000\n" + sse_event("ready", {})
+            while True:
+                try:
+                    event, data = pending.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"  # also how a closed connection is noticed
+                    continue
+                yield sse_event(event, data)
+        finally:
+            notifier.unsubscribe(token)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(generate(), mimetype="text/event-stream", headers=headers)
+
+# Delivery logic: the scheduler keeps pending messages ordered by due time,
+# so a run only touches sessions with something due
+def deliver_due_messages():
+    return delivery_scheduler.deliver_due()
+
+# mark one user's due messages delivered, append them to their chat history
+def deliver_user_messages(user, now=None):
+    now = now or datetime.now(timezone.utc)
+    # each backend marks a message delivered exactly once, even with workers racing
+    delivered_msgs = user.time_messages.deliver_due(now)
+    if delivered_msgs:
+        # append each delivered message to the chat history as assistant notification
         try:
-            hist_path = Path(HISTORY_FILE)
-            hist = []
-            if hist_path.exists():
-                hist = json.loads(hist_path.read_text(encoding="utf-8")) or []
-            for m in delivered_msgs:
-                hist.append({
-                    "role": "assistant",
-                    "content": f"[Time Capsule] {m['message']}",
-                    "meta": {"time_message_id": m["id"], "delivered_at": m.get("delivered_at")}
-                })
-            hist_path.write_text(json.dumps(hist, ensure_ascii=False, indent=2), encoding="utf-8")
+            user.history.append_many({
+                "role": "assistant",
+                "content": f"[Time Capsule] {m['message']}",
+                "meta": {"time_message_id": m["id"], "delivered_at": m.get("delivered_at")},
+                "ts": now.isoformat(timespec="seconds"),
+            } for m in delivered_msgs)
         except Exception as e:
             print("Could not append delivered messages to history:", e)
+        # push to the session's open /events connections, on whichever worker holds them
+        notifier.publish(user.sid, "delivered", {"messages": [
+            {k: m.get(k) for k in ("id", "message", "scheduled_date", "delivered_at")} for m in delivered_msgs]})
     return delivered_msgs
 
+def deliver_session_messages(sid, now):
+    return deliver_user_messages(session_cache.get(sid), now)
+
+delivery_scheduler = DeliveryScheduler(
+    deliver_session_messages, sessions.pending_time_messages,
+    os.path.join(sessions.DATA_DIR, "schedule.jsonl"),
+    journal_poll=float(os.getenv("SCHEDULER_JOURNAL_POLL", "30")))
+
 # Expose route so Render cron or external scheduler can call it daily/minutely
 @app.route("/run_deliveries", methods=["POST","GET"])
 def run_deliveries_route():
     delivered = deliver_due_messages()
     return jsonify({"delivered_count": len(delivered), "delivered_ids":[d["id"] for d in delivered]})
 
-# Optional: lightweight background checker for local/dev (calls deliver_due_messages every minute)
-def start_delivery_worker(interval_seconds=60):
-    import threading, time
-    def worker():
-        while True:
-            try:
-                deliver_due_messages()
-            except Exception:
-                pass
-            time.sleep(interval_seconds)
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
+# Optional: background delivery thread for local/dev; sleeps until the next message is due
+def start_delivery_worker():
+    delivery_scheduler.start()
 
-# Start background worker only in dev mode (avoid in some production hosts)
-if __name__ == "__main__" or os.environ.get("ENABLE_TIME_WORKER") == "1":
+# Start background worker only in dev mode (avoid in some production hosts).
+# With gunicorn --preload (gunicorn.conf.py) threads don't survive the fork,
+# so there each worker starts it from post_fork instead.
+if (__name__ == "__main__" or os.environ.get("ENABLE_TIME_WORKER") == "1") and os.environ.get("SAATHI_PRELOAD") != "1":
     # don't start the thread in Gunicorn worker processes by default on Render;
     # use Render Cron to call /run_deliveries, or set ENABLE_TIME_WORKER=1 for testing.
     if os.environ.get("FLASK_ENV") == "development" or os.environ.get("ENABLE_TIME_WORKER") == "1":
         start_delivery_worker()
 
+# A data file that exists but can't be parsed: refuse the request rather than
+# treating it as empty (which would overwrite the user's data on the next save)
+@app.errorhandler(CorruptFileError)
+def corrupt_file(e):
+    print("Corrupt data file:", e)
+    return jsonify({"error": "stored data is unreadable, please try again later"}), 503
+
+# --- /metrics ---
+def stats_samples(prefix, stats, help):
+    """Numeric stats() entries as gauges; a nested dict becomes one labelled series."""
+    for key, value in stats.items():
+        name = f"saathi_{prefix}_{key}"
+        if isinstance(value, dict):
+            for label, v in value.items():
+                yield name, "gauge", f"{help}: {key}", v, {"name": label}
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, "gauge", f"{help}: {key}", value
+
+@REGISTRY.collector
+def app_stats():
+    yield "saathi_process_info", "gauge", "Worker process that served this scrape.", 1, {"pid": os.getpid()}
+    yield "saathi_sessions_cached", "gauge", "Sessions held in this worker's cache.", len(session_cache)
+    yield ("saathi_upstream_circuit_open", "gauge", "1 while the upstream circuit breaker is open.",
+           int(upstream.breaker.state == "open"))
+    yield from stats_samples("response_cache", response_cache.stats(), "Response cache")
+    yield from stats_samples("context", context_builder.stats(), "Context builder")
+    yield from stats_samples("intents", intent_router.stats(), "Intent routing")
+    yield from stats_samples("coalescer", coalescer.stats(), "Request coalescing")
+    yield from stats_samples("rate_limit", upstream_limiter.stats(), "Upstream rate limiter")
+    yield from stats_samples("capture", chat_capture.stats(), "Chat capture")
+    yield from stats_samples("notify", notifier.stats(), "Push notifications")
+    if sessions.write_behind is not None:
+        yield from stats_samples("write_behind", sessions.write_behind.stats(), "Write-behind queue")
+
+@app.route("/metrics")
+def metrics_route():
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# --- Warmup ---
+TEMPLATES = ("index.html", "planner.html", "time_traveler.html")
+
+def warmup():
+    """
+    Do the work the first requests would otherwise pay for: the intent model,
+    the compiled templates, the delivery heap and the HTTP client import.
+    gunicorn.conf.py runs it once in the master before forking, so every
+    worker starts with it done (and shares the memory).
+    """
+    started = time.perf_counter()
+    intent_router.warmup()
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+    delivery_scheduler.next_due()
+    import requests  # noqa: F401  (upstream imports it on the first call)
+    return time.perf_counter() - started
+
 # --- Flask routes ---
 @app.route("/")
 def home():
@@ -511,9 +967,74 @@ def chat():
     if not user_input:
         return jsonify({"reply": "Please enter a message."})
 
-    response = chatbot_response(user_input)
+    user = current_user()
+    response = coalescer.run((user.sid, user_input), lambda: chatbot_response(user_input, user))
     return jsonify({"reply": response})
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_turn(user_input, user):
+    """One chat turn as ("delta" | "done", payload) events."""
+    capture = chat_capture.begin(user.sid, user_input, "stream")
+    greeting, turn, user_name = start_turn(user_input, user)
+    if greeting:
+        chat_capture.end(capture, greeting, "local", user_name)
+        yield "done", {"reply": greeting}
+        return
+    formatter = StreamingFormatter(max_sentences=7)
+    payload = build_payload(turn, user)
+    context = reply_cache_context(user_input, user_name, user, payload)
+    cached = cached_reply(user_input, context)
+    outcome = {}
+    chunks = [cached] if cached is not None else stream_perplexity(turn, user, outcome, payload)
+    for chunk in chunks:
+        if formatter.capped:
+            formatter.feed(chunk)  # keep the full text for history
+            continue
+        blocks, line = formatter.feed(chunk)
+        if blocks or line:
+            yield "delta", {"blocks": blocks, "line": line}
+    blocks = formatter.finish()
+    if blocks:
+        yield "delta", {"blocks": blocks, "line": None}
+    if outcome.get("complete"):
+        remember_reply(user_input, context, formatter.text)
+    html = finish_turn(user_input, user_name, formatter.text, user)
+    chat_capture.end(capture, html, "cache" if cached is not None else "ai", user_name, formatter.text)
+    yield "done", {"reply": html}
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Same turn as /chat, streamed as Server-Sent Events: "delta" events carry
+    finished blocks plus the current partial line, and a final "done" event
+    carries the complete formatted reply once history has been saved.
+    """
+    data = request.get_json(silent=True) or {}
+    user_input = data.get("message", "").strip()
+    user = current_user()
+
+    def generate():
+        if not user_input:
+            yield sse_event("done", {"reply": "Please enter a message."})
+            return
+        leader, flight = coalescer.join((user.sid, user_input))
+        if not leader:
+            # a duplicate of a turn that is running or just finished: share its reply
+            yield sse_event("done", {"reply": flight})
+            return
+        try:
+            for event, payload in stream_turn(user_input, user):
+                if event == "done":
+                    coalescer.resolve(flight, payload["reply"])
+                yield sse_event(event, payload)
+        finally:
+            coalescer.release(flight)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
 @app.route("/planner")
 def planner_page():
     # Render a separate planner page (new template)
@@ -523,72 +1044,6 @@ def planner_page():
 def time_traveler_page():
     return render_template("time_traveler.html")
 
-def store_name(user_input: str):
-    """
-    Extracts and cleans a likely user name from input text.
-    Handles formats like 'my name is X', 'I am X', "I'm X", or single-word names.
-    Rejects values in INVALID_NAMES and common filler words.
-    """
-    if not user_input:
-        return None
-
-    text = user_input.strip()
-
-    # common patterns: "my name is X", "call me X", "I'm X", "I am X"
-    patterns = [
-        r"\bmy\s+name\s+is\s+([A-Za-z][A-ZaZ'\-]*)\b",
-        r"\bcall\s+me\s+([A-Za-z][A-ZaZ'\-]*)\b",
-        r"\bi\s*(?:'m|am)\s+([A-Za-z][A-Za-z'\-]*)\b"
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, text, flags=re.IGNORECASE)
-        if match:
-            candidate = re.sub(r"[^A-Za-z'\-]", "", match.group(1)).strip().capitalize()
-            if candidate and candidate.lower() not in INVALID_NAMES:
-                return candidate
-
-    # single-word input -> treat as name only if alphabetic, reasonable length,
-    # not in INVALID_NAMES, and likely a real name (simple vowel check)
-    tokens = text.split()
-    if len(tokens) == 1:
-        token = re.sub(r"[^A-Za-z'\-]", "", tokens[0]).strip()
-        if token and token.isalpha() and 2 <= len(token) <= 30 and token.lower() not in INVALID_NAMES:
-            # require at least one vowel OR allow very short names (<=3) to accommodate e.g. "Li"
-            if re.search(r"[aeiou]", token, flags=re.I) or len(token) <= 3:
-                return token.capitalize()
-
-    return None
-
-def choose_followup(user_input: str):
-    """
-    Return a short student-focused follow-up question based on user_input.
-    Keep it concise and actionable.
-    """
-    if not user_input:
-        return "Would you like to tell me more or try a short grounding exercise?"
-
-    u = user_input.lower()
-
-    exams = ["exam", "exams", "test", "tests", "grade", "grades", "marks", "result", "results"]
-    stress = ["stress", "stressed", "stressing", "overwhelmed", "pressure", "deadline"]
-    anxious = ["anxious", "anxiety", "worried", "worried about"]
-    happy = ["happy", "excited", "great", "celebrate", "good marks", "good grade", "got"]
-    sleep = ["sleep", "tired", "rest", "insomnia"]
-    social = ["friend", "friends", "relationship", "peer", "classmate", "roommate"]
-
-    if any(k in u for k in exams):
-        return "Congrats — would you like tips to keep the momentum or plan next study steps?"
-    if any(k in u for k in happy):
-        return "That’s wonderful — want ideas to celebrate or channels to share this with friends?"
-    if any(k in u for k in anxious) or any(k in u for k in stress):
-        return "Would you like a short breathing exercise now or a few quick strategies to manage this stress?"
-    if any(k in u for k in sleep):
-        return "Would you like some quick sleep tips you can try tonight?"
-    if any(k in u for k in social):
-        return "Do you want help thinking through how to talk to them or what to say?"
-    # default
-    return "Would you like to tell me more, or try a short grounding exercise?"
-
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 5000))
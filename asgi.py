@@ -0,0 +1,418 @@
+"""
+Asyncio (ASGI) serving mode.
+
+    uvicorn asgi:app --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+/chat and /chat/stream run on the event loop with the async upstream client,
+so a slow LLM reply holds a coroutine instead of a whole worker; so does
+every open /events connection. Their file I/O (profile, history) runs in
+the default thread pool. Every other route
+(pages, planner, time capsule, deliveries) is the existing Flask app, called
+in the thread pool as well, so the loop never blocks on disk; its request
+body and response are passed through as they arrive, so uploads and
+exports stream here too. Waits that can last seconds (a turn queued by the
+rate limiter, a duplicate waiting for its leader's reply) run on a separate
+bounded pool, ASGI_WAIT_THREADS threads, so a burst of them can't use up
+the default pool that everything else needs.
+The WSGI app (`gunicorn app:app`) keeps working unchanged.
+"""
+import asyncio
+import contextvars
+import functools
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as wsgi
+import metrics
+import sessions
+from upstream import AsyncUpstreamClient
+
+upstream = AsyncUpstreamClient.from_env(api_key=wsgi.PERPLEXITY_KEY)
+# threads start on first use, so each forked worker gets its own
+wait_pool = ThreadPoolExecutor(int(os.getenv("ASGI_WAIT_THREADS", "64")), thread_name_prefix="asgi-wait")
+
+
+async def wait_in_pool(fn, *args):
+    """asyncio.to_thread on wait_pool: for calls that block until something else happens."""
+    call = functools.partial(contextvars.copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(wait_pool, call)
+
+
+# --- Async chat turn ---
+async def ask_perplexity(turn, user, payload=None):
+    if not wsgi.PERPLEXITY_KEY:
+        return "(Offline Mode) API key not set."
+    payload = payload or await asyncio.to_thread(wsgi.build_payload, turn, user)
+    started = time.perf_counter()
+    try:
+        await wait_in_pool(wsgi.upstream_limiter.acquire, user.sid)
+        reply = wsgi.reply_from_result(await upstream.chat_completion(payload))
+        metrics.record(metrics.LLM_SECONDS, started, "llm.call", mode="complete", outcome="ok")
+        wsgi.chat_capture.upstream(payload["messages"], started)
+        return reply
+    except Exception as e:
+        metrics.record(metrics.LLM_SECONDS, started, "llm.call", mode="complete", outcome="offline")
+        wsgi.chat_capture.upstream(payload["messages"], started, ok=False)
+        return wsgi.offline_reply(e)
+
+
+async def stream_perplexity(turn, user, outcome=None, payload=None):
+    if not wsgi.PERPLEXITY_KEY:
+        yield "(Offline Mode) API key not set."
+        return
+    payload = payload or await asyncio.to_thread(wsgi.build_payload, turn, user)
+    got_text = False
+    started = time.perf_counter()
+    try:
+        await wait_in_pool(wsgi.upstream_limiter.acquire, user.sid)
+        async for chunk in upstream.stream_chat_completion(payload):
+            got_text = True
+            yield chunk
+        if outcome is not None:
+            outcome["complete"] = True
+        metrics.record(metrics.LLM_SECONDS, started, "llm.stream", mode="stream", outcome="ok")
+        wsgi.chat_capture.upstream(payload["messages"], started)
+    except Exception as e:
+        metrics.record(metrics.LLM_SECONDS, started, "llm.stream", mode="stream", outcome="offline")
+        wsgi.chat_capture.upstream(payload["messages"], started, ok=False)
+        reply = wsgi.offline_reply(e)
+        if not got_text:
+            yield reply
+
+
+async def chatbot_response(user_input, user):
+    capture = wsgi.chat_capture.begin(user.sid, user_input, "chat")
+    greeting, turn, user_name = await asyncio.to_thread(wsgi.start_turn, user_input, user)
+    if greeting:
+        wsgi.chat_capture.end(capture, greeting, "local", user_name)
+        return greeting
+    payload = await asyncio.to_thread(wsgi.build_payload, turn, user)
+    context = await asyncio.to_thread(wsgi.reply_cache_context, user_input, user_name, user, payload)
+    ai_text = wsgi.cached_reply(user_input, context)
+    path = "cache"
+    if ai_text is None:
+        path = "ai"
+        ai_text = await ask_perplexity(turn, user, payload)
+        wsgi.remember_reply(user_input, context, ai_text)
+    html = await asyncio.to_thread(wsgi.finish_turn, user_input, user_name, ai_text, user)
+    wsgi.chat_capture.end(capture, html, path, user_name, ai_text)
+    return html
+
+
+# --- Handlers ---
+async def chat(scope, receive, send):
+    data = await read_json(receive)
+    user, cookie_headers = resolve_user(scope)
+    user_input = (data.get("message") or "").strip()
+    if not user_input:
+        return await send_json(send, {"reply": "Please enter a message."}, headers=cookie_headers)
+    # duplicates of a running (or just finished) turn share its reply
+    leader, flight = await wait_in_pool(wsgi.coalescer.join, (user.sid, user_input))
+    if not leader:
+        return await send_json(send, {"reply": flight}, headers=cookie_headers)
+    try:
+        reply = await chatbot_response(user_input, user)
+        wsgi.coalescer.resolve(flight, reply)
+    finally:
+        wsgi.coalescer.release(flight)
+    await send_json(send, {"reply": reply}, headers=cookie_headers)
+
+
+async def chat_stream(scope, receive, send):
+    data = await read_json(receive)
+    user, cookie_headers = resolve_user(scope)
+    user_input = (data.get("message") or "").strip()
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")] + cookie_headers,
+    })
+
+    async def event(name, payload, more=True):
+        body = wsgi.sse_event(name, payload).encode("utf-8")
+        await send({"type": "http.response.body", "body": body, "more_body": more})
+
+    if not user_input:
+        return await event("done", {"reply": "Please enter a message."}, more=False)
+    leader, flight = await wait_in_pool(wsgi.coalescer.join, (user.sid, user_input))
+    if not leader:
+        return await event("done", {"reply": flight}, more=False)
+    try:
+        await stream_turn(user_input, user, flight, event)
+    finally:
+        wsgi.coalescer.release(flight)
+
+
+async def stream_turn(user_input, user, flight, event):
+    """The streamed turn; its final reply also resolves `flight` for duplicates."""
+    capture = wsgi.chat_capture.begin(user.sid, user_input, "stream")
+    greeting, turn, user_name = await asyncio.to_thread(wsgi.start_turn, user_input, user)
+    if greeting:
+        wsgi.chat_capture.end(capture, greeting, "local", user_name)
+        wsgi.coalescer.resolve(flight, greeting)
+        return await event("done", {"reply": greeting}, more=False)
+    formatter = wsgi.StreamingFormatter(max_sentences=7)
+    payload = await asyncio.to_thread(wsgi.build_payload, turn, user)
+    context = await asyncio.to_thread(wsgi.reply_cache_context, user_input, user_name, user, payload)
+    cached = wsgi.cached_reply(user_input, context)
+    outcome = {}
+
+    async def chunks():
+        if cached is not None:
+            yield cached
+            return
+        async for chunk in stream_perplexity(turn, user, outcome, payload):
+            yield chunk
+
+    async for chunk in chunks():
+        if formatter.capped:
+            formatter.feed(chunk)
+            continue
+        blocks, line = formatter.feed(chunk)
+        if blocks or line:
+            await event("delta", {"blocks": blocks, "line": line})
+    blocks = formatter.finish()
+    if blocks:
+        await event("delta", {"blocks": blocks, "line": None})
+    if outcome.get("complete"):
+        wsgi.remember_reply(user_input, context, formatter.text)
+    html = await asyncio.to_thread(wsgi.finish_turn, user_input, user_name, formatter.text, user)
+    wsgi.chat_capture.end(capture, html, "cache" if cached is not None else "ai", user_name, formatter.text)
+    wsgi.coalescer.resolve(flight, html)
+    await event("done", {"reply": html}, more=False)
+
+
+async def events(scope, receive, send):
+    """/events (see app.events) as a coroutine: an idle connection costs no thread."""
+    user, cookie_headers = resolve_user(scope)
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue(wsgi.SSE_QUEUE)
+
+    def put(item):
+        if not pending.full():
+            pending.put_nowait(item)
+
+    def on_event(event, data):
+        # called from the notifier's threads
+        loop.call_soon_threadsafe(put, (event, data))
+
+    token = wsgi.notifier.subscribe(user.sid, on_event)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")] + cookie_headers,
+        })
+        body = "retry: 5000\n" + wsgi.sse_event("ready", {})
+        while True:
+            await send({"type": "http.response.body", "body": body.encode("utf-8"), "more_body": True})
+            get = asyncio.ensure_future(pending.get())
+            done, _ = await asyncio.wait({get, disconnected}, timeout=wsgi.SSE_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if get not in done:
+                get.cancel()
+            if disconnected in done:
+                return
+            body = wsgi.sse_event(*get.result()) if get in done else ": keep-alive\n\n"
+    finally:
+        wsgi.notifier.unsubscribe(token)
+        disconnected.cancel()
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+ROUTES = {
+    ("POST", "/chat"): chat,
+    ("POST", "/chat/stream"): chat_stream,
+    ("GET", "/events"): events,
+}
+
+
+# --- Plumbing ---
+def resolve_user(scope):
+    """Session for the request's cookie, plus the Set-Cookie header when a new one was started."""
+    cookie = b"; ".join(v for k, v in scope.get("headers", []) if k == b"cookie").decode("latin-1")
+    sid = sessions.session_id_from_cookie_header(cookie)
+    headers = []
+    if sid is None:
+        sid = sessions.new_session_id()
+        headers.append((b"set-cookie", sessions.session_cookie_header(sid).encode("latin-1")))
+    return wsgi.session_cache.get(sid), headers
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def read_json(receive):
+    try:
+        return json.loads(await read_body(receive) or b"{}") or {}
+    except ValueError:
+        return {}
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                    *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def wsgi_environ(scope, body_stream):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body_stream,
+        "wsgi.input_terminated": True,  # the stream ends with the body, even without a Content-Length
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = f"HTTP_{name}"
+            sep = "; " if key == "HTTP_COOKIE" else ","
+            environ[key] = f"{environ[key]}{sep}{value}" if key in environ else value
+    return environ
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    wsgi.input that pulls the request body from ASGI `receive` while Flask
+    reads it in a worker thread, so an upload is never buffered whole.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buf = b""
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            self._buf = message.get("body", b"")
+            self._done = message["type"] != "http.request" or not message.get("more_body")
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+def start_wsgi(environ):
+    """Call the Flask app in a worker thread: (status, headers, body iterator)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+    result = wsgi.app(environ, start_response)
+    return response["status"], response["headers"], result
+
+
+def next_chunk(chunks):
+    for chunk in chunks:
+        if chunk:
+            return chunk
+    return None
+
+
+async def call_flask(scope, receive, send):
+    environ = wsgi_environ(scope, io.BufferedReader(ReceiveStream(receive, asyncio.get_running_loop())))
+    status, headers, result = await asyncio.to_thread(start_wsgi, environ)
+    try:
+        # streamed responses (exports) are sent chunk by chunk as Flask produces them
+        chunks = iter(result)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        while True:
+            chunk = await asyncio.to_thread(next_chunk, chunks)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await asyncio.to_thread(result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await upstream.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        return await call_flask(scope, receive, send)  # Flask records its own metrics
+    await timed_handler(handler, scope, receive, send)
+
+
+async def timed_handler(handler, scope, receive, send):
+    """Route metrics and trace for the async handlers, as the Flask hooks do for the rest."""
+    method, route = scope["method"], scope["path"]
+    start = time.perf_counter()
+    trace = metrics.tracer.start(f"{method} {route}", route=route, method=method)
+    status = 500
+
+    async def send_tracking(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_tracking)
+    finally:
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - start, route=route, method=method)
+        metrics.HTTP_REQUESTS.inc(route=route, method=method, status=status)
+        metrics.tracer.finish(trace, status=status)
@@ -0,0 +1,105 @@
+"""
+Concurrent /chat throughput: sync WSGI workers vs the ASGI mode.
+
+    python bench/bench_async.py --clients 50 --requests 4 --latency 0.5 --workers 2
+
+Both modes run under gunicorn with the same worker count against a local fake
+LLM, in a scratch directory so no repo data files are touched.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_llm import start_fake_llm
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    "wsgi (sync workers)": ["app:app"],
+    "asgi (uvicorn workers)": ["asgi:app", "-k", "uvicorn.workers.UvicornWorker"],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not start")
+
+
+def run_mode(target, args, llm_url):
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="saathi-bench-")
+    env = dict(os.environ, PYTHONPATH=REPO, PERPLEXITY_API_KEY="bench", PERPLEXITY_API_URL=llm_url,
+               PERPLEXITY_READ_TIMEOUT="60")
+    cmd = [sys.executable, "-m", "gunicorn", *target, "-w", str(args.workers),
+           "-b", f"127.0.0.1:{port}", "--timeout", "120", "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        wait_for(base + "/")
+
+        def client(i):
+            latencies = []
+            with requests.Session() as s:
+                for _ in range(args.requests):
+                    t0 = time.perf_counter()
+                    r = s.post(base + "/chat", json={"message": "I feel stressed about exams"}, timeout=300)
+                    r.raise_for_status()
+                    latencies.append(time.perf_counter() - t0)
+            return latencies
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(args.clients) as pool:
+            latencies = [x for batch in pool.map(client, range(args.clients)) for x in batch]
+        elapsed = time.perf_counter() - t0
+    finally:
+        proc.terminate()
+        proc.wait(10)
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=4, help="requests per client")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency in seconds")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    server, llm_url = start_fake_llm(args.latency)
+    print(f"{args.clients} clients x {args.requests} requests, LLM latency {args.latency}s, {args.workers} workers")
+    for name, target in MODES.items():
+        r = run_mode(target, args, llm_url)
+        print(f"{name:24} {r['throughput_rps']:8.1f} req/s  p50 {r['p50_ms']:8.0f} ms  "
+              f"p95 {r['p95_ms']:8.0f} ms  ({r['requests']} in {r['elapsed_s']:.1f}s)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Time capsule push latency: delivery to an open /events connection, with
+many idle connections held at the same time.
+
+    python bench/bench_push.py --connections 2000 --workers 2 --rounds 20 --per-round 10
+
+Starts the ASGI app under gunicorn (uvicorn workers) in a scratch directory,
+opens --connections SSE connections, each its own session, and waits until
+all of them are "ready". Each round schedules an already-due message for
+--per-round random sessions and calls /run_deliveries, which lands on any
+one worker; the other workers hear about it through the notification
+sockets (notify.py). Latency is the client's receive time minus the
+message's delivered_at. Also reports events that never arrived and the
+workers' memory with the connections open.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import requests
+
+from bench_async import free_port, wait_for
+from loadtest import percentile, process_tree_rss
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Connection:
+    """One SSE client; `events` maps message id -> wall-clock receive time."""
+
+    def __init__(self):
+        self.sid = None
+        self.ready = asyncio.Event()
+        self.events = {}
+
+    async def run(self, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /events HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n")
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        for line in head.decode("latin-1").split("\r\n"):
+            if line.lower().startswith("set-cookie:"):
+                self.sid = line.split(":", 1)[1].split(";")[0].strip().split("=", 1)[1]
+        buf = b""
+        try:
+            while True:
+                # chunked transfer encoding: size line, data, CRLF
+                size = int((await reader.readline()).strip() or b"0", 16)
+                if not size:
+                    return
+                buf += await reader.readexactly(size + 2)
+                buf = buf[:-2]
+                while b"\n\n" in buf:
+                    raw, buf = buf.split(b"\n\n", 1)
+                    self.on_event(raw.decode("utf-8"))
+        finally:
+            writer.close()
+
+    def on_event(self, raw):
+        now = time.time()
+        fields = dict(line.split(": ", 1) for line in raw.splitlines() if ": " in line and not line.startswith(":"))
+        if fields.get("event") == "ready":
+            self.ready.set()
+        elif fields.get("event") == "delivered":
+            for m in (json.loads(fields["data"]) or {}).get("messages", []):
+                self.events[m["id"]] = (now, m.get("delivered_at"))
+
+
+def schedule(base, sid):
+    r = requests.post(base + "/time_messages", json={"message": "bench", "scheduled_date": "2000-01-01"},
+                      cookies={"saathi_sid": sid}, timeout=30)
+    r.raise_for_status()
+    return r.json()["id"]
+
+
+async def run(args, port, proc):
+    base = f"http://127.0.0.1:{port}"
+    conns = [Connection() for _ in range(args.connections)]
+    t0 = time.perf_counter()
+    tasks = []
+    for i, c in enumerate(conns):
+        tasks.append(asyncio.ensure_future(c.run(port)))
+        if i % 100 == 99:
+            await asyncio.sleep(0.05)  # don't overflow the listen backlog
+    await asyncio.wait_for(asyncio.gather(*(c.ready.wait() for c in conns)), 120)
+    print(f"{args.connections} connections ready in {time.perf_counter() - t0:.1f}s, "
+          f"server RSS {process_tree_rss(proc.pid) / 1e6:.0f} MB")
+
+    rng = random.Random(args.seed)
+    latencies, expected = [], {}
+    for _ in range(args.rounds):
+        picked = rng.sample(conns, args.per_round)
+        for c in picked:
+            expected[await asyncio.to_thread(schedule, base, c.sid)] = c
+        r = await asyncio.to_thread(requests.post, base + "/run_deliveries", timeout=30)
+        r.raise_for_status()
+        await asyncio.sleep(args.wait)
+    missing = 0
+    for msg_id, c in expected.items():
+        got = c.events.get(msg_id)
+        if got is None or not got[1]:
+            missing += 1
+            continue
+        received, delivered_at = got
+        latencies.append(received - datetime.fromisoformat(delivered_at).timestamp())
+    for t in tasks:
+        t.cancel()
+    return latencies, missing, len(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--connections", type=int, default=1000, help="idle SSE connections, one session each")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--per-round", type=int, default=10, help="sessions with a delivery per round")
+    parser.add_argument("--wait", type=float, default=0.2, help="seconds between rounds")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="saathi-push-")
+    env = dict(os.environ, PYTHONPATH=REPO, PERPLEXITY_API_KEY="bench", PERPLEXITY_API_URL="http://127.0.0.1:9/")
+    cmd = [sys.executable, "-m", "gunicorn", "asgi:app", "-k", "uvicorn.workers.UvicornWorker",
+           "-c", os.path.join(REPO, "gunicorn.conf.py"), "-w", str(args.workers),
+           "-b", f"127.0.0.1:{port}", "--backlog", "4096", "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    try:
+        wait_for(f"http://127.0.0.1:{port}/metrics")
+        latencies, missing, total = asyncio.run(run(args, port, proc))
+    finally:
+        proc.terminate()
+        proc.wait(10)
+    latencies.sort()
+    print(f"{total} deliveries over {args.rounds} rounds, {args.workers} workers: "
+          f"{total - missing} pushed, {missing} missing")
+    if latencies:
+        print(f"delivery -> client  p50 {percentile(latencies, 50) * 1000:.2f} ms  "
+              f"p95 {percentile(latencies, 95) * 1000:.2f} ms  max {latencies[-1] * 1000:.2f} ms")
+    print(f"scratch data in {workdir}")
+
+
+if __name__ == "__main__":
+    main()
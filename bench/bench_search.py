@@ -0,0 +1,139 @@
+"""
+Search index cost as a session's history grows: building it, keeping it up
+to date, and query latency.
+
+    python bench/bench_search.py --messages 1000000 --queries 200
+
+Writes --messages generated messages (the datagen corpus plus words drawn
+from a Zipf-distributed vocabulary, so terms range from very common to
+rare) to one history log in a scratch directory, then reports the first,
+catch-up build of the index, its size next to the log's, query latency
+percentiles per query kind (common and rare words, phrases, prefixes,
+filters, recency order; "5000+" matches means the query stopped at its
+match budget), and the cost of indexing newly appended turns.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from datagen import ASSISTANT_MESSAGES, USER_MESSAGES  # noqa: E402
+from history_log import HistoryLog  # noqa: E402
+from loadtest import percentile  # noqa: E402
+from search_index import SearchIndex  # noqa: E402
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "tu", "ne", "so", "vi", "de", "pa", "shi", "ro", "an", "el", "ur"]
+
+
+def vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def messages(rng, n, vocab, end):
+    # Zipf-ish: word k drawn with weight 1/(k+1)
+    weights = [1 / (k + 1) for k in range(len(vocab))]
+    extra = rng.choices(vocab, weights, k=n * 3)
+    for i in range(n):
+        role = "user" if i % 2 == 0 else "assistant"
+        base = rng.choice(USER_MESSAGES if role == "user" else ASSISTANT_MESSAGES)
+        ts = (end - timedelta(minutes=5 * (n - 1 - i))).isoformat(timespec="seconds")
+        yield {"role": role, "content": f"{base} {' '.join(extra[i * 3:i * 3 + 3])}", "ts": ts}
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def timed_queries(index, queries, runs):
+    out = {}
+    for label, (q, kwargs) in queries.items():
+        times, total = [], ""
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            found = index.search(q, **kwargs)
+            total = f"{found['total']}{'' if found['total_exact'] else '+'}"
+            times.append(time.perf_counter() - t0)
+        times.sort()
+        out[label] = (percentile(times, 50), percentile(times, 95), total)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--vocab", type=int, default=20000, help="generated vocabulary size")
+    parser.add_argument("--queries", type=int, default=50, help="runs per query kind")
+    parser.add_argument("--appends", type=int, default=500, help="turns appended after the build")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="saathi-search-")
+    vocab = vocabulary(rng, args.vocab)
+    end = datetime.now(timezone.utc)
+    history = HistoryLog(os.path.join(workdir, "history"))
+    t0 = time.perf_counter()
+    batch = []
+    for msg in messages(rng, args.messages, vocab, end):
+        batch.append(msg)
+        if len(batch) >= 10000:
+            history.append_many(batch)
+            batch = []
+    if batch:
+        history.append_many(batch)
+    print(f"history      {args.messages} messages, {directory_size(history.directory) / 1e6:.1f} MB "
+          f"(written in {time.perf_counter() - t0:.1f}s)")
+
+    index = SearchIndex(os.path.join(workdir, "search"), history)
+    history.on_write = index.note_write
+    t0 = time.perf_counter()
+    index.search("warmup")
+    build = time.perf_counter() - t0
+    print(f"index build  {build:.1f}s ({args.messages / build:,.0f} messages/s), "
+          f"{directory_size(index.directory) / 1e6:.1f} MB, {index.stats()['segments']} segments")
+
+    # a fresh index object over the same files, as in another worker
+    cold = SearchIndex(os.path.join(workdir, "search"), history)
+    t0 = time.perf_counter()
+    cold.search("sleep")
+    print(f"first query in a new worker (segments opened) {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    week_ago = (end - timedelta(days=7)).date().isoformat()
+    queries = {
+        "common word": ("exams", {}),
+        "rare word": (vocab[-1], {}),
+        "two words": (f"sleep {vocab[len(vocab) // 2]}", {}),
+        "phrase": ('"breaking revision"', {}),
+        "prefix": (vocab[len(vocab) // 3][:4] + "*", {}),
+        "role filter": ("sleep", {"role": "assistant"}),
+        "last week": ("sleep", {"date_from": week_ago}),
+        "recent order": ("sleep", {"sort": "recent"}),
+    }
+    print(f"\n{'query':14}{'p50':>10}{'p95':>10}{'matches':>10}")
+    for label, (p50, p95, total) in timed_queries(cold, queries, args.queries).items():
+        print(f"{label:14}{p50 * 1000:8.2f}ms{p95 * 1000:8.2f}ms{total:>10}")
+
+    times = []
+    for i in range(args.appends):
+        t0 = time.perf_counter()
+        history.append_many([{"role": "user", "content": f"new message {i} about sleep"},
+                             {"role": "assistant", "content": "Sleep matters."}])
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    s = index.stats()
+    print(f"\nappend + index p50 {percentile(times, 50) * 1000:.2f} ms  p95 {percentile(times, 95) * 1000:.2f} ms  "
+          f"max {times[-1] * 1000:.1f} ms ({s['segments_written']} segments written, {s['merges']} merges)")
+    print(f"scratch data in {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Start-up cost: importing the app, and gunicorn from launch to first reply
+with and without the preload + warmup of gunicorn.conf.py.
+
+    python bench/bench_startup.py --runs 7 --workers 4 --sessions 2000 --history 200000
+
+Reports the median `import app` time over --runs fresh interpreters and the
+modules that dominate it (-X importtime), then for GUNICORN_PRELOAD=1 and 0:
+time to the first page, first /chat and /planner replies (intent model and
+templates built on demand, or already by warmup), and the workers' RSS and
+PSS (/proc/<pid>/smaps_rollup; PSS counts shared pages once across the
+workers). --history N times the one-off import of an N-message legacy
+chat_history.json and its peak memory. Everything runs in scratch directories.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from bench_async import free_port
+from datagen import generate
+from loadtest import process_tree_rss
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = ("import time; t = time.perf_counter(); import app; "
+                  "print(time.perf_counter() - t)")
+LEGACY_SNIPPET = ("import resource, time; t = time.perf_counter(); import app; "
+                  "print(time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+
+
+def app_env(data_dir, **extra):
+    return dict(os.environ, PYTHONPATH=REPO, DATA_DIR=data_dir, PERPLEXITY_API_KEY="bench",
+                PERPLEXITY_API_URL="http://127.0.0.1:9/", **extra)
+
+
+def import_times(runs, data_dir):
+    env = app_env(data_dir)
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=os.path.dirname(data_dir),
+                             env=env, capture_output=True, text=True, check=True).stdout
+        times.append(float(out.split()[-1]))
+    return times
+
+
+def import_profile(data_dir, top):
+    """[(cumulative us, module)] of the slowest top-level imports."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=os.path.dirname(data_dir), env=app_env(data_dir), capture_output=True, text=True)
+    rows, children = [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # children are listed before their parent, one more level indented
+        depth = len(name) - len(name.lstrip())
+        if depth == 3:
+            children.append((int(cumulative), name.strip()))
+        elif depth == 1:
+            if name.strip() == "app":
+                rows = children
+            children = []
+    return sorted(rows, reverse=True)[:top]
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def smaps_rollup(pid):
+    """{"Rss": bytes, "Pss": bytes, ...} from /proc (Linux only)."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    values[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        pass
+    return values
+
+
+def first_ok(url, deadline, method="GET", **kwargs):
+    while time.perf_counter() < deadline:
+        try:
+            r = requests.request(method, url, timeout=30, **kwargs)
+            if r.status_code < 500:
+                return r
+        except requests.RequestException:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError(f"{url} did not answer")
+
+
+def cold_start(preload, args, data_dir):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = app_env(data_dir, GUNICORN_PRELOAD="1" if preload else "0", STORAGE_BACKEND=args.backend)
+    cmd = [sys.executable, "-m", "gunicorn", "app:app", "-c", os.path.join(REPO, "gunicorn.conf.py"),
+           "-w", str(args.workers), "-b", f"127.0.0.1:{port}", "--log-level", "warning",
+           # a gthread worker that has served a keep-alive connection can sit out
+           # the whole graceful timeout (30 s) on shutdown; nothing here is in flight then
+           "--graceful-timeout", "2"]
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(data_dir), env=env)
+    try:
+        first_ok(base + "/metrics", t0 + 60)
+        ready = time.perf_counter() - t0
+        # one request per worker at most, so most of them hit a worker that hasn't served yet
+        timings = {}
+        for name, path, kwargs in (("first /chat", "/chat", {"method": "POST", "json": {"message": "hello"}}),
+                                   ("first /planner", "/planner", {}), ("first /", "/", {})):
+            t = time.perf_counter()
+            first_ok(base + path, t + 30, **kwargs)
+            timings[name] = time.perf_counter() - t
+        time.sleep(0.5)
+        workers = children(proc.pid)
+        mem = [smaps_rollup(p) for p in workers]
+        return {
+            "ready": ready,
+            **timings,
+            "workers": len(workers),
+            "worker_rss": sum(m.get("Rss", 0) for m in mem),
+            "worker_pss": sum(m.get("Pss", 0) for m in mem),
+            "tree_rss": process_tree_rss(proc.pid),
+        }
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def legacy_import(n, workdir):
+    path = os.path.join(workdir, "chat_history.json")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i in range(n):
+            role = "user" if i % 2 == 0 else "assistant"
+            f.write(("," if i else "") + json.dumps({"role": role, "content": f"message {i} " + "x" * 80}))
+        f.write("]")
+    size = os.path.getsize(path)
+    out = subprocess.run([sys.executable, "-c", LEGACY_SNIPPET], cwd=workdir,
+                         env=app_env(os.path.join(workdir, "data")), capture_output=True, text=True, check=True)
+    seconds, maxrss_kb = out.stdout.split()[-2:]
+    return size, float(seconds), int(maxrss_kb) * 1024
+
+
+def mb(n):
+    return f"{n / 1e6:7.1f} MB" if n else "    n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=7, help="fresh interpreters for the import timing")
+    parser.add_argument("--top", type=int, default=8, help="slowest imports to list")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=500, help="generated sessions in the data dir")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--history", type=int, default=0, help="also time importing a legacy history of N messages")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="saathi-startup-")
+    data_dir = os.path.join(workdir, "data")
+    generate(data_dir, sessions=args.sessions, turns=20, planner=20, capsules=5)
+    # the first start migrates/creates files; time the starts after it
+    subprocess.run([sys.executable, "-c", "import app"], cwd=workdir, check=True,
+                   env=app_env(data_dir, STORAGE_BACKEND=args.backend))
+
+    times = import_times(args.runs, data_dir)
+    print(f"import app     median {statistics.median(times) * 1000:6.1f} ms  "
+          f"(min {min(times) * 1000:.1f}, max {max(times) * 1000:.1f}, {args.runs} runs)")
+    for cumulative, name in import_profile(data_dir, args.top):
+        print(f"  {cumulative / 1000:7.1f} ms  {name}")
+
+    print(f"\ngunicorn, {args.workers} workers, {args.sessions} sessions, {args.backend} backend")
+    results = {"preload": cold_start(True, args, data_dir), "no preload": cold_start(False, args, data_dir)}
+    keys = ["ready", "first /chat", "first /planner", "first /"]
+    print(f"{'':12}" + "".join(f"{k:>16}" for k in keys) + f"{'worker RSS':>14}{'worker PSS':>14}{'total RSS':>14}")
+    for label, r in results.items():
+        print(f"{label:12}" + "".join(f"{r[k] * 1000:13.1f} ms" for k in keys)
+              + f"{mb(r['worker_rss']):>14}{mb(r['worker_pss']):>14}{mb(r['tree_rss']):>14}")
+
+    if args.history:
+        size, seconds, maxrss = legacy_import(args.history, tempfile.mkdtemp(prefix="saathi-legacy-"))
+        print(f"\nlegacy history import: {args.history} messages ({size / 1e6:.1f} MB) in {seconds:.2f}s, "
+              f"peak RSS {maxrss / 1e6:.1f} MB")
+    print(f"scratch data in {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Per-request latency of the planner / time capsule routes, JSON vs SQLite backend.
+
+    python bench/bench_storage.py --sizes 10 100 1000 10000 100000 --reps 20
+
+For each size one session is seeded with that many planner items and time
+capsule messages, then each route is timed through the Flask test client.
+Every (backend, size) pair gets its own scratch data directory. A second
+table gives the peak Python memory (tracemalloc) of streaming the CSV
+export to the client and of importing it back.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+os.chdir(tempfile.mkdtemp(prefix="saathi-bench-"))  # keep the legacy migration away from repo files
+
+import app as saathi  # noqa: E402
+import sessions  # noqa: E402
+import stores  # noqa: E402
+from scheduler import DeliveryScheduler  # noqa: E402
+from storage import atomic_write_json  # noqa: E402
+
+
+def seed(user, n):
+    planner = [{"id": str(uuid.uuid4()), "title": f"task {i}", "date": "2025-01-01", "time": "09:00",
+                "notes": "", "completed": False} for i in range(n)]
+    capsule = [{"id": str(uuid.uuid4()), "message": f"note {i}", "scheduled_date": "2999-01-01",
+                "created_at": "2025-01-01T00:00:00+00:00", "delivered": False, "delivered_at": None}
+               for i in range(n)]
+    if isinstance(user.planner, stores.SQLiteStore):
+        for store, items in ((user.planner, planner), (user.time_messages, capsule)):
+            with store.db.transaction() as conn:
+                conn.executemany(store._insert_sql(), [[user.sid] + store._row(it) for it in items])
+    else:
+        atomic_write_json(user.planner_path, planner)
+        atomic_write_json(user.time_messages_path, capsule)
+    return planner, capsule
+
+
+def timed(fn, reps):
+    samples = []
+    for i in range(reps):
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def peak_mb(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def drain(response):
+    for _ in response.response:
+        pass
+    response.close()
+
+
+def run(backend, n, reps):
+    sessions.STORAGE_BACKEND = backend
+    sessions.DATA_DIR = tempfile.mkdtemp(prefix=f"saathi-{backend}-")
+    sessions.SQLITE_PATH = os.path.join(sessions.DATA_DIR, "saathi.db")
+    saathi.session_cache = sessions.SessionCache()
+    saathi.delivery_scheduler = DeliveryScheduler(
+        saathi.deliver_session_messages, sessions.pending_time_messages,
+        os.path.join(sessions.DATA_DIR, "schedule.jsonl"))
+    sid = sessions.new_session_id()
+    user = saathi.session_cache.get(sid)
+    planner, capsule = seed(user, n)
+    client = saathi.app.test_client()
+    client.set_cookie(sessions.SESSION_COOKIE, sid)
+    pid = planner[n // 2]["id"]
+    mid = capsule[n // 2]["id"]
+    client.get("/planner_items")  # warm the caches, as a live worker would be
+    client.post("/run_deliveries")  # builds the scheduler's heap once
+    etag = client.get("/planner_items?sort=date&limit=50").headers["ETag"]
+
+    batch_ids = [it["id"] for it in planner[:20]]
+
+    def single_patches(i):
+        for item_id in batch_ids:
+            client.patch(f"/planner_items/{item_id}", json={"completed": i % 2 == 0})
+
+    def batch_patch(i):
+        client.post("/planner_items/batch",
+                    json={"ops": [{"op": "complete", "id": item_id, "completed": i % 2 == 0} for item_id in batch_ids]})
+
+    def replace_item(i):
+        item = client.post("/planner_items", json={"title": f"new {i}"}).get_json()
+        client.delete(f"/planner_items/{item['id']}")
+
+    return {
+        "GET planner": timed(lambda i: client.get("/planner_items"), reps),
+        "GET planner page": timed(lambda i: client.get("/planner_items?sort=date&limit=50"), reps),
+        "GET page (304)": timed(lambda i: client.get("/planner_items?sort=date&limit=50",
+                                                     headers={"If-None-Match": etag}), reps),
+        "PATCH planner": timed(lambda i: client.patch(f"/planner_items/{pid}", json={"completed": i % 2 == 0}), reps),
+        "POST+DELETE planner": timed(replace_item, reps) / 2,
+        "PATCH capsule": timed(lambda i: client.patch(f"/time_messages/{mid}", json={"message": f"m{i}"}), reps),
+        "deliveries (idle)": timed(lambda i: client.post("/run_deliveries"), reps),
+        "20 PATCHes": timed(single_patches, max(1, reps // 5)),
+        "batch of 20": timed(batch_patch, reps),
+        "export text": timed(lambda i: drain(client.get("/download_planner_text", buffered=False)), max(1, reps // 5)),
+        "export csv": timed(lambda i: drain(client.get("/download_planner_csv", buffered=False)), max(1, reps // 5)),
+    }
+
+
+def memory(backend, n):
+    """Peak MB of streaming the CSV export, and of importing it into an empty session."""
+    run(backend, n, 1)  # seeds a fresh data dir
+    sid = sessions.new_session_id()
+    user = saathi.session_cache.get(sid)
+    seed(user, n)
+    client = saathi.app.test_client()
+    client.set_cookie(sessions.SESSION_COOKIE, sid)
+    csv_body = client.get("/download_planner_csv").get_data()
+    export = peak_mb(lambda: drain(client.get("/download_planner_csv", buffered=False)))
+    other = saathi.app.test_client()
+    upload = peak_mb(lambda: other.post("/planner_items/import", data=csv_body, content_type="text/csv"))
+    # the upload itself is in memory here (test client); a real client streams it
+    return export, upload - len(csv_body) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--reps", type=int, default=20)
+    parser.add_argument("--backends", nargs="+", default=["json", "sqlite"])
+    args = parser.parse_args()
+    results = {}
+    for backend in args.backends:
+        for n in args.sizes:
+            results[backend, n] = run(backend, n, args.reps)
+            print(f"done: {backend} n={n}", file=sys.stderr)
+
+    ops = list(next(iter(results.values())))
+    print(f"median latency per request (ms), {args.reps} reps")
+    print(f"{'operation':<22}{'items':>8}" + "".join(f"{b:>12}" for b in args.backends))
+    for op in ops:
+        for n in args.sizes:
+            print(f"{op:<22}{n:>8}" + "".join(f"{results[b, n][op]:>12.2f}" for b in args.backends))
+
+    print("\npeak Python memory (MB): streaming the CSV export / importing it")
+    print(f"{'items':>8}" + "".join(f"{b + ' export':>16}{b + ' import':>16}" for b in args.backends))
+    for n in args.sizes:
+        row = [memory(b, n) for b in args.backends]
+        print(f"{n:>8}" + "".join(f"{e:>16.2f}{i:>16.2f}" for e, i in row))
+
+
+if __name__ == "__main__":
+    main()
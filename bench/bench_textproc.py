@@ -0,0 +1,251 @@
+"""
+Golden-output check and microbenchmark for textproc.py.
+
+    python bench/bench_textproc.py --fuzz 20000 --number 2000
+
+The legacy implementations below are verbatim copies of the app.py
+functions textproc replaced. Every input of a fixed corpus plus `--fuzz`
+random ones must produce identical output from both; the script exits
+non-zero on the first mismatch, then prints per-call timings.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import textproc  # noqa: E402
+
+INVALID_NAMES = textproc.INVALID_NAMES
+
+
+# --- legacy implementations (app.py before textproc.py) ---
+def legacy_format_reply(ai_text, max_sentences: int = 7, followup: str = None, end_conversation: bool = False):
+    """
+    Clean AI text, limit to `max_sentences`, convert simple markdown (bold)
+    and list lines to safe HTML paragraphs / lists.
+    If end_conversation is True, do not append any follow-up question.
+    """
+    import re
+
+    if not ai_text:
+        return "<p>Sorry, I couldn't generate a reply right now.</p>"
+
+    # remove citation-style markers and convert simple markdown
+    text = re.sub(r'(?:\s*\[\d+\])+', '', ai_text)
+    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
+    text = text.replace('*', '')
+
+    # split into sentences (keeps punctuation)
+    sentences = re.split(r'(?<=[\.!\?…])\s+', text.strip())
+    # filter out empty
+    sentences = [s.strip() for s in sentences if s.strip()]
+
+    truncated = sentences[:max_sentences]
+    truncated_text = " ".join(truncated).strip()
+
+    # Ensure we end cleanly with punctuation
+    if truncated_text and truncated_text[-1] not in ".!?…":
+        truncated_text = truncated_text + "."
+
+    # if original had more sentences, append an ellipsis to show continuation
+    if len(sentences) > max_sentences:
+        truncated_text = truncated_text.rstrip() + " …"
+
+    # ensure there is a follow-up question unless this is an end-of-conversation reply
+    has_question = bool(re.search(r'\?\s*$', truncated_text))
+    if not has_question and not end_conversation:
+        if followup:
+            truncated_text = truncated_text + " " + followup
+        else:
+            truncated_text = truncated_text + " Would you like to tell me more?"
+
+    # Convert simple lists / paragraphs into HTML
+    lines = truncated_text.splitlines()
+    out = []
+    in_list = False
+    for line in lines:
+        line = line.strip()
+        if re.match(r'^(-|\d+\.)\s+', line):
+            if not in_list:
+                in_list = True
+                out.append("<ul>")
+            item = re.sub(r'^(-|\d+\.)\s+', '', line)
+            out.append(f'<li>{item}</li>')
+        else:
+            if in_list:
+                out.append("</ul>")
+                in_list = False
+            if line:
+                out.append(f"<p>{line}</p>")
+    if in_list:
+        out.append("</ul>")
+
+    html = "\n".join(out) if out else f"<p>{truncated_text}</p>"
+    return html
+
+def legacy_store_name(user_input: str):
+    """
+    Extracts and cleans a likely user name from input text.
+    Handles formats like 'my name is X', 'I am X', "I'm X", or single-word names.
+    Rejects values in INVALID_NAMES and common filler words.
+    """
+    if not user_input:
+        return None
+
+    text = user_input.strip()
+
+    # common patterns: "my name is X", "call me X", "I'm X", "I am X"
+    patterns = [
+        r"\bmy\s+name\s+is\s+([A-Za-z][A-ZaZ'\-]*)\b",
+        r"\bcall\s+me\s+([A-Za-z][A-ZaZ'\-]*)\b",
+        r"\bi\s*(?:'m|am)\s+([A-Za-z][A-Za-z'\-]*)\b"
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, text, flags=re.IGNORECASE)
+        if match:
+            candidate = re.sub(r"[^A-Za-z'\-]", "", match.group(1)).strip().capitalize()
+            if candidate and candidate.lower() not in INVALID_NAMES:
+                return candidate
+
+    # single-word input -> treat as name only if alphabetic, reasonable length,
+    # not in INVALID_NAMES, and likely a real name (simple vowel check)
+    tokens = text.split()
+    if len(tokens) == 1:
+        token = re.sub(r"[^A-Za-z'\-]", "", tokens[0]).strip()
+        if token and token.isalpha() and 2 <= len(token) <= 30 and token.lower() not in INVALID_NAMES:
+            # require at least one vowel OR allow very short names (<=3) to accommodate e.g. "Li"
+            if re.search(r"[aeiou]", token, flags=re.I) or len(token) <= 3:
+                return token.capitalize()
+
+    return None
+
+def legacy_choose_followup(user_input: str):
+    """
+    Return a short student-focused follow-up question based on user_input.
+    Keep it concise and actionable.
+    """
+    if not user_input:
+        return "Would you like to tell me more or try a short grounding exercise?"
+
+    u = user_input.lower()
+
+    exams = ["exam", "exams", "test", "tests", "grade", "grades", "marks", "result", "results"]
+    stress = ["stress", "stressed", "stressing", "overwhelmed", "pressure", "deadline"]
+    anxious = ["anxious", "anxiety", "worried", "worried about"]
+    happy = ["happy", "excited", "great", "celebrate", "good marks", "good grade", "got"]
+    sleep = ["sleep", "tired", "rest", "insomnia"]
+    social = ["friend", "friends", "relationship", "peer", "classmate", "roommate"]
+
+    if any(k in u for k in exams):
+        return "Congrats — would you like tips to keep the momentum or plan next study steps?"
+    if any(k in u for k in happy):
+        return "That’s wonderful — want ideas to celebrate or channels to share this with friends?"
+    if any(k in u for k in anxious) or any(k in u for k in stress):
+        return "Would you like a short breathing exercise now or a few quick strategies to manage this stress?"
+    if any(k in u for k in sleep):
+        return "Would you like some quick sleep tips you can try tonight?"
+    if any(k in u for k in social):
+        return "Do you want help thinking through how to talk to them or what to say?"
+    # default
+    return "Would you like to tell me more, or try a short grounding exercise?"
+
+# --- inputs ---
+CORPUS = [
+    "",
+    "Hello there.",
+    "It sounds like exams are stressing you out [1][2]. That is completely normal! Try this:\n- Take a **short break**\n- Drink water\n1. Breathe in\n2. Breathe out",
+    "**Bold start** and *stray stars* and ***triple*** and ** spaced ** text",
+    "One. Two! Three? Four… Five. Six. Seven. Eight. Nine.",
+    "No punctuation at the end",
+    "Question at the end?   ",
+    "Citations [3] everywhere [12] and [x] not numbers [ 4].",
+    "Line one\nLine two.\n\n- item after blank\nplain after list",
+    "Unclosed **bold across\nlines** here.",
+    "   \n  ",
+    "[1]",
+    "* * *",
+    "3. numbered first\n- dash second\n",
+    "Trailing newline question?\n",
+]
+NAMES = [
+    "", "my name is Anya", "MY NAME IS o'brien", "call me Ravi-kumar", "I'm happy", "i am sam",
+    "Priya", "xyz", "Li", "okay", "I'mstressed", "hey i am... Neha", "I am 21", "Zoë", "bcd",
+    "my name is no", "call me maybe",
+]
+FOLLOWUPS = [
+    "", "I have an exam tomorrow", "feeling great", "so worried about results", "can't sleep",
+    "my roommate is annoying", "just chatting", "GOOD GRADE!!", "deadline pressure", "I got it",
+    "restless", "friendship", "tested", "insomniac and anxious",
+]
+PIECES = ["Hello", "there", ".", "!", "?", "…", " ", "  ", "\n", "\n\n", "*", "**", "[1]", " [2]", "[", "]",
+          "- ", "1. ", "12. ", "word", "exam", "sleep", "\t", "x", "Great job", "?\n", ". ", "**bold**"]
+
+
+def random_text(rng):
+    return "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+
+
+def check(fuzz, seed):
+    rng = random.Random(seed)
+    texts = CORPUS + [random_text(rng) for _ in range(fuzz)]
+    checked = 0
+    for text in texts:
+        for kwargs in ({}, {"max_sentences": 2}, {"max_sentences": 0}, {"followup": "Want a tip?"},
+                       {"end_conversation": True}):
+            want, got = legacy_format_reply(text, **kwargs), textproc.format_reply(text, **kwargs)
+            if want != got:
+                sys.exit(f"format_reply mismatch for {text!r} {kwargs}:\n  legacy: {want!r}\n  new:    {got!r}")
+            checked += 1
+        want = textproc.BOLD_RE.sub(r'<strong>\1</strong>', text).replace('*', '')
+        got = textproc.MARKUP_RE.sub(textproc._markup, text)
+        if want != got:
+            sys.exit(f"markup mismatch for {text!r}:\n  legacy: {want!r}\n  new:    {got!r}")
+    words = [w for w in re.split(r"\s+", " ".join(NAMES + FOLLOWUPS)) if w]
+    names = NAMES + [" ".join(rng.choice(words + ["my", "name", "is", "I'm", "call", "me"])
+                              for _ in range(rng.randint(1, 5))) for _ in range(fuzz // 4)]
+    for text in names:
+        if legacy_store_name(text) != textproc.store_name(text):
+            sys.exit(f"store_name mismatch for {text!r}")
+        if legacy_choose_followup(text) != textproc.choose_followup(text):
+            sys.exit(f"choose_followup mismatch for {text!r}")
+        checked += 2
+    for text in FOLLOWUPS:
+        if legacy_choose_followup(text) != textproc.choose_followup(text):
+            sys.exit(f"choose_followup mismatch for {text!r}")
+    return checked
+
+
+def bench(number):
+    reply = ("Exams can feel heavy [1]. It is okay to **pause** and breathe. " * 6
+             + "\n- Take a walk\n- Sleep early\n1. Plan tomorrow\nWhat would help most right now?")
+    message = "I am really stressed about my exams and I can't sleep before the deadline"
+    cases = [
+        ("format_reply (short)", legacy_format_reply, textproc.format_reply, CORPUS[2]),
+        ("format_reply (long)", legacy_format_reply, textproc.format_reply, reply),
+        ("store_name", legacy_store_name, textproc.store_name, message),
+        ("choose_followup", legacy_choose_followup, textproc.choose_followup, message),
+    ]
+    print(f"{'function':<24}{'legacy us':>12}{'new us':>12}{'speedup':>10}")
+    for name, old, new, arg in cases:
+        t_old = min(timeit.repeat(lambda: old(arg), number=number, repeat=5)) / number * 1e6
+        t_new = min(timeit.repeat(lambda: new(arg), number=number, repeat=5)) / number * 1e6
+        print(f"{name:<24}{t_old:>12.2f}{t_new:>12.2f}{t_old / t_new:>9.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fuzz", type=int, default=20000, help="random inputs on top of the fixed corpus")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--number", type=int, default=2000, help="calls per timing run")
+    args = parser.parse_args()
+    print(f"golden output: {check(args.fuzz, args.seed)} cases identical")
+    bench(args.number)
+
+
+if __name__ == "__main__":
+    main()
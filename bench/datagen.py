@@ -0,0 +1,144 @@
+"""
+Synthetic session data for benchmarks: long chat histories, big planners and
+time capsule sets, written in the app's on-disk layout.
+
+    python bench/datagen.py /tmp/saathi-data --sessions 20 --turns 2000 --planner 500 --capsules 200
+
+Point the app at it with DATA_DIR=/tmp/saathi-data (STORAGE_BACKEND=sqlite
+imports the JSON files on start, as for any existing install). The session
+ids are printed, one per line, for use as saathi_sid cookies. The same
+--seed always produces the same data.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from history_log import HistoryLog  # noqa: E402
+from storage import atomic_write_json  # noqa: E402
+
+USER_MESSAGES = [
+    "I am stressed about my exams next week",
+    "I can't sleep before tests",
+    "my friends have been ignoring me lately",
+    "I got good marks in maths today!",
+    "I feel overwhelmed with all the assignments",
+    "how do I stop procrastinating",
+    "my roommate keeps me up at night",
+    "I'm worried about my results",
+    "I don't know what to do after school",
+    "I had a nice day with my classmates",
+    "the deadline for my project is tomorrow and I haven't started",
+    "I feel tired all the time",
+]
+ASSISTANT_MESSAGES = [
+    "That sounds really stressful. Breaking revision into short blocks can make it feel more manageable. "
+    "Which subject worries you most?",
+    "Sleep can be hard when your mind is racing. Try putting your phone away an hour before bed. "
+    "Would you like some quick sleep tips?",
+    "It hurts when friends pull away. It might help to ask one of them how they have been. "
+    "Do you want help thinking through what to say?",
+    "Congratulations, that is a great result! Take a moment to enjoy it. What helped you prepare?",
+    "When everything piles up, start with the smallest task. Would you like to plan the next hour together?",
+]
+PLANNER_TITLES = ["Revise chapter", "Finish assignment", "Call a friend", "Go for a walk", "Practice problems",
+                  "Read notes", "Group study", "Submit lab report", "Meditate", "Plan the week"]
+CAPSULE_MESSAGES = ["You made it through exam week!", "Remember how far you have come.",
+                    "Check in with yourself today.", "Future me: drink some water.", "Proud of you."]
+
+
+def user_dir(data_dir, sid):
+    # same layout as sessions.user_dir
+    return os.path.join(data_dir, "users", sid[:2], sid)
+
+
+def history_messages(rng, turns, end=None):
+    """`turns` user/assistant pairs, ten minutes apart, the last one at `end`."""
+    end = end or datetime.now(timezone.utc)
+    for i in range(turns):
+        ts = (end - timedelta(minutes=10 * (turns - 1 - i))).isoformat(timespec="seconds")
+        yield {"role": "user", "content": rng.choice(USER_MESSAGES), "ts": ts}
+        yield {"role": "assistant", "content": rng.choice(ASSISTANT_MESSAGES), "ts": ts}
+
+
+def planner_items(rng, n, today):
+    items = []
+    for i in range(n):
+        day = today + timedelta(days=rng.randint(-60, 60))
+        items.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "title": f"{rng.choice(PLANNER_TITLES)} {i}",
+            "date": day.date().isoformat() if rng.random() < 0.8 else "",
+            "time": f"{rng.randint(7, 21):02d}:{rng.choice(['00', '30'])}" if rng.random() < 0.5 else "",
+            "notes": "generated" if rng.random() < 0.3 else "",
+            "completed": rng.random() < 0.4,
+        })
+    return items
+
+
+def time_capsules(rng, n, today, due_fraction):
+    items = []
+    for _ in range(n):
+        due = rng.random() < due_fraction
+        offset = -rng.randint(1, 30) if due else rng.randint(1, 365)
+        items.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "message": rng.choice(CAPSULE_MESSAGES),
+            "scheduled_date": (today + timedelta(days=offset)).date().isoformat(),
+            "created_at": (today - timedelta(days=rng.randint(31, 90))).isoformat(),
+            "delivered": False,
+            "delivered_at": None,
+        })
+    return items
+
+
+def generate(data_dir, sessions: int = 10, turns: int = 200, planner: int = 100, capsules: int = 20,
+             due_fraction: float = 0.1, seed: int = 1):
+    """Write `sessions` users under `data_dir`; returns their session ids."""
+    rng = random.Random(seed)
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    sids = []
+    for _ in range(sessions):
+        sid = uuid.UUID(int=rng.getrandbits(128)).hex
+        directory = user_dir(data_dir, sid)
+        os.makedirs(directory, exist_ok=True)
+        log = HistoryLog(os.path.join(directory, "history"))
+        batch = []
+        for msg in history_messages(rng, turns):
+            batch.append(msg)
+            if len(batch) >= 500:
+                log.append_many(batch)
+                batch = []
+        if batch:
+            log.append_many(batch)
+        atomic_write_json(os.path.join(directory, "user.json"), {"name": "Bench"})
+        atomic_write_json(os.path.join(directory, "planner.json"), planner_items(rng, planner, today))
+        atomic_write_json(os.path.join(directory, "time_messages.json"),
+                          time_capsules(rng, capsules, today, due_fraction))
+        sids.append(sid)
+    return sids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("data_dir")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=200, help="chat turns (user + reply) per session")
+    parser.add_argument("--planner", type=int, default=100, help="planner items per session")
+    parser.add_argument("--capsules", type=int, default=20, help="time capsule messages per session")
+    parser.add_argument("--due", type=float, default=0.1, help="fraction of capsules already due")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the session ids as a JSON list")
+    args = parser.parse_args()
+    sids = generate(args.data_dir, args.sessions, args.turns, args.planner, args.capsules, args.due, args.seed)
+    print(json.dumps(sids) if args.json else "\n".join(sids))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Local stand-in for the Perplexity chat-completions API, for benchmarks.
+
+    python bench/fake_llm.py --port 8099 --latency 0.5 --jitter 0.1 --chunk-delay 0.02
+
+Point the app at it with PERPLEXITY_API_URL=http://127.0.0.1:8099/ and any
+PERPLEXITY_API_KEY. Requests with "stream": true get the reply as SSE chunks
+(`chunk_delay` seconds apart) after `latency` seconds; the others get the
+whole completion after `latency` seconds. `jitter` adds up to that many
+seconds at random, and `error_rate` is the fraction answered with a 503.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = (
+    "It sounds like exams are weighing on you right now. That is a very common feeling "
+    "for students[1]. Try breaking your revision into **short, focused blocks** with "
+    "breaks in between[2]. A few slow breaths before each block can help you settle. "
+    "What subject feels the most stressful at the moment?"
+)
+
+
+def chunks(text, words: int = 4):
+    """The reply split into deltas of a few words, like a streamed completion."""
+    parts = text.split(" ")
+    return [" ".join(parts[i:i + words]) + (" " if i + words < len(parts) else "")
+            for i in range(0, len(parts), words)]
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.streams = 0
+        self.errors = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "streams": self.streams, "errors": self.errors}
+
+
+def make_handler(latency, jitter=0.0, chunk_delay=0.02, error_rate=0.0, counters=None):
+    counters = counters or Counters()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                payload = {}
+            stream = bool(payload.get("stream"))
+            counters.add(requests=1, streams=int(stream))
+            time.sleep(latency + (random.uniform(0, jitter) if jitter else 0))
+            if error_rate and random.random() < error_rate:
+                counters.add(errors=1)
+                return self._send(503, {"error": "fake overload"})
+            if stream:
+                return self._stream()
+            self._send(200, {"choices": [{"message": {"role": "assistant", "content": REPLY}}]})
+
+        def _send(self, status, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for i, delta in enumerate(chunks(REPLY)):
+                if i and chunk_delay:
+                    time.sleep(chunk_delay)
+                event = {"choices": [{"index": 0, "delta": {"content": delta}}]}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_llm(latency: float = 0.5, port: int = 0, jitter: float = 0.0, chunk_delay: float = 0.02,
+                   error_rate: float = 0.0):
+    """Start the fake server in a background thread; returns (server, url). server.counters counts calls."""
+    counters = Counters()
+    server = ThreadingHTTPServer(("127.0.0.1", port),
+                                 make_handler(latency, jitter, chunk_delay, error_rate, counters))
+    server.daemon_threads = True
+    server.counters = counters
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds to the completion (or first chunk)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds, at random")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    args = parser.parse_args()
+    server, url = start_fake_llm(args.latency, args.port, args.jitter, args.chunk_delay, args.error_rate)
+    print("fake LLM listening on", url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,347 @@
+"""
+Offline load test: the app under gunicorn, a fake LLM, generated data.
+
+    python bench/loadtest.py --scenarios chat,chat_stream,planner,deliveries --clients 20 --requests 25
+    python bench/loadtest.py --save baseline.json
+    python bench/loadtest.py --baseline baseline.json --tolerance 0.25    # exit 1 on a regression
+
+Everything runs in a scratch directory on localhost: bench/fake_llm.py
+answers the Perplexity calls and bench/datagen.py seeds the sessions the
+clients use, so no network or repo data file is touched. For each scenario
+and operation it reports throughput, p50/p95/p99/max latency and errors,
+plus the peak and final RSS of the gunicorn master and workers together.
+
+With --baseline, p95 latency above (1 + tolerance) x the baseline,
+throughput below (1 - tolerance) x the baseline, or new errors count as a
+regression. Rate limits are off unless --env sets them; pass e.g.
+--env RESPONSE_CACHE=0 to change other app settings.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+
+from bench_async import free_port, wait_for
+from datagen import USER_MESSAGES, generate
+from fake_llm import start_fake_llm
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "wsgi": ["app:app"],
+    "asgi": ["asgi:app", "-k", "uvicorn.workers.UvicornWorker"],
+}
+TOPICS = ["physics", "history", "my sister", "football practice", "the hostel", "my part-time job",
+          "chemistry lab", "online classes", "my parents", "the bus ride"]
+
+
+# --- Scenarios: each step makes one or more requests and returns [(op, seconds, ok)] ---
+def timed(op, s, method, url, **kwargs):
+    t0 = time.perf_counter()
+    try:
+        r = s.request(method, url, timeout=120, **kwargs)
+        for _ in r.iter_content(8192):   # streamed bodies count until the last byte
+            pass
+        ok = r.status_code < 400
+    except requests.RequestException:
+        r, ok = None, False
+    return (op, time.perf_counter() - t0, ok), r
+
+
+def chat_message(rng):
+    # mostly new text, so the response cache and intent router see realistic traffic
+    return f"{rng.choice(USER_MESSAGES)}, and also about {rng.choice(TOPICS)} {rng.randint(1, 10 ** 6)}"
+
+
+def step_chat(s, base, rng, state):
+    return [timed("chat", s, "POST", base + "/chat", json={"message": chat_message(rng)})[0]]
+
+
+def step_chat_stream(s, base, rng, state):
+    return [timed("chat_stream", s, "POST", base + "/chat/stream", json={"message": chat_message(rng)},
+                  stream=True)[0]]
+
+
+def step_planner(s, base, rng, state):
+    ids = state.setdefault("ids", [])
+    roll = rng.random()
+    if roll < 0.5 or not ids:
+        if roll < 0.25 or not ids:
+            result, r = timed("planner.add", s, "POST", base + "/planner_items", json={
+                "title": f"Study {rng.choice(TOPICS)}",
+                "date": (date.today() + timedelta(days=rng.randint(0, 30))).isoformat(),
+            })
+            if r is not None and r.ok:
+                ids.append(r.json()["id"])
+            return [result]
+        return [timed("planner.list", s, "GET", base + "/planner_items", params={"limit": 50})[0]]
+    if roll < 0.65:
+        return [timed("planner.list_filtered", s, "GET", base + "/planner_items",
+                      params={"completed": "false", "sort": "date", "limit": 20})[0]]
+    if roll < 0.85:
+        return [timed("planner.patch", s, "PATCH", base + f"/planner_items/{rng.choice(ids)}",
+                      json={"completed": rng.random() < 0.5})[0]]
+    return [timed("planner.delete", s, "DELETE", base + f"/planner_items/{ids.pop()}")[0]]
+
+
+def step_deliveries(s, base, rng, state):
+    out = []
+    if rng.random() < 0.5:
+        # keep something due, otherwise every run after the first finds nothing to do
+        out.append(timed("time_messages.add", s, "POST", base + "/time_messages", json={
+            "message": "Benchmark capsule", "scheduled_date": (date.today() - timedelta(days=1)).isoformat(),
+        })[0])
+    out.append(timed("run_deliveries", s, "POST", base + "/run_deliveries")[0])
+    return out
+
+
+SCENARIOS = {
+    "chat": step_chat,
+    "chat_stream": step_chat_stream,
+    "planner": step_planner,
+    "deliveries": step_deliveries,
+}
+
+
+# --- Measurements ---
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of `pid` and its children (Linux /proc), or None."""
+    children = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, ValueError, IndexError):
+                    continue
+                children.setdefault(ppid, []).append(int(entry))
+    except OSError:
+        return None
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+        stack.extend(children.get(p, ()))
+    return total
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid, interval: float = 0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.last = None
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def sample(self):
+        rss = process_tree_rss(self.pid)
+        if rss is not None:
+            self.last = rss
+            self.peak = max(self.peak or 0, rss)
+        return rss
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+
+def summarize(results, elapsed):
+    by_op = {}
+    for op, seconds, ok in results:
+        by_op.setdefault(op, []).append((seconds, ok))
+    summary = {}
+    for op, rows in sorted(by_op.items()):
+        latencies = sorted(s for s, _ in rows)
+        summary[op] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, ok in rows if not ok),
+            "throughput_rps": round(len(rows) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+        }
+    return summary
+
+
+# --- Running ---
+def start_server(args, data_dir, llm_url):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPO, DATA_DIR=data_dir, PERPLEXITY_API_KEY="bench",
+               PERPLEXITY_API_URL=llm_url, PERPLEXITY_READ_TIMEOUT="60", STORAGE_BACKEND=args.backend,
+               # measure the app, not the admission control in front of the AI
+               RATE_LIMIT_SESSION_RATE="0", RATE_LIMIT_GLOBAL_RATE="0")
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        env[key] = value
+    cmd = [sys.executable, "-m", "gunicorn", *SERVERS[args.server], "-w", str(args.workers),
+           "-b", f"127.0.0.1:{port}", "--timeout", "120", "--log-level", "warning"]
+    if args.threads > 1 and args.server == "wsgi":
+        cmd += ["--threads", str(args.threads)]
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(data_dir), env=env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        wait_for(base + "/metrics")
+    except RuntimeError:
+        proc.terminate()
+        raise
+    return proc, base
+
+
+def run_scenario(name, args, base, sids):
+    step = SCENARIOS[name]
+
+    def client(i):
+        rng = random.Random(args.seed * 1000 + i)
+        state = {}
+        results = []
+        with requests.Session() as s:
+            s.cookies.set("saathi_sid", sids[i % len(sids)])
+            step(s, base, rng, state)  # warm-up, not recorded
+            for _ in range(args.requests):
+                results.extend(step(s, base, rng, state))
+        return results
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as pool:
+        results = [r for batch in pool.map(client, range(args.clients)) for r in batch]
+    return summarize(results, time.perf_counter() - t0)
+
+
+def compare(report, baseline, tolerance):
+    """Lines describing regressions against `baseline`; empty if there are none."""
+    problems = []
+    for name, ops in report["scenarios"].items():
+        for op, now in ops.items():
+            before = baseline.get("scenarios", {}).get(name, {}).get(op)
+            if not before:
+                continue
+            if now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                problems.append(f"{name}/{op}: p95 {before['p95_ms']:.1f} -> {now['p95_ms']:.1f} ms")
+            if now["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+                problems.append(f"{name}/{op}: throughput {before['throughput_rps']:.1f} -> "
+                                f"{now['throughput_rps']:.1f} req/s")
+            if now["errors"] > before["errors"]:
+                problems.append(f"{name}/{op}: errors {before['errors']} -> {now['errors']}")
+    peak, before_peak = report.get("rss_peak_mb"), baseline.get("rss_peak_mb")
+    if peak and before_peak and peak > before_peak * (1 + tolerance):
+        problems.append(f"peak RSS {before_peak:.1f} -> {peak:.1f} MB")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenarios", default="chat,chat_stream,planner,deliveries",
+                        help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=25, help="steps per client per scenario")
+    parser.add_argument("--server", choices=sorted(SERVERS), default="wsgi")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker (wsgi)")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="extra random fake LLM latency")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake LLM calls failing")
+    parser.add_argument("--sessions", type=int, default=20, help="generated sessions the clients share")
+    parser.add_argument("--turns", type=int, default=500, help="chat turns of history per session")
+    parser.add_argument("--planner", type=int, default=200, help="planner items per session")
+    parser.add_argument("--capsules", type=int, default=50, help="time capsule messages per session")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app setting")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare with a JSON file from --save")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix="saathi-load-")
+    data_dir = os.path.join(workdir, "data")
+    t0 = time.perf_counter()
+    sids = generate(data_dir, args.sessions, args.turns, args.planner, args.capsules, seed=args.seed)
+    print(f"generated {len(sids)} sessions in {time.perf_counter() - t0:.1f}s ({workdir})")
+
+    llm, llm_url = start_fake_llm(args.latency, jitter=args.jitter, chunk_delay=args.chunk_delay,
+                                  error_rate=args.error_rate)
+    proc, base = start_server(args, data_dir, llm_url)
+    sampler = RSSSampler(proc.pid)
+    sampler.start()
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("save", "baseline")},
+              "scenarios": {}}
+    try:
+        start_rss = sampler.sample()
+        print(f"{args.server}, {args.workers} workers, {args.backend} storage, {args.clients} clients x "
+              f"{args.requests} steps, LLM latency {args.latency}s")
+        print(f"{'scenario/op':34} {'req':>6} {'err':>4} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'p99 ms':>9} {'max ms':>9}")
+        for name in names:
+            report["scenarios"][name] = ops = run_scenario(name, args, base, sids)
+            for op, r in ops.items():
+                print(f"{name + '/' + op:34} {r['requests']:6} {r['errors']:4} {r['throughput_rps']:8.1f} "
+                      f"{r['p50_ms']:9.1f} {r['p95_ms']:9.1f} {r['p99_ms']:9.1f} {r['max_ms']:9.1f}")
+    finally:
+        sampler.stop()
+        proc.terminate()
+        proc.wait(10)
+        llm.shutdown()
+    mb = 1024 * 1024
+    if sampler.peak is not None:
+        report["rss_start_mb"] = round((start_rss or 0) / mb, 1)
+        report["rss_peak_mb"] = round(sampler.peak / mb, 1)
+        report["rss_end_mb"] = round(sampler.last / mb, 1)
+        print(f"RSS (master + workers): start {report['rss_start_mb']} MB, peak {report['rss_peak_mb']} MB, "
+              f"end {report['rss_end_mb']} MB")
+    report["fake_llm"] = llm.counters.snapshot()
+    print("fake LLM calls:", report["fake_llm"])
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        if problems:
+            print("REGRESSIONS:")
+            for line in problems:
+                print("  " + line)
+            sys.exit(1)
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Replay captured chat turns (CHAT_CAPTURE=1, see capture.py) through
+chatbot_response, with the recorded upstream replies standing in for
+Perplexity.
+
+    python bench/replay.py requests.jsonl --concurrency 8 --delay recorded --diff 5
+    python bench/replay.py requests.jsonl --repeat 10 --delay 0 --out replay.jsonl
+
+Lines that are not chat captures are skipped. Every captured session starts
+from an empty session in a scratch directory, and its turns run in order.
+Sessions run `--concurrency` at a time. --delay sleeps before each upstream
+reply: "recorded" uses the captured latency, a number is a fixed delay in
+seconds, and 0 measures the app alone. The response cache is off unless
+--cache is given, so turns the cache answered during capture are replayed
+through the upstream stand-in with the reply they got.
+
+The report gives turns/s, turn latency percentiles and how many upstream
+calls were made. It also compares each turn's HTML with the captured HTML
+and each prompt with the captured prompt. When capture started in the middle
+of a session, the first prompts differ for that reason alone. With --strict
+the exit code is 1 if any HTML differs.
+"""
+import argparse
+import difflib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from capture import is_capture  # noqa: E402
+from loadtest import percentile  # noqa: E402
+
+MISSING_REPLY = "(Replay) No upstream reply was recorded for this turn."
+
+
+def load_sessions(paths):
+    """{session: [capture, ...] in time order}, plus the number of lines skipped."""
+    sessions, skipped = {}, 0
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if not is_capture(record) or not record.get("input"):
+                    skipped += 1
+                    continue
+                sessions.setdefault(record["session"], []).append(record)
+    for turns in sessions.values():
+        turns.sort(key=lambda r: r.get("ts", 0))
+    return sessions, skipped
+
+
+class ReplayUpstream:
+    """Stands in for UpstreamClient: answers with the turn the calling thread is replaying."""
+
+    def __init__(self, delay="0"):
+        self.delay = delay
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.missing = 0
+        self.prompt_changes = 0
+
+    def _reply(self, payload):
+        record = getattr(self.local, "record", None) or {}
+        recorded = record.get("upstream") or {}
+        # a turn the response cache answered when captured: its reply is all there is
+        content = recorded.get("content", record.get("cached_reply"))
+        with self.lock:
+            self.calls += 1
+            if content is None:
+                self.missing += 1
+            elif recorded.get("prompt") and recorded["prompt"] != [
+                    {"role": m.get("role"), "content": m.get("content")} for m in payload["messages"]]:
+                self.prompt_changes += 1
+        self.local.called = True
+        if self.delay == "recorded":
+            time.sleep((recorded.get("ms") or 0) / 1000)
+        elif float(self.delay) > 0:
+            time.sleep(float(self.delay))
+        return MISSING_REPLY if content is None else content
+
+    def chat_completion(self, payload):
+        return {"choices": [{"message": {"role": "assistant", "content": self._reply(payload)}}]}
+
+    def stream_chat_completion(self, payload):
+        yield self._reply(payload)
+
+
+def setup_app(delay, cache=False):
+    """Import the app in a scratch directory, with capture off and the replay upstream wired in."""
+    workdir = tempfile.mkdtemp(prefix="saathi-replay-")
+    os.chdir(workdir)
+    os.environ.update(DATA_DIR=os.path.join(workdir, "data"), PERPLEXITY_API_KEY="replay", CHAT_CAPTURE="0",
+                      RATE_LIMIT_SESSION_RATE="0", RATE_LIMIT_GLOBAL_RATE="0")
+    if not cache:
+        # repeated sessions would otherwise be answered from each other's cached replies
+        os.environ["RESPONSE_CACHE"] = "0"
+    import app
+    replay_upstream = ReplayUpstream(delay)
+    replay_upstream.breaker = app.upstream.breaker  # read by /metrics
+    app.upstream = replay_upstream
+    app.PERPLEXITY_KEY = "replay"
+    return app, replay_upstream, workdir
+
+
+def replay_session(app, replay_upstream, turns):
+    user = app.session_cache.get(uuid.uuid4().hex)
+    results = []
+    for record in turns:
+        replay_upstream.local.record = record
+        replay_upstream.local.called = False
+        t0 = time.perf_counter()
+        html = app.chatbot_response(record["input"], user)
+        seconds = time.perf_counter() - t0
+        results.append({
+            "session": record["session"],
+            "input": record["input"],
+            "path": record.get("path"),
+            "upstream_called": replay_upstream.local.called,
+            "ms": round(seconds * 1000, 3),
+            "recorded_ms": (record.get("timings") or {}).get("total_ms"),
+            "same_html": html == record.get("reply_html"),
+            "html": html,
+            "recorded_html": record.get("reply_html"),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("paths", nargs="+", help="capture files (JSONL)")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions replayed at once")
+    parser.add_argument("--delay", default="0", help='upstream delay: "recorded" or seconds')
+    parser.add_argument("--repeat", type=int, default=1, help="replay every session this many times")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache on")
+    parser.add_argument("--diff", type=int, default=3, help="show the first N HTML differences")
+    parser.add_argument("--out", help="write per-turn results as JSONL")
+    parser.add_argument("--strict", action="store_true", help="exit 1 if any HTML differs")
+    args = parser.parse_args()
+    paths = [os.path.abspath(p) for p in args.paths]
+    out = os.path.abspath(args.out) if args.out else None
+
+    sessions, skipped = load_sessions(paths)
+    if not sessions:
+        print(f"no chat captures found ({skipped} other lines skipped)")
+        sys.exit(1)
+    app, replay_upstream, workdir = setup_app(args.delay, args.cache)
+    jobs = [turns for _ in range(args.repeat) for turns in sessions.values()]
+    n_turns = sum(len(t) for t in jobs)
+    print(f"{len(sessions)} sessions, {n_turns} turns ({args.repeat}x), {skipped} other lines skipped, "
+          f"concurrency {args.concurrency}, upstream delay {args.delay}")
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = [r for batch in pool.map(lambda t: replay_session(app, replay_upstream, t), jobs)
+                   for r in batch]
+    elapsed = time.perf_counter() - t0
+
+    latencies = sorted(r["ms"] for r in results)
+    recorded = sorted(r["recorded_ms"] for r in results if r["recorded_ms"] is not None)
+    expected_calls = sum(1 for r in results if r["path"] == "ai" or (r["path"] == "cache" and not args.cache))
+    different = [r for r in results if not r["same_html"]]
+    print(f"throughput   {len(results) / elapsed:8.1f} turns/s ({elapsed:.2f}s)")
+    print(f"turn latency p50 {percentile(latencies, 50):.1f} ms  p95 {percentile(latencies, 95):.1f} ms  "
+          f"p99 {percentile(latencies, 99):.1f} ms")
+    if recorded:
+        print(f"captured     p50 {percentile(recorded, 50):.1f} ms  p95 {percentile(recorded, 95):.1f} ms  "
+              f"p99 {percentile(recorded, 99):.1f} ms")
+    print(f"upstream     {replay_upstream.calls} calls (captured: {expected_calls}), "
+          f"{replay_upstream.missing} without a recorded reply, {replay_upstream.prompt_changes} prompts changed")
+    print(f"html         {len(results) - len(different)} identical, {len(different)} different")
+    for r in different[:args.diff]:
+        print(f"\n--- {r['session']}: {r['input'][:60]!r} (captured path {r['path']})")
+        sys.stdout.writelines(difflib.unified_diff(
+            (r["recorded_html"] or "").splitlines(True), r["html"].splitlines(True), "captured", "replayed"))
+        print()
+
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    print(f"scratch data in {workdir}")
+    if args.strict and different:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
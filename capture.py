@@ -0,0 +1,238 @@
+"""
+Capture of chat turns for replay (bench/replay.py), off by default.
+
+    CHAT_CAPTURE=1 CHAT_CAPTURE_FILE=requests.jsonl gunicorn app:app
+
+Each /chat or /chat/stream turn becomes one JSON line: the student's message,
+the prompt sent upstream, the upstream reply, the formatted HTML and
+timings. The file is only ever appended to, and every capture line has
+"type": "chat_capture", so replay skips any other lines the file holds.
+
+The request thread only puts the turn on a bounded queue; a background
+thread sanitizes, serializes and appends batches with one O_APPEND write
+each. If the queue is full the turn is dropped (and counted), never waited
+for. Sanitizing replaces e-mail addresses, URLs and phone numbers, and
+swaps the student's name for a fixed stand-in everywhere in the record, so
+name greetings still replay consistently. Session ids are stored as salted
+hashes (CHAT_CAPTURE_SALT). CHAT_CAPTURE_SAMPLE captures that fraction of
+sessions, whole sessions at a time.
+"""
+import atexit
+import contextvars
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+CAPTURE_TYPE = "chat_capture"
+CAPTURE_VERSION = 1
+NAME_STAND_IN = "Sam"
+
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+URL_RE = re.compile(r"\bhttps?://\S+|\bwww\.\S+", re.IGNORECASE)
+# dates (2024-05-01, 01/05/2024) look like phone numbers too; they are kept, and
+# a match can't start inside one
+DATE_RE = r"(?:\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4})(?!\d)"
+PHONE_RE = re.compile(rf"(?<![\w./-])(?!{DATE_RE})\+?\d[\d\s().-]{{6,}}\d(?!\w)")
+
+
+def sanitize(text, names=()):
+    if not isinstance(text, str) or not text:
+        return text
+    text = EMAIL_RE.sub("[email]", text)
+    text = URL_RE.sub("[url]", text)
+    text = PHONE_RE.sub("[phone]", text)
+    for name in names:
+        text = re.sub(rf"\b{re.escape(name)}\b", NAME_STAND_IN, text, flags=re.IGNORECASE)
+    return text
+
+
+def sanitize_record(record, names):
+    names = sorted({n for n in names if n and n.lower() != NAME_STAND_IN.lower()}, key=len, reverse=True)
+    record["input"] = sanitize(record.get("input"), names)
+    record["reply_html"] = sanitize(record.get("reply_html"), names)
+    if "cached_reply" in record:
+        record["cached_reply"] = sanitize(record["cached_reply"], names)
+    upstream = record.get("upstream")
+    if upstream:
+        upstream["content"] = sanitize(upstream.get("content"), names)
+        upstream["prompt"] = [dict(m, content=sanitize(m.get("content"), names)) for m in upstream.get("prompt") or []]
+    return record
+
+
+def is_capture(record):
+    return isinstance(record, dict) and record.get("type") == CAPTURE_TYPE
+
+
+class CaptureWriter:
+    """Bounded queue + background appender; write() never blocks."""
+
+    def __init__(self, path, max_queue: int = 10000, flush_interval: float = 1.0, batch: int = 256):
+        self.path = path
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        atexit.register(self.flush)
+
+    def _ensure_thread(self):
+        # (re)started lazily, so a forked worker gets its own queue and thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queue)
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="chat-capture", daemon=True).start()
+
+    def write(self, record, names=()):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((record, names))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def _run(self):
+        q = self._queue
+        while True:
+            try:
+                items = [q.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(items) < self.batch:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            self._append(items)
+
+    def _append(self, items):
+        lines = []
+        for record, names in items:
+            try:
+                lines.append(json.dumps(sanitize_record(record, names), ensure_ascii=False, default=str))
+            except Exception as e:
+                print("Could not serialize chat capture:", e)
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            with self._lock:
+                self.written += len(lines)
+        except OSError as e:
+            with self._lock:
+                self.failed += len(lines)
+            print("Could not write chat capture:", e)
+
+    def flush(self):
+        """Write whatever is queued now, in the calling thread (used at exit)."""
+        if self._queue is None or self._pid != os.getpid():
+            return
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            self._append(items)
+
+    def stats(self):
+        with self._lock:
+            return {"written": self.written, "dropped": self.dropped, "failed": self.failed,
+                    "queued": self._queue.qsize() if self._queue is not None else 0}
+
+
+_current = contextvars.ContextVar("saathi_capture", default=None)
+
+
+class ChatCapture:
+    """
+        record = chat_capture.begin(user.sid, user_input, "chat")   # None when not capturing
+        ...
+        chat_capture.upstream(payload["messages"], started, ok=True)  # from the LLM call, if any
+        ...
+        chat_capture.end(record, html, path="ai", user_name=name, ai_text=ai_text)
+    """
+
+    def __init__(self, writer=None, sample: float = 1.0, salt: str = ""):
+        self.writer = writer
+        self.sample = sample
+        self.salt = salt
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        if env("CHAT_CAPTURE", "0") != "1":
+            return cls()
+        return cls(CaptureWriter(env("CHAT_CAPTURE_FILE", "requests.jsonl")),
+                   sample=float(env("CHAT_CAPTURE_SAMPLE", "1")), salt=env("CHAT_CAPTURE_SALT", ""))
+
+    @property
+    def enabled(self):
+        return self.writer is not None and self.sample > 0
+
+    def session_key(self, sid):
+        return hashlib.sha256(f"{self.salt}:{sid}".encode()).hexdigest()[:20]
+
+    def begin(self, sid, user_input, mode):
+        if not self.enabled:
+            return None
+        key = self.session_key(sid)
+        # whole sessions are in or out of the sample
+        if self.sample < 1 and int(key[:8], 16) / 0xFFFFFFFF >= self.sample:
+            return None
+        record = {
+            "type": CAPTURE_TYPE, "v": CAPTURE_VERSION, "ts": time.time(), "session": key,
+            "mode": mode, "input": user_input, "t0": time.perf_counter(),
+        }
+        _current.set(record)
+        return record
+
+    def upstream(self, messages, started, ok=True):
+        """Note the prompt and latency of this turn's LLM call (no-op when not capturing)."""
+        record = _current.get()
+        if record is not None:
+            record["upstream"] = {
+                "prompt": [{"role": m.get("role"), "content": m.get("content")} for m in messages],
+                "ok": ok,
+                "ms": round((time.perf_counter() - started) * 1000, 3),
+            }
+
+    def end(self, record, reply_html, path, user_name=None, ai_text=None):
+        if record is None:
+            return
+        if _current.get() is record:
+            _current.set(None)
+        record["path"] = path
+        record["reply_html"] = reply_html
+        record["name"] = bool(user_name)
+        if path == "ai":
+            record.setdefault("upstream", {})["content"] = ai_text
+        elif path == "cache":
+            record["cached_reply"] = ai_text  # lets replay run with the cache off
+        record["timings"] = {
+            "total_ms": round((time.perf_counter() - record.pop("t0")) * 1000, 3),
+            "llm_ms": (record.get("upstream") or {}).get("ms"),
+        }
+        self.writer.write(record, (user_name,) if user_name else ())
+
+    def stats(self):
+        return self.writer.stats() if self.writer is not None else {}
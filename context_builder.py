@@ -0,0 +1,270 @@
+"""
+Token-budgeted context window for the chat model.
+
+Every turn sends one system message (the system prompt, this turn's
+instructions and a short summary of older turns), then the most recent
+turns and the new message, trimmed to fit `budget` tokens. Older turns are
+not dropped silently: as they leave the recent window they are folded, one
+at a time, into a rolling extractive summary (first sentence of each, time
+capsule notes as one line), so the summary is never recomputed from
+scratch.
+
+Each session keeps a ContextWindow between turns: the recent messages with
+their clipped text and token counts, the summary lines, and the last
+assembled prefix. A new turn only processes the messages appended since the
+previous one. Token counts are estimates (about 4 characters per token);
+no tokenizer is needed.
+"""
+import os
+import re
+import threading
+from collections import deque
+from typing import NamedTuple
+
+TIME_CAPSULE_PREFIX = "[Time Capsule]"
+MESSAGE_OVERHEAD = 4  # role + separators, per message
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+MARKUP_RE = re.compile(r"[*_#`>]+")
+SPACE_RE = re.compile(r"\s+")
+
+
+def estimate_tokens(text):
+    return (len(text or "") + 3) // 4
+
+
+def clip(text, max_tokens):
+    """`text` cut to about `max_tokens`, on a sentence boundary where possible."""
+    text = SPACE_RE.sub(" ", text or "").strip()
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens * 4
+    out = ""
+    for sentence in SENTENCE_END_RE.split(text):
+        candidate = f"{out} {sentence}".strip()
+        if len(candidate) > limit:
+            break
+        out = candidate
+    return out or text[:limit].rsplit(" ", 1)[0] + "..."
+
+
+def summary_line(msg, max_words: int = 18):
+    """One short line for the rolling summary, or None if the message adds nothing."""
+    content = MARKUP_RE.sub("", msg.get("content") or "")
+    content = SPACE_RE.sub(" ", content).strip()
+    if not content:
+        return None
+    if msg.get("role") == "assistant" and content.startswith(TIME_CAPSULE_PREFIX):
+        who, content = "Time capsule delivered", content[len(TIME_CAPSULE_PREFIX):].strip()
+    elif msg.get("role") == "user":
+        who = "Student"
+    elif msg.get("role") == "assistant":
+        who = "Saathi"
+    else:
+        return None
+    words = SENTENCE_END_RE.split(content, 1)[0].split()
+    text = " ".join(words[:max_words]) + ("..." if len(words) > max_words else "")
+    return f"{who}: {text}"
+
+
+class Turn(NamedTuple):
+    """What start_turn hands to the model: the student's message plus per-turn instructions."""
+    message: str
+    instructions: str = ""
+
+
+class ContextWindow:
+    """Per-session state kept between turns (lives on the session's UserState)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recent = deque()     # (role, clipped content, tokens), oldest first
+        self.summary = deque()    # (line, tokens), oldest first
+        self.summary_tokens = 0
+        self.last = None          # last two history messages seen, to find what is new
+        self.prefix_key = None
+        self.prefix = None        # (system content, recent messages) of the last build
+
+    def reset(self):
+        self.recent.clear()
+        self.summary.clear()
+        self.summary_tokens = 0
+        self.last = None
+        self.prefix_key = None
+        self.prefix = None
+
+
+class ContextBuilder:
+    """
+    `budget` is the prompt budget in tokens (the reply's max_tokens is
+    separate). At most `recent_messages` history messages are sent verbatim,
+    each clipped to `message_tokens`; the summary is capped at `summary_tokens`.
+    """
+
+    def __init__(self, system_prompt, budget: int = 1200, recent_messages: int = 10,
+                 message_tokens: int = 160, summary_tokens: int = 200, scan: int = 40):
+        self.system_prompt = system_prompt.strip()
+        self.budget = budget
+        self.recent_messages = recent_messages
+        self.message_tokens = message_tokens
+        self.summary_tokens = summary_tokens
+        self.scan = scan  # history messages read when a window starts from nothing
+        self._stats_lock = threading.Lock()
+        self.builds = 0
+        self.prefix_hits = 0       # prefix reused as is
+        self.incremental = 0       # prefix extended with the newest messages only
+        self.rebuilds = 0          # window rebuilt from the history tail
+        self.summarized = 0        # messages folded into summaries
+        self.trimmed = 0           # recent messages left out to meet the budget
+        self.prompt_tokens = 0
+        self.naive_tokens = 0      # what the old full-prompt payload would have cost
+
+    @classmethod
+    def from_env(cls, system_prompt):
+        env = os.environ.get
+        return cls(
+            system_prompt,
+            budget=int(env("CONTEXT_TOKEN_BUDGET", "1200")),
+            recent_messages=int(env("CONTEXT_RECENT_MESSAGES", "10")),
+            message_tokens=int(env("CONTEXT_MESSAGE_TOKENS", "160")),
+            summary_tokens=int(env("CONTEXT_SUMMARY_TOKENS", "200")),
+        )
+
+    # --- window maintenance ---
+    def _fold(self, window, msg):
+        line = summary_line(msg)
+        if line is None:
+            return
+        tokens = estimate_tokens(line) + 2
+        window.summary.append((line, tokens))
+        window.summary_tokens += tokens
+        with self._stats_lock:
+            self.summarized += 1
+        # rolling: the oldest lines go once the summary is over its cap
+        while window.summary_tokens > self.summary_tokens and window.summary:
+            window.summary_tokens -= window.summary.popleft()[1]
+
+    def _push(self, window, msg):
+        role = msg.get("role")
+        content = msg.get("content") or ""
+        if role not in ("user", "assistant"):
+            return
+        if role == "assistant" and content.startswith(TIME_CAPSULE_PREFIX):
+            # a notification, not part of the dialogue: the summary is enough
+            self._fold(window, msg)
+            return
+        text = clip(content, self.message_tokens)
+        if window.recent and window.recent[-1][0] == role:
+            # the API wants alternating roles; merge a doubled turn
+            _, prev, _ = window.recent.pop()
+            text = clip(f"{prev} {text}", self.message_tokens)
+        window.recent.append((role, text, estimate_tokens(text) + MESSAGE_OVERHEAD))
+        while len(window.recent) > self.recent_messages:
+            role, text, _ = window.recent.popleft()
+            self._fold(window, {"role": role, "content": text})
+
+    def _sync(self, window, history):
+        """Push the messages appended since the last build; True if there were any."""
+        tail = history.tail(self.recent_messages + 10)
+        new = None
+        if window.last == []:
+            new = tail if len(tail) < self.recent_messages + 10 else None
+        elif window.last is not None:
+            k = len(window.last)
+            for i in range(len(tail) - k, -1, -1):
+                if tail[i:i + k] == window.last:
+                    new = tail[i + k:]
+                    break
+        if new is None:
+            # first turn in this worker, or too much was appended elsewhere
+            window.reset()
+            tail = new = history.tail(self.scan)
+            with self._stats_lock:
+                self.rebuilds += 1
+        elif new:
+            with self._stats_lock:
+                self.incremental += 1
+        for msg in new:
+            self._push(window, msg)
+        window.last = [dict(m) for m in tail[-2:]]
+        return bool(new)
+
+    # --- assembly ---
+    def _system_content(self, instructions, summary_lines):
+        parts = [self.system_prompt]
+        if instructions:
+            parts.append(instructions.strip())
+        if summary_lines:
+            parts.append("Earlier in this conversation:\n" + "\n".join(f"- {line}" for line in summary_lines))
+        return "\n".join(parts)
+
+    def _assemble(self, window, instructions, message_tokens):
+        """(system content, recent messages) that fit the budget next to a message of `message_tokens`."""
+        fixed = estimate_tokens(self.system_prompt) + estimate_tokens(instructions) + 2 * MESSAGE_OVERHEAD
+        room = self.budget - fixed - message_tokens
+        summary = list(window.summary)
+        summary_cost = sum(t for _, t in summary)
+        # the newest turns matter most: fill from the end, keeping some room for the summary
+        reserve = min(summary_cost, self.summary_tokens // 2)
+        recent = []
+        used = 0
+        for role, text, tokens in reversed(window.recent):
+            if used + tokens > room - reserve:
+                break
+            recent.append({"role": role, "content": text})
+            used += tokens
+        with self._stats_lock:
+            self.trimmed += len(window.recent) - len(recent)
+        recent.reverse()
+        # after the system message the first turn must be the student's
+        while recent and recent[0]["role"] != "user":
+            recent.pop(0)
+        if recent and recent[-1]["role"] == "user":
+            recent.pop()  # the new message follows; never two user turns in a row
+        while summary and summary_cost > room - used:
+            summary_cost -= summary.pop(0)[1]
+        return self._system_content(instructions, [line for line, _ in summary]), recent
+
+    def build(self, history, turn, window):
+        """Chat messages for `turn` (a Turn), updating the session's `window`."""
+        message = turn.message
+        message_tokens = estimate_tokens(message) + MESSAGE_OVERHEAD
+        with window.lock:
+            changed = self._sync(window, history)
+            key = (turn.instructions, message_tokens)
+            if not changed and window.prefix_key == key:
+                system, recent = window.prefix
+                with self._stats_lock:
+                    self.prefix_hits += 1
+            else:
+                system, recent = self._assemble(window, turn.instructions, message_tokens)
+                window.prefix_key, window.prefix = key, (system, recent)
+            raw = history.tail(self.recent_messages)
+        messages = [{"role": "system", "content": system}] + [dict(m) for m in recent]
+        messages.append({"role": "user", "content": message})
+
+        tokens = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+        # the old payload: system prompt, the raw last 10 messages, then the system
+        # prompt and instructions again inside the user message
+        naive = (2 * estimate_tokens(self.system_prompt) + estimate_tokens(turn.instructions)
+                 + message_tokens + MESSAGE_OVERHEAD
+                 + sum(estimate_tokens(m.get("content")) + MESSAGE_OVERHEAD
+                       for m in raw if m.get("role") in ("user", "assistant")))
+        with self._stats_lock:
+            self.builds += 1
+            self.prompt_tokens += tokens
+            self.naive_tokens += naive
+        return messages
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "builds": self.builds,
+                "prefix_hits": self.prefix_hits,
+                "incremental": self.incremental,
+                "rebuilds": self.rebuilds,
+                "summarized_messages": self.summarized,
+                "trimmed_messages": self.trimmed,
+                "prompt_tokens": self.prompt_tokens,
+                "tokens_saved": max(0, self.naive_tokens - self.prompt_tokens),
+                "avg_prompt_tokens": round(self.prompt_tokens / self.builds, 1) if self.builds else 0.0,
+            }
@@ -0,0 +1,71 @@
+"""
+gunicorn settings, picked up automatically from the working directory
+(`gunicorn app:app`, `gunicorn asgi:app -k uvicorn.workers.UvicornWorker`).
+
+The app is imported once in the master (preload). when_ready then runs its
+one-off data work (legacy and SQLite migrations, write-behind recovery;
+app.prepare_data) and warms it up, both before any worker forks: the
+intent model, templates and delivery heap are built before forking, and
+gc.freeze() keeps the collector from touching those objects again, so the
+workers share their pages instead of each building and copying its own.
+Everything that can't cross a fork (HTTP sessions, SQLite connections, the
+write-behind and capture threads) is already created lazily per process.
+GUNICORN_PRELOAD=0 imports the app in every worker instead.
+
+`gunicorn app:app` runs threaded workers (gthread, GUNICORN_THREADS per
+worker, 32 by default): an open /events connection holds one thread, and a
+sync worker would have to refuse them (204), leaving the pages without
+push. For many idle connections use the ASGI mode, where one is a
+coroutine; -k on the command line overrides worker_class (gunicorn runs
+`-k sync` as gthread while threads > 1, so add --threads 1 for sync workers).
+
+A worker that dies leaves its write-behind journal (writebehind.py) behind.
+Importing the app replays such journals, but with preload that import only
+happens once, in the master, so child_exit replays the dead worker's
+journal as soon as it is reaped, before its replacement takes requests.
+"""
+import gc
+import os
+import sys
+import time
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+if preload_app:
+    # tells app.py to leave the delivery thread to post_fork
+    os.environ["SAATHI_PRELOAD"] = "1"
+
+
+def when_ready(server):
+    app = sys.modules.get("app")
+    if app is None:  # not preloaded
+        return
+    started = time.perf_counter()
+    app.prepare_data()
+    server.log.info("Data ready in %.0f ms", (time.perf_counter() - started) * 1000)
+    started = time.perf_counter()
+    app.warmup()
+    gc.collect()
+    gc.freeze()
+    server.log.info("Warmed up in %.0f ms", (time.perf_counter() - started) * 1000)
+
+
+def post_fork(server, worker):
+    app = sys.modules.get("app")
+    if app is not None and os.environ.get("ENABLE_TIME_WORKER") == "1":
+        app.start_delivery_worker()
+
+
+def child_exit(server, worker):
+    sessions = sys.modules.get("sessions")
+    if sessions is None:  # not preloaded: the replacement worker's import recovers
+        return
+    try:
+        replayed = sessions.recover_write_behind()
+    except Exception as e:
+        server.log.error("Write-behind recovery after worker %s exited failed: %s", worker.pid, e)
+        return
+    if replayed:
+        server.log.info("Replayed %d journaled writes of worker %s", replayed, worker.pid)
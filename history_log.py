@@ -0,0 +1,441 @@
+"""
+Append-only chat history storage.
+
+History lives in a directory of JSONL segment files plus a small index:
+
+    chat_history_log/
+        index.json          # sealed segments + their message counts
+        seg-000001.jsonl    # sealed
+        seg-000002.jsonl    # active (appended to)
+
+Each turn is written as one buffered append to the active segment, so the
+cost of a /chat request no longer grows with the size of the history.
+Reads of the last N messages are served from the end of the log without
+parsing the older segments. Appends, seals and compaction hold the index's
+file lock, so several workers can share one log.
+"""
+import json
+import os
+import threading
+from collections import deque
+
+from metrics import STORAGE_SECONDS, instrument
+from storage import atomic_write_json, file_lock, iter_json_array
+
+SEGMENT_PREFIX = "seg-"
+SEGMENT_SUFFIX = ".jsonl"
+INDEX_NAME = "index.json"
+
+
+def _segment_name(number: int) -> str:
+    return f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}"
+
+
+def _segment_number(name: str) -> int:
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+class HistoryLog:
+    """
+    Segmented append-only log of chat messages (dicts).
+
+    `segment_max_bytes` controls when the active segment is sealed and a new
+    one started. Every `compact_every` seals, adjacent sealed segments are
+    merged so the number of files stays small.
+    """
+
+    def __init__(self, directory, segment_max_bytes: int = 256 * 1024,
+                 compact_every: int = 8, tail_cache_size: int = 200, write_behind=None, on_write=None):
+        self.directory = str(directory)
+        self.write_behind = write_behind
+        self.on_write = on_write  # called with the entries once they are in a segment
+        self._pending = []  # journaled, not yet in a segment (write-behind)
+        self.segment_max_bytes = segment_max_bytes
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._tail = deque(maxlen=tail_cache_size)
+        self._tail_complete = False  # True when _tail holds the whole log
+        self._tail_stamp = None      # (segment, size) the tail cache reflects
+        self._index = None
+        self._index_mtime = None
+
+    # --- index ---
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_NAME)
+
+    def _load_index(self):
+        # another worker may have sealed a segment; a stat is enough to notice
+        try:
+            mtime = os.stat(self._index_path()).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._index is not None and mtime == self._index_mtime:
+            return self._index
+        os.makedirs(self.directory, exist_ok=True)
+        index = {"sealed": [], "active": 1, "seals_since_compact": 0, "imported_from": None}
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                index.update(json.load(f) or {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Could not read history index, rebuilding:", e)
+            index = self._rebuild_index()
+        self._index = index
+        self._index_mtime = mtime
+        return index
+
+    def _rebuild_index(self):
+        names = sorted(n for n in os.listdir(self.directory)
+                       if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX))
+        index = {"sealed": [], "active": 1, "seals_since_compact": 0, "imported_from": None}
+        if names:
+            for name in names[:-1]:
+                index["sealed"].append({"name": name, "count": self._count_lines(name)})
+            index["active"] = _segment_number(names[-1])
+        return index
+
+    def _save_index(self):
+        atomic_write_json(self._index_path(), self._index)
+        self._index_mtime = os.stat(self._index_path()).st_mtime_ns
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _active_name(self):
+        return _segment_name(self._load_index()["active"])
+
+    def _count_lines(self, name):
+        try:
+            with open(self._path(name), "rb") as f:
+                return sum(1 for line in f if line.strip())
+        except FileNotFoundError:
+            return 0
+
+    # --- writes ---
+    def append(self, entry: dict):
+        self.append_many([entry])
+
+    def append_many(self, entries):
+        """
+        Append several messages with a single write to the active segment, or,
+        with a write_behind, journal them and leave the write to its thread.
+        """
+        entries = list(entries)
+        if not entries:
+            return
+        if self.write_behind is None:
+            self._append_now(entries)
+            return self._notify(entries)
+        with self._lock:
+            try:
+                seq = self.write_behind.journal(self, {"kind": "history", "directory": self.directory,
+                                                       "entries": entries})
+            except OSError as e:
+                print("Write-behind journal failed, writing through:", e)
+                self._append_now(entries)
+                return self._notify(entries)
+            self._pending.extend(entries)
+        self.write_behind.sync(seq)
+
+    def flush_pending(self):
+        """Write the journaled entries (called by the write-behind thread)."""
+        with self._lock:
+            written = self._pending
+            if written:
+                self._append_now(written, fsync=True)
+                self._pending = []
+        if written:
+            self._notify(written)
+
+    def _notify(self, entries):
+        # outside the lock: the listener may read the log back
+        if self.on_write is not None:
+            try:
+                self.on_write(entries)
+            except Exception as e:
+                print("History listener failed:", e)
+
+    @instrument(STORAGE_SECONDS, "history.append", backend="history", op="write")
+    def _append_now(self, entries, fsync=False):
+        data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries).encode("utf-8")
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, file_lock(self._index_path()):
+            self._load_index()
+            path = self._path(self._active_name())
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                if fsync:
+                    os.fsync(fd)  # the journal entry is dropped after this
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if self._tail_stamp is not None and self._tail_stamp[0] == self._active_name() \
+                    and self._tail_stamp[1] == size - len(data):
+                if len(self._tail) + len(entries) > self._tail.maxlen:
+                    self._tail_complete = False  # the oldest entries fall out of the cache
+                self._tail.extend(entries)
+                self._tail_stamp = (self._active_name(), size)
+            else:
+                self._tail_stamp = None
+            if size >= self.segment_max_bytes:
+                self._seal_active()
+
+    def _seal_active(self):
+        index = self._index
+        name = self._active_name()
+        index["sealed"].append({"name": name, "count": self._count_lines(name)})
+        index["active"] += 1
+        index["seals_since_compact"] = index.get("seals_since_compact", 0) + 1
+        self._save_index()
+        if self._tail_stamp is not None:
+            self._tail_stamp = (self._active_name(), 0)
+        if index["seals_since_compact"] >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """
+        Merge adjacent sealed segments into files of up to 4x the segment size and
+        drop malformed (torn) lines. The active segment is never touched.
+        """
+        with self._lock, file_lock(self._index_path()):
+            index = self._load_index()
+            merged, run, run_bytes = [], [], 0
+
+            def flush_run():
+                if len(run) > 1:
+                    merged.append(self._merge_segments(run))
+                else:
+                    merged.extend(run)
+
+            for seg in index["sealed"]:
+                try:
+                    size = os.path.getsize(self._path(seg["name"]))
+                except OSError:
+                    continue
+                if run and run_bytes + size > self.segment_max_bytes * 4:
+                    flush_run()
+                    run, run_bytes = [], 0
+                run.append(seg)
+                run_bytes += size
+            flush_run()
+            old_names = {s["name"] for s in index["sealed"]}
+            index["sealed"] = merged
+            index["seals_since_compact"] = 0
+            self._save_index()
+            for name in old_names - {s["name"] for s in merged}:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def _merge_segments(self, segments):
+        # keep the first segment's name so ordering by name stays intact
+        target = segments[0]["name"]
+        tmp = self._path(target + ".compact")
+        count = 0
+        with open(tmp, "w", encoding="utf-8") as out:
+            for seg in segments:
+                for entry in self._iter_segment(seg["name"]):
+                    out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    count += 1
+        os.replace(tmp, self._path(target))
+        return {"name": target, "count": count}
+
+    # --- reads ---
+    def _iter_segment(self, name):
+        try:
+            with open(self._path(name), "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # torn write at the end of a segment; skip it
+                        continue
+        except FileNotFoundError:
+            return
+
+    def __iter__(self):
+        with self._lock:
+            index = self._load_index()
+            names = [s["name"] for s in index["sealed"]] + [self._active_name()]
+            pending = list(self._pending)
+        for name in names:
+            yield from self._iter_segment(name)
+        yield from pending
+
+    def __len__(self):
+        with self._lock:
+            index = self._load_index()
+            return (sum(s["count"] for s in index["sealed"]) + self._count_lines(self._active_name())
+                    + len(self._pending))
+
+    def tail(self, n: int):
+        """Return the last `n` messages, reading backwards from the end of the log."""
+        if n <= 0:
+            return []
+        with self._lock:
+            if not self._pending:
+                return self._tail_on_disk(n)
+            pending = self._pending[-n:]
+            if len(pending) == n:
+                return list(pending)
+            return self._tail_on_disk(n - len(pending)) + list(pending)
+
+    def _tail_on_disk(self, n):
+        with self._lock:
+            self._load_index()
+            active = self._active_name()
+            try:
+                size = os.path.getsize(self._path(active))
+            except OSError:
+                size = 0
+            if self._tail_stamp == (active, size) and (len(self._tail) >= n or self._tail_complete):
+                return list(self._tail)[-n:]
+            entries = self._read_tail(max(n, self._tail.maxlen))
+            self._tail.clear()
+            self._tail.extend(entries)
+            self._tail_complete = len(entries) < self._tail.maxlen
+            self._tail_stamp = (active, size)
+            return entries[-n:]
+
+    @instrument(STORAGE_SECONDS, "history.read", backend="history", op="read")
+    def _read_tail(self, n):
+        index = self._index
+        names = [s["name"] for s in index["sealed"]] + [self._active_name()]
+        collected = []
+        for name in reversed(names):
+            lines = self._read_last_lines(name, n - len(collected))
+            collected = lines + collected
+            if len(collected) >= n:
+                break
+        out = []
+        for line in collected:
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                continue
+        return out[-n:]
+
+    def read_since(self, start, hint=None, limit=None):
+        """
+        Messages written to disk from position `start` on (journaled ones are
+        not included until written), at most `limit` of them, as
+        ([(position, entry)], end, hint). Pass `hint` back with start=end to
+        continue from where this read stopped instead of rescanning the segment.
+        """
+        with self._lock, file_lock(self._index_path()):
+            index = self._load_index()
+            segments = [(s["name"], s["count"]) for s in index["sealed"]] + [(self._active_name(), None)]
+            out, first, position = [], 0, 0
+            for name, count in segments:
+                if count is not None and first + count <= start:
+                    first += count
+                    continue
+                offset, position = 0, first
+                if hint and hint[0] == name and hint[1] == first and hint[3] <= start:
+                    offset, position = hint[2], hint[3]
+                try:
+                    f = open(self._path(name), "rb")
+                except FileNotFoundError:
+                    f = None
+                if f is not None:
+                    with f:
+                        f.seek(offset)
+                        for line in f:
+                            if not line.endswith(b"\n"):
+                                break  # not completely written yet
+                            offset += len(line)
+                            if not line.strip():
+                                continue
+                            if position >= start:
+                                try:
+                                    out.append((position, json.loads(line)))
+                                except ValueError:
+                                    pass  # torn line; it still takes up its position
+                            position += 1
+                            if limit is not None and len(out) >= limit:
+                                break
+                hint = (name, first, offset, position)
+                if limit is not None and len(out) >= limit:
+                    break
+                if count is not None:
+                    first += count
+                    position = first
+            return out, position, hint
+
+    def _read_last_lines(self, name, n, block_size: int = 8192):
+        try:
+            f = open(self._path(name), "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            buf = b""
+            while pos > 0 and buf.count(b"\n") <= n:
+                step = min(block_size, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+        lines = [ln.decode("utf-8", errors="replace") for ln in buf.split(b"\n") if ln.strip()]
+        if pos > 0:
+            lines = lines[1:]  # first line may be cut in the middle
+        return lines[-n:] if n else []
+
+    # --- migration ---
+    def import_json_array(self, path, batch_size: int = 10000):
+        """
+        One-time import of the legacy chat_history.json array. The source file is
+        left in place. The array is parsed and appended in batches, never loaded
+        whole. The index records how far the import got, so one that stopped
+        partway resumes there when called again, and remembers the file once
+        every element is in, so it is never imported twice.
+        """
+        name = os.path.basename(path)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, file_lock(self._index_path()):
+            index = self._load_index()
+            if index.get("imported_from") or not os.path.exists(path):
+                return 0
+            progress = index.get("importing")
+            if not progress or progress.get("from") != name:
+                if len(self):
+                    # the log already has messages of its own: don't mix the legacy ones in
+                    index["imported_from"] = name
+                    self._save_index()
+                    return 0
+                progress = {"from": name, "done": 0}
+            start = done = progress["done"]
+            batch = []
+            try:
+                for i, item in enumerate(iter_json_array(path)):
+                    if i < start:
+                        continue
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        done = self._import_batch(name, batch, done, resumed=start > 0 and done == start)
+                        batch = []
+                if batch:
+                    done = self._import_batch(name, batch, done, resumed=start > 0 and done == start)
+            except Exception as e:
+                print(f"Could not import legacy history (stopped after {done} entries, will resume):", e)
+                return done - start
+            index = self._load_index()
+            index.pop("importing", None)
+            index["imported_from"] = name
+            self._save_index()
+            return done - start
+
+    def _import_batch(self, name, batch, done, resumed=False):
+        # a run that died between its append and the progress update left this batch in the log already
+        if not (resumed and self.tail(len(batch)) == batch):
+            self.append_many(batch)
+        done += len(batch)
+        self._load_index()["importing"] = {"from": name, "done": done}
+        self._save_index()
+        return done
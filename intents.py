@@ -0,0 +1,235 @@
+"""
+Local intent routing: greetings, thanks, goodbyes and simple requests for
+a breathing exercise, motivation or a wellness tip are answered instantly,
+without calling the AI.
+
+The classifier is a nearest-example model over the same hashed word and
+character n-gram vectors as the response cache. All example vectors sit in
+one inverted index (feature -> [(example, weight)]), so scoring a message
+against every intent is a single sparse matrix-vector product. A message is
+only routed when it is short, the best intent clearly beats the runner-up,
+and it carries no negation or distress words; everything else goes to the
+AI as before.
+"""
+import os
+import random
+import threading
+from typing import NamedTuple
+
+from response_cache import NEGATIONS, normalize, vectorize
+from storage import read_json
+from textproc import KeywordMatcher
+
+TIPS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wellness_tips.json")
+
+INTENT_EXAMPLES = {
+    "greeting": [
+        "hi", "hii", "hello", "hey", "hey there", "hi there", "hello there",
+        "good morning", "good afternoon", "good evening", "namaste", "yo", "sup",
+    ],
+    "thanks": [
+        "thanks", "thank you", "thank you so much", "thanks a lot", "thx", "ty", "many thanks",
+        "thanks so much", "that helped", "that was helpful", "appreciate it", "thank u",
+    ],
+    "goodbye": [
+        "bye", "goodbye", "bye bye", "see you", "see you later", "good night", "gotta go",
+        "talk later", "talk to you later", "ttyl", "goodnight", "bye for now", "ok bye", "see ya",
+    ],
+    "breathing": [
+        "give me a breathing exercise", "breathing exercise", "a breathing exercise please",
+        "help me breathe", "teach me to breathe", "how do i calm down", "help me calm down",
+        "calm me down", "help me relax", "i want to relax", "relaxation exercise", "relaxation tip",
+    ],
+    "motivation": [
+        "motivate me", "i need motivation", "need motivation", "give me motivation",
+        "say something motivating", "encourage me", "i need encouragement", "motivational quote",
+        "give me a motivational quote",
+    ],
+    "tip": [
+        "give me a tip", "tip", "tips", "wellness tip", "wellness tips", "any tips", "self care tip",
+        "share a tip", "give me a wellness tip",
+    ],
+}
+
+# politeness and filler that say nothing about the intent
+FILLER = {"please", "pls", "plz", "saathi", "so", "some", "any", "very", "really", "just", "now", "again",
+          "can", "you", "could", "would"}
+
+# never answered from the fast path, whatever the score
+GUARD_KEYWORDS = KeywordMatcher({
+    "distress": ["suicid", "kill", "die", "dying", "hurt myself", "self harm", "self-harm", "hopeless",
+                 "worthless", "panic", "crying", "abuse", "can't go on", "cant go on", "end it"],
+})
+
+
+class Routed(NamedTuple):
+    intent: str
+    score: float
+    reply: str
+    end_conversation: bool = False
+
+
+def intent_text(text):
+    """Normalized message without FILLER words (kept whole if that leaves nothing)."""
+    words = normalize(text).split()
+    kept = [w for w in words if w not in FILLER]
+    return " ".join(kept or words)
+
+
+class IntentClassifier:
+    """Nearest-example intent scores over hashed n-gram vectors."""
+
+    def __init__(self, examples=None):
+        examples = examples or INTENT_EXAMPLES
+        self.labels = list(examples)
+        self._example_label = []     # example index -> label index
+        self._index = {}             # feature -> [(example index, weight)]
+        for li, label in enumerate(self.labels):
+            for text in examples[label]:
+                ei = len(self._example_label)
+                self._example_label.append(li)
+                for feature, weight in vectorize(intent_text(text)).items():
+                    self._index.setdefault(feature, []).append((ei, weight))
+
+    def scores(self, text):
+        """{intent: cosine of the closest example} for one message."""
+        return self.scores_many([text])[0]
+
+    def scores_many(self, texts):
+        """Scores for a batch of messages; one pass over the index per message."""
+        out = []
+        n_examples = len(self._example_label)
+        for text in texts:
+            dots = [0.0] * n_examples
+            for feature, weight in vectorize(intent_text(text)).items():
+                for ei, w in self._index.get(feature, ()):
+                    dots[ei] += weight * w
+            best = [0.0] * len(self.labels)
+            for ei, dot in enumerate(dots):
+                li = self._example_label[ei]
+                if dot > best[li]:
+                    best[li] = dot
+            out.append(dict(zip(self.labels, best)))
+        return out
+
+
+class IntentRouter:
+    """
+    route(message) returns a Routed reply for a confident, harmless intent,
+    or None to let the AI answer. Decisions are counted (stats()) and, with
+    INTENT_LOG=1, printed one line each.
+    """
+
+    def __init__(self, classifier=None, tips=None, threshold: float = 0.75, margin: float = 0.15,
+                 max_words: int = 8, log: bool = False):
+        # built on first use (or by warmup()), not at import
+        self._classifier = classifier
+        self._tips = tips
+        self.threshold = threshold
+        self.margin = margin
+        self.max_words = max_words
+        self.log = log
+        self._lock = threading.Lock()
+        self.routed = {}      # intent -> count
+        self.fallbacks = 0
+
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            with self._lock:
+                if self._classifier is None:
+                    self._classifier = IntentClassifier()
+        return self._classifier
+
+    @property
+    def tips(self):
+        if self._tips is None:
+            self._tips = load_tips()
+        return self._tips
+
+    def warmup(self):
+        return self.classifier, self.tips
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        if env("INTENT_ROUTING", "1") == "0":
+            return cls(threshold=2.0)  # nothing scores above 1
+        return cls(
+            threshold=float(env("INTENT_THRESHOLD", "0.75")),
+            margin=float(env("INTENT_MARGIN", "0.15")),
+            log=env("INTENT_LOG", "0") == "1",
+        )
+
+    def classify(self, message):
+        """(intent, score, reason); intent is None when the message should go to the AI."""
+        normalized = normalize(message)
+        words = normalized.split()
+        if not words:
+            return None, 0.0, "empty"
+        if len(words) > self.max_words:
+            return None, 0.0, "long"
+        if NEGATIONS.intersection(words) or GUARD_KEYWORDS.first(normalized):
+            return None, 0.0, "guarded"
+        scores = self.classifier.scores(message)
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        (intent, score), runner_up = ranked[0], ranked[1][1] if len(ranked) > 1 else 0.0
+        if score < self.threshold:
+            return None, score, "low score"
+        if score - runner_up < self.margin:
+            return None, score, "ambiguous"
+        return intent, score, "routed"
+
+    def route(self, message):
+        intent, score, reason = self.classify(message)
+        with self._lock:
+            if intent:
+                self.routed[intent] = self.routed.get(intent, 0) + 1
+            else:
+                self.fallbacks += 1
+        if self.log:
+            print(f"Intent routing: {intent or 'ai'} ({reason}, score {score:.2f})")
+        if not intent:
+            return None
+        return Routed(intent, score, self.reply(intent), end_conversation=intent == "goodbye")
+
+    def reply(self, intent):
+        if intent == "greeting":
+            return "Hi! I'm Saathi, and I'm here to listen. How are you feeling today?"
+        if intent == "thanks":
+            return "You're very welcome — I'm glad I could help."
+        if intent == "goodbye":
+            return "Take care of yourself. I'm here whenever you want to talk."
+        if intent == "breathing":
+            text = ("Let's try box breathing: breathe in for 4 counts, hold for 4, breathe out for 4, "
+                    "and hold for 4. Repeat it four times.")
+            tip = self._tip("relaxation")
+            return f"{text} Afterwards: {tip}" if tip else text
+        if intent == "motivation":
+            tip = self._tip("motivation")
+            return f"{tip} One small step today is enough." if tip else "One small step today is enough."
+        tip = self._tip(random.choice(list(self.tips))) if self.tips else None
+        return f"Here's one to try: {tip}" if tip else "Try taking a short break and a few slow breaths."
+
+    def _tip(self, category):
+        tips = self.tips.get(category) or []
+        return random.choice(tips) if tips else None
+
+    def stats(self):
+        with self._lock:
+            routed = sum(self.routed.values())
+            total = routed + self.fallbacks
+            return {
+                "routed": dict(self.routed),
+                "fallbacks": self.fallbacks,
+                "routed_rate": round(routed / total, 3) if total else 0.0,
+            }
+
+
+def load_tips(path=TIPS_FILE):
+    try:
+        data = read_json(path, default={})
+    except Exception as e:
+        print("Could not load wellness tips:", e)
+        return {}
+    return {k: [t for t in v if isinstance(t, str)] for k, v in data.items() if isinstance(v, list)}
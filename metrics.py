@@ -0,0 +1,285 @@
+"""
+Process-local metrics (Prometheus text format) and optional request traces.
+
+    with metrics.timed(metrics.STORAGE_SECONDS, "storage.read", backend="json", op="read"):
+        ...
+
+timed() observes a latency histogram and, when the current request is being
+traced, records a span with the same name. Observing is a perf_counter call
+and a short locked update, cheap enough to leave on. Values are per worker
+process; /metrics reports the worker's pid alongside them.
+
+Tracing is off unless TRACE_FILE is set. Then a TRACE_SAMPLE fraction of
+requests (default all) append one JSON line each to that file: route,
+status, duration and the spans recorded while the request ran.
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for key, row in sorted(items):
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {row[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(row[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {row[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _add(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, help, labelnames, buckets=buckets)
+
+    def collector(self, fn):
+        """
+        Register fn() -> iterable of (name, kind, help, value) or
+        (name, kind, help, value, labels dict), read at scrape time.
+        Usable as a decorator.
+        """
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        seen = set()
+        for fn in collectors:
+            try:
+                samples = list(fn())
+            except Exception as e:
+                print("Metrics collector failed:", e)
+                continue
+            for name, kind, help, value, *rest in samples:
+                labels = rest[0] if rest else {}
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {name} {help}")
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Metrics used across the app ---
+HTTP_REQUESTS = REGISTRY.counter(
+    "saathi_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+HTTP_SECONDS = REGISTRY.histogram(
+    "saathi_http_request_duration_seconds", "Request latency, until the body was fully sent.", ("route", "method"))
+UPSTREAM_ATTEMPTS = REGISTRY.counter(
+    "saathi_upstream_attempts_total", "Perplexity API attempts by HTTP status (or error kind).", ("status",))
+UPSTREAM_RETRIES = REGISTRY.counter("saathi_upstream_retries_total", "Perplexity API attempts that were retried.")
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "saathi_upstream_attempt_duration_seconds", "Latency of one Perplexity API attempt (to response headers).",
+    ("status",))
+LLM_SECONDS = REGISTRY.histogram(
+    "saathi_llm_call_duration_seconds", "ask_perplexity/stream_perplexity latency, retries and queueing included.",
+    ("mode", "outcome"))
+FORMAT_SECONDS = REGISTRY.histogram(
+    "saathi_format_reply_duration_seconds", "format_reply latency.",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+STORAGE_SECONDS = REGISTRY.histogram(
+    "saathi_storage_duration_seconds", "Storage reads and writes by backend.", ("backend", "op"))
+SEARCH_SECONDS = REGISTRY.histogram(
+    "saathi_search_duration_seconds", "Search queries and index updates (refresh, merge).", ("op",))
+
+
+# --- Tracing ---
+_current = contextvars.ContextVar("saathi_trace", default=None)
+
+
+class Tracer:
+    def __init__(self, path=None, sample: float = 1.0):
+        self.path = path
+        self.sample = sample
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get("TRACE_FILE") or None, float(os.environ.get("TRACE_SAMPLE", "1")))
+
+    @property
+    def enabled(self):
+        return bool(self.path) and self.sample > 0
+
+    def start(self, name, **attrs):
+        """Begin a trace for this request; returns a token for finish(), or None when not sampled."""
+        if not self.enabled or (self.sample < 1 and random.random() >= self.sample):
+            return None
+        trace = {"trace_id": uuid.uuid4().hex, "name": name, "start": time.time(),
+                 "t0": time.perf_counter(), "attrs": attrs, "spans": []}
+        return trace, _current.set(trace)
+
+    def finish(self, token, **attrs):
+        if token is None:
+            return
+        trace, ctx_token = token
+        try:
+            _current.reset(ctx_token)
+        except ValueError:
+            _current.set(None)  # finished from another context (e.g. after a stream)
+        record = {
+            "trace_id": trace["trace_id"],
+            "name": trace["name"],
+            "start": trace["start"],
+            "duration_ms": round((time.perf_counter() - trace["t0"]) * 1000, 3),
+            **trace["attrs"], **attrs,
+            "spans": trace["spans"],
+            "pid": os.getpid(),
+        }
+        line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        try:
+            with self._lock:
+                # one O_APPEND write per trace: lines from several workers don't interleave
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+        except OSError as e:
+            print("Could not write trace:", e)
+
+
+tracer = Tracer.from_env()
+
+
+@contextmanager
+def timed(histogram, span=None, **labels):
+    """Observe the block's duration in `histogram`; also a span named `span` if tracing."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(histogram, start, span, **labels)
+
+
+def record(histogram, start, span=None, **labels):
+    """Observe the time since `start` (a perf_counter value), plus a span if tracing."""
+    end = time.perf_counter()
+    histogram.observe(end - start, **labels)
+    trace = _current.get()
+    if trace is not None:
+        trace["spans"].append({
+            "name": span or histogram.name,
+            "start_ms": round((start - trace["t0"]) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+            **labels,
+        })
+
+
+def instrument(histogram, span=None, **labels):
+    """Decorator form of timed()."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def timed_call(*args, **kwargs):
+            with timed(histogram, span, **labels):
+                return fn(*args, **kwargs)
+        return timed_call
+    return wrap
+
+
+def annotate(**attrs):
+    """Attach attributes to the current trace, if any."""
+    trace = _current.get()
+    if trace is not None:
+        trace["attrs"].update(attrs)
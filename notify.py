@@ -0,0 +1,192 @@
+"""
+Per-session push notifications across workers (time capsule deliveries,
+see /events).
+
+    notifier = Notifier.from_env(os.path.join(DATA_DIR, "notify"))
+    token = notifier.subscribe(sid, callback)    # callback(event, data), from a background thread
+    notifier.publish(sid, "delivered", {...})    # any worker
+    notifier.unsubscribe(token)
+
+A worker with subscribers binds a Unix datagram socket in the notify
+directory (<pid>.sock) and a listener thread hands incoming events to that
+session's callbacks. publish() calls the local callbacks directly and sends
+one datagram to every other socket in the directory, so an event reaches
+a connection on any worker without polling. Sends never block: a socket
+whose owner died is removed, and an event for a worker that isn't reading
+(full buffer) is dropped and counted. Events are hints: what was delivered
+is always in the stores, so a client refetches after reconnecting.
+Without AF_UNIX (Windows dev machines) only same-process subscribers hear
+an event.
+"""
+import atexit
+import itertools
+import json
+import os
+import socket
+import threading
+
+SOCKET_SUFFIX = ".sock"
+MAX_DATAGRAM = 64 * 1024
+
+
+class Notifier:
+    def __init__(self, directory, enabled: bool = True):
+        self.directory = directory
+        self.enabled = enabled
+        self._subscribers = {}  # sid -> {token: callback}
+        self._tokens = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._sock_pid = None
+        self._send_sock = None
+        self._send_pid = None
+        self.published = 0
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls, directory):
+        """NOTIFY_DIR overrides the socket directory; NOTIFY=0 turns cross-worker fan-out off."""
+        return cls(os.getenv("NOTIFY_DIR", directory), enabled=os.getenv("NOTIFY", "1") == "1")
+
+    # --- subscribers ---
+    def subscribe(self, sid, callback):
+        """Call `callback(event, data)` for every event of session `sid`; returns a token for unsubscribe()."""
+        with self._lock:
+            token = next(self._tokens)
+            self._subscribers.setdefault(sid, {})[token] = callback
+            self._listen()
+        return sid, token
+
+    def unsubscribe(self, token):
+        sid, n = token
+        with self._lock:
+            callbacks = self._subscribers.get(sid)
+            if callbacks is not None:
+                callbacks.pop(n, None)
+                if not callbacks:
+                    del self._subscribers[sid]
+
+    def _dispatch(self, sid, event, data):
+        with self._lock:
+            callbacks = list(self._subscribers.get(sid, {}).values())
+        for callback in callbacks:
+            try:
+                callback(event, data)
+            except Exception as e:
+                self.errors += 1
+                print("Notification callback failed:", e)
+
+    # --- publishing ---
+    def publish(self, sid, event, data=None):
+        """Tell every subscriber of `sid`, in this worker and the others, about `event`."""
+        self.published += 1
+        self._dispatch(sid, event, data)
+        if not self.enabled or not hasattr(socket, "AF_UNIX"):
+            return
+        payload = json.dumps({"sid": sid, "event": event, "data": data}, ensure_ascii=False).encode("utf-8")
+        if len(payload) > MAX_DATAGRAM:
+            # too big for one datagram: the client refetches instead
+            payload = json.dumps({"sid": sid, "event": event, "data": None}).encode("utf-8")
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return  # nobody has subscribed yet
+        own = self._own_path()
+        for name in names:
+            if not name.endswith(SOCKET_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            if path == own:
+                continue
+            try:
+                self._sender().sendto(payload, path)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # its worker is gone
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            except (BlockingIOError, OSError):
+                self.dropped += 1
+
+    def _sender(self):
+        # sockets don't cross a fork: each process opens its own
+        if self._send_pid != os.getpid():
+            self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._send_sock.setblocking(False)
+            self._send_pid = os.getpid()
+        return self._send_sock
+
+    # --- listening ---
+    def _own_path(self):
+        return os.path.join(self.directory, f"{os.getpid()}{SOCKET_SUFFIX}")
+
+    def _listen(self):
+        """Bind this worker's socket and start its listener thread, once per process (call with the lock)."""
+        if not self.enabled or not hasattr(socket, "AF_UNIX"):
+            return
+        pid = os.getpid()
+        if self._sock is not None and self._sock_pid == pid:
+            return
+        path = self._own_path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                os.remove(path)  # left by an earlier process with our pid
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+        except OSError as e:
+            print("Could not open the notification socket; pushes reach this worker's clients only:", e)
+            self.enabled = False
+            return
+        self._sock, self._sock_pid = sock, pid
+        atexit.register(self.close)
+        threading.Thread(target=self._run, args=(sock,), name="notify-listener", daemon=True).start()
+
+    def _run(self, sock):
+        while True:
+            try:
+                raw = sock.recv(MAX_DATAGRAM + 1024)
+                if not raw:
+                    return  # shut down by close()
+                message = json.loads(raw)
+                self.received += 1
+                self._dispatch(message["sid"], message["event"], message.get("data"))
+            except (ValueError, KeyError, TypeError):
+                self.errors += 1
+            except OSError as e:
+                print("Notification listener stopped:", e)
+                return
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None and self._sock_pid == os.getpid():
+            try:
+                os.remove(self._own_path())
+            except OSError:
+                pass
+            try:
+                sock.shutdown(socket.SHUT_RDWR)  # wakes the listener
+            except OSError:
+                pass
+            sock.close()
+
+    def stats(self):
+        with self._lock:
+            connections = sum(len(c) for c in self._subscribers.values())
+        return {
+            "subscribers": connections,
+            "sessions": len(self._subscribers),
+            "published": self.published,
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
@@ -0,0 +1,269 @@
+"""
+Admission control in front of the AI.
+
+- Coalescer: double-clicks and client retries send the same message twice.
+  The first request for a (session, message) key does the turn; duplicates
+  arriving while it runs, or within `linger` seconds after, get its result
+  instead of making their own upstream call and history append.
+- FairLimiter: a token bucket per session plus one global bucket for the
+  Perplexity quota. A session over its own rate waits (up to `max_wait`) for
+  its next token. When the global bucket runs dry, waiting requests queue
+  per session and tokens are handed out round-robin across sessions, so one
+  bursty student cannot starve everyone else. Past `max_wait` the request
+  fails with RateLimited.
+
+Both are per worker process; size the global rate per worker.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class RateLimited(Exception):
+    """No upstream token within the allowed wait."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+# --- Coalescing ---
+class Flight:
+    __slots__ = ("key", "event", "ok", "result", "done_at")
+
+    def __init__(self, key):
+        self.key = key
+        self.event = threading.Event()
+        self.ok = False
+        self.result = None
+        self.done_at = None
+
+
+class Coalescer:
+    """
+        leader, flight = coalescer.join(key)
+        if not leader:
+            return flight                   # a duplicate: this is the leader's result
+        try:
+            result = do_turn()
+            coalescer.resolve(flight, result)
+        finally:
+            coalescer.release(flight)       # no-op once resolved; lets waiters retry on failure
+    """
+
+    def __init__(self, linger: float = 2.0, timeout: float = 60.0):
+        self.linger = linger
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _expired(self, flight, now):
+        return flight.done_at is not None and now - flight.done_at > self.linger
+
+    def join(self, key):
+        """(True, flight) for the request that should do the work, (False, result) for a duplicate."""
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None or self._expired(flight, now):
+                    if len(self._flights) > 1024:
+                        for k in [k for k, f in self._flights.items() if self._expired(f, now)]:
+                            del self._flights[k]
+                    flight = self._flights[key] = Flight(key)
+                    self.leaders += 1
+                    return True, flight
+            if not flight.event.wait(self.timeout):
+                # the first request is stuck; go ahead uncoordinated
+                with self._lock:
+                    self.leaders += 1
+                return True, Flight(key)
+            if flight.ok:
+                with self._lock:
+                    self.coalesced += 1
+                return False, flight.result
+            # the first request failed: try again, one of the waiters becomes the leader
+
+    def resolve(self, flight, result):
+        with self._lock:
+            flight.ok, flight.result = True, result
+            flight.done_at = time.monotonic()
+        flight.event.set()
+
+    def release(self, flight):
+        with self._lock:
+            if flight.ok:
+                return
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.event.set()
+
+    def run(self, key, fn):
+        """fn() once per burst of identical keys; duplicates return its result."""
+        leader, flight = self.join(key)
+        if not leader:
+            return flight
+        try:
+            result = fn()
+            self.resolve(flight, result)
+            return result
+        finally:
+            self.release(flight)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+# --- Rate limiting ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now):
+        """Take a token if one is there."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self, now, max_wait):
+        """Reserve the next token; seconds until it is ours, or None if that exceeds `max_wait`."""
+        self._refill(now)
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def time_to_token(self, now):
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class FairLimiter:
+    """
+    `session_rate`/`global_rate` are tokens per second, `*_burst` the bucket
+    sizes; a rate of 0 disables that limit. acquire(sid) returns once the
+    request may call upstream, or raises RateLimited.
+    """
+
+    def __init__(self, session_rate: float = 0.5, session_burst: float = 5, global_rate: float = 5.0,
+                 global_burst: float = 10, max_wait: float = 10.0, max_sessions: int = 10000):
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.max_wait = max_wait
+        self.max_sessions = max_sessions
+        self._global = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self._sessions = OrderedDict()   # sid -> TokenBucket, least recently used first
+        self._waiting = {}               # sid -> deque of tickets waiting for a global token
+        self._order = deque()            # sids with waiting tickets, round-robin order
+        self._granted = set()
+        self._cond = threading.Condition()
+        self.granted = 0
+        self.queued = 0                  # requests that had to wait for a token
+        self.rejected = 0
+        self.max_queue = 0
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        return cls(
+            session_rate=float(env("RATE_LIMIT_SESSION_RATE", "0.5")),
+            session_burst=float(env("RATE_LIMIT_SESSION_BURST", "5")),
+            global_rate=float(env("RATE_LIMIT_GLOBAL_RATE", "5")),
+            global_burst=float(env("RATE_LIMIT_GLOBAL_BURST", "10")),
+            max_wait=float(env("RATE_LIMIT_MAX_WAIT", "10")),
+        )
+
+    def _session_bucket(self, sid):
+        bucket = self._sessions.get(sid)
+        if bucket is None:
+            bucket = self._sessions[sid] = TokenBucket(self.session_rate, self.session_burst)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(sid)
+        return bucket
+
+    def acquire(self, sid):
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            if self.session_rate > 0:
+                wait = self._session_bucket(sid).reserve(time.monotonic(), self.max_wait)
+                if wait is None:
+                    self.rejected += 1
+                    raise RateLimited(self._sessions[sid].time_to_token(time.monotonic()))
+                if wait > 0:
+                    self.queued += 1
+                    # this session's own pace; other sessions are not held up meanwhile
+                    end = time.monotonic() + wait
+                    while time.monotonic() < end:
+                        self._cond.wait(end - time.monotonic())
+            if self._global is None:
+                self.granted += 1
+                return
+            if not self._order and self._global.take(time.monotonic()):
+                self.granted += 1
+                return
+            self._wait_global(sid, deadline)
+
+    def _wait_global(self, sid, deadline):
+        ticket = object()
+        queue = self._waiting.setdefault(sid, deque())
+        queue.append(ticket)
+        if len(queue) == 1:
+            self._order.append(sid)
+        self.queued += 1
+        self.max_queue = max(self.max_queue, sum(len(q) for q in self._waiting.values()))
+        while True:
+            now = time.monotonic()
+            self._dispatch(now)
+            if ticket in self._granted:
+                self._granted.discard(ticket)
+                self.granted += 1
+                return
+            if now >= deadline:
+                queue.remove(ticket)
+                if not queue:
+                    del self._waiting[sid]
+                    self._order.remove(sid)
+                self.rejected += 1
+                raise RateLimited(self._global.time_to_token(now))
+            self._cond.wait(min(deadline - now, max(self._global.time_to_token(now), 0.001)))
+
+    def _dispatch(self, now):
+        """Hand available global tokens to the waiting sessions, one per session per round."""
+        granted = False
+        while self._order and self._global.take(now):
+            sid = self._order.popleft()
+            queue = self._waiting[sid]
+            self._granted.add(queue.popleft())
+            if queue:
+                self._order.append(sid)
+            else:
+                del self._waiting[sid]
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "granted": self.granted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "waiting": sum(len(q) for q in self._waiting.values()),
+                "max_queue": self.max_queue,
+            }
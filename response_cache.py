@@ -0,0 +1,262 @@
+"""
+Semantic cache for AI replies.
+
+Students send the same few messages over and over ("I am stressed about
+exams", "im stressed about my exams!!"). Each reply is cached under the
+normalized message plus a hash of the prompt context it was written for
+(see context_fingerprint), and a later message that is close enough (cosine
+similarity of hashed word and character n-gram vectors) reuses it instead of
+paying for another API call. Only a session's first turns, which carry no
+one's history, are shared between sessions.
+
+Lookups only compare entries with the same context fingerprint, and only
+the few that share the most keywords with the message (an inverted index)
+get a full cosine. Entries expire after `ttl` seconds and are evicted
+least-recently-used first once `max_entries` or `max_bytes` is exceeded.
+The cache is per worker process.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+CONTRACTIONS = [
+    (re.compile(r"\bcan't\b"), "cannot"),
+    (re.compile(r"\bwon't\b"), "will not"),
+    (re.compile(r"\bim\b"), "i am"),
+    (re.compile(r"n't\b"), " not"),
+    (re.compile(r"'re\b"), " are"),
+    (re.compile(r"'m\b"), " am"),
+    (re.compile(r"'ve\b"), " have"),
+    (re.compile(r"'ll\b"), " will"),
+    (re.compile(r"'d\b"), " would"),
+]
+NON_WORD_RE = re.compile(r"[^a-z0-9\s]+")
+SPACE_RE = re.compile(r"\s+")
+# a hit must agree on these, or "I am not okay" would reuse the reply to "I am okay"
+NEGATIONS = {"not", "no", "never", "nothing", "nobody", "cannot", "cant", "dont", "without"}
+STOPWORDS = {
+    "i", "me", "my", "am", "is", "are", "was", "a", "an", "the", "to", "of", "and", "or", "in", "on",
+    "for", "about", "it", "this", "that", "so", "really", "very", "just", "feel", "feeling", "im",
+    "you", "your", "be", "been", "with", "at", "do", "have", "has", "what", "how", "can",
+}
+
+
+def normalize(text):
+    """Lowercase, expand contractions, drop punctuation and extra spaces."""
+    text = (text or "").lower().replace("’", "'")
+    for pattern, repl in CONTRACTIONS:
+        text = pattern.sub(repl, text)
+    text = NON_WORD_RE.sub(" ", text)
+    return SPACE_RE.sub(" ", text).strip()
+
+
+def keywords(normalized):
+    return [w for w in normalized.split() if w not in STOPWORDS and w not in NEGATIONS]
+
+
+def vectorize(normalized, dims: int = 1 << 16):
+    """Sparse L2-normalized vector {feature: weight} of words, word pairs and char 3-grams."""
+    words = normalized.split()
+    features = {}
+
+    def add(token, weight):
+        h = zlib.crc32(token.encode("utf-8")) % dims
+        features[h] = features.get(h, 0.0) + weight
+
+    for w in words:
+        add("w:" + w, 0.5 if w in STOPWORDS else 2.0)
+        padded = f" {w} "
+        for i in range(len(padded) - 2):
+            add("c:" + padded[i:i + 3], 0.5)
+    for a, b in zip(words, words[1:]):
+        add(f"b:{a} {b}", 1.0)
+    norm = math.sqrt(sum(v * v for v in features.values())) or 1.0
+    return {k: v / norm for k, v in features.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+class _Entry:
+    __slots__ = ("key", "context", "normalized", "vector", "words", "negations", "reply", "expires", "size")
+
+    def __init__(self, key, context, normalized, vector, reply, expires):
+        self.key = key
+        self.context = context
+        self.normalized = normalized
+        self.vector = vector
+        self.words = set(keywords(normalized))
+        self.negations = NEGATIONS.intersection(normalized.split())
+        self.reply = reply
+        self.expires = expires
+        # rough footprint: strings + ~100 bytes per vector slot + bookkeeping
+        self.size = len(reply) + 2 * len(normalized) + 100 * len(vector) + 200
+
+
+class ResponseCache:
+    def __init__(self, threshold: float = 0.86, ttl: float = 6 * 3600, max_entries: int = 2000,
+                 max_bytes: int = 8 * 1024 * 1024, max_message_chars: int = 300, max_candidates: int = 32):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_message_chars = max_message_chars
+        self.max_candidates = max_candidates
+        self._entries = OrderedDict()   # (context, normalized) -> _Entry, least recently used first
+        self._postings = {}             # context -> {keyword: set of keys}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0                   # exact or near-duplicate
+        self.near_hits = 0              # the near-duplicate part of `hits`
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        if env("RESPONSE_CACHE", "1") == "0":
+            return cls(max_entries=0)
+        return cls(
+            threshold=float(env("RESPONSE_CACHE_THRESHOLD", "0.86")),
+            ttl=float(env("RESPONSE_CACHE_TTL", str(6 * 3600))),
+            max_entries=int(env("RESPONSE_CACHE_MAX_ENTRIES", "2000")),
+            max_bytes=int(env("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+        )
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def cacheable(self, message):
+        return self.enabled and 0 < len(message or "") <= self.max_message_chars
+
+    # --- lookups ---
+    def get(self, message, context=""):
+        """Cached reply for `message` in `context`, or None."""
+        if not self.cacheable(message):
+            return None
+        normalized = normalize(message)
+        if not normalized:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((context, normalized))
+            near = False
+            if entry is None or entry.expires <= now:
+                entry = self._nearest(context, normalized, now)
+                near = entry is not None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry.key)
+            self.hits += 1
+            self.near_hits += near
+            return entry.reply
+
+    def _nearest(self, context, normalized, now):
+        postings = self._postings.get(context)
+        if not postings:
+            return None
+        # anything above the threshold shares most keywords with the message, so
+        # only the entries with the biggest keyword overlap get a full cosine
+        overlap = Counter()
+        for word in set(keywords(normalized)):
+            overlap.update(postings.get(word, ()))
+        if not overlap:
+            return None
+        vector = vectorize(normalized)
+        negations = NEGATIONS.intersection(normalized.split())
+        best, best_score = None, self.threshold
+        for key, _ in overlap.most_common(self.max_candidates):
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry.expires <= now:
+                self._remove(entry)
+                self.expirations += 1
+                continue
+            if entry.negations != negations:
+                continue
+            score = cosine(vector, entry.vector)
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    # --- writes ---
+    def put(self, message, reply, context=""):
+        if not self.cacheable(message) or not reply:
+            return
+        normalized = normalize(message)
+        if not normalized:
+            return
+        key = (context, normalized)
+        entry = _Entry(key, context, normalized, vectorize(normalized), reply, time.monotonic() + self.ttl)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self._remove(old)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            postings = self._postings.setdefault(context, {})
+            for word in entry.words:
+                postings.setdefault(word, set()).add(key)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries.values())))
+                self.evictions += 1
+
+    def _remove(self, entry):
+        if self._entries.pop(entry.key, None) is None:
+            return
+        self._bytes -= entry.size
+        postings = self._postings.get(entry.context, {})
+        for word in entry.words:
+            keys = postings.get(word)
+            if keys is not None:
+                keys.discard(entry.key)
+                if not keys:
+                    del postings[word]
+        if not postings:
+            self._postings.pop(entry.context, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._postings.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def context_fingerprint(messages, owner=None):
+    """
+    Key for the conversation a reply was written in: a hash of the prompt
+    messages sent ahead of the student's new one (system content with its
+    instructions and summary, then the recent turns). With `owner` (a
+    session id) the key is that session's alone; pass it whenever the
+    conversation has any history, so only first turns are shared.
+    """
+    data = json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    digest = hashlib.sha1(data).hexdigest()[:16]
+    return f"{owner}|{digest}" if owner else digest
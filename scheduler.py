@@ -0,0 +1,184 @@
+"""
+Time capsule delivery scheduler.
+
+Pending messages sit in a min-heap keyed by their due time (UTC wall clock,
+see stores.scheduled_at). The delivery thread sleeps until the earliest one
+is due, so an idle minute costs nothing and a delivery run only touches the
+sessions that actually have something due.
+
+Creating or editing a message calls schedule(), which pushes onto the heap
+and wakes the thread. Other workers hear about it through a small
+append-only journal (data/schedule.jsonl): each schedule() appends one line,
+and every scheduler reads the lines it hasn't seen yet. Heap entries are
+only hints: the session's store decides what is really due, so stale
+entries (deleted or rescheduled messages) are dropped harmlessly.
+"""
+import heapq
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from stores import scheduled_at
+from storage import atomic_write_bytes, file_lock
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+
+class DeliveryScheduler:
+    """
+    `pending()` yields (session_id, message_id, scheduled_date) for every
+    undelivered message; it is only called to build the heap. `deliver(sid, now)`
+    delivers that session's due messages and returns them.
+    """
+
+    def __init__(self, deliver, pending, journal_path, journal_poll: float = 30.0,
+                 journal_max_bytes: int = 1024 * 1024):
+        self.deliver = deliver
+        self.pending = pending
+        self.journal_path = journal_path
+        self.journal_poll = journal_poll
+        self.journal_max_bytes = journal_max_bytes
+        self._heap = []
+        self._built = False
+        self._offset = 0
+        self._inode = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # --- scheduling ---
+    def schedule(self, sid, msg_id, scheduled_date):
+        """Note that `msg_id` of session `sid` is due at `scheduled_date`."""
+        due = scheduled_at(scheduled_date or "")
+        if due is None:
+            return
+        with self._cond:
+            if self._built:
+                heapq.heappush(self._heap, (due, sid, msg_id))
+            self._cond.notify()
+        self._journal_append({"sid": sid, "id": msg_id, "due": due.isoformat(), "pid": os.getpid()})
+
+    def _journal_append(self, entry):
+        os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+        # the lock keeps an append from landing in a journal that is being rotated
+        with file_lock(self.journal_path):
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (json.dumps(entry) + "\n").encode("utf-8"))
+            finally:
+                os.close(fd)
+
+    def _journal_stat(self):
+        try:
+            st = os.stat(self.journal_path)
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def _rebuild(self):
+        # stat first: lines written during the scan are read again, which is harmless
+        self._inode, size = self._journal_stat()
+        heap = []
+        for sid, msg_id, scheduled_date in self.pending():
+            due = scheduled_at(scheduled_date or "")
+            if due is not None:
+                heap.append((due, sid, msg_id))
+        heapq.heapify(heap)
+        self._heap, self._offset, self._built = heap, size, True
+
+    def _sync(self):
+        """Build the heap on first use, then pick up journal lines from other workers."""
+        if not self._built:
+            self._rebuild()
+            return
+        inode, size = self._journal_stat()
+        if inode == self._inode and size == self._offset:
+            return
+        if inode != self._inode or size < self._offset:
+            # rotated by another scheduler; every pending message is still in its store
+            self._rebuild()
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        # only whole lines; a torn last line is picked up next time
+        data = data[:data.rfind(b"\n") + 1]
+        self._offset += len(data)
+        pid = os.getpid()
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+                if entry.get("pid") != pid:
+                    heapq.heappush(self._heap, (datetime.fromisoformat(entry["due"]), entry["sid"], entry["id"]))
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def _compact_journal(self):
+        if self._offset < self.journal_max_bytes:
+            return
+        with file_lock(self.journal_path):
+            # lines appended since our last read would be lost with the old file:
+            # read them now, while nobody can append (or rotate it first)
+            self._sync()
+            if self._offset < self.journal_max_bytes:
+                return  # another scheduler rotated it
+            # a fresh inode tells the other schedulers to rebuild from the stores
+            atomic_write_bytes(self.journal_path, b"")
+            self._inode, self._offset = self._journal_stat()
+
+    # --- delivery ---
+    def next_due(self):
+        with self._cond:
+            self._sync()
+            return self._heap[0][0] if self._heap else None
+
+    def deliver_due(self, now=None):
+        """Deliver everything due at `now`; cost grows with the due messages only."""
+        now = now or utc_now()
+        wall = now.replace(tzinfo=None)
+        with self._cond:
+            self._sync()
+            due_sids = []
+            while self._heap and self._heap[0][0] <= wall:
+                _, sid, _ = heapq.heappop(self._heap)
+                if sid not in due_sids:
+                    due_sids.append(sid)
+            self._compact_journal()
+        delivered = []
+        for sid in due_sids:
+            try:
+                delivered += self.deliver(sid, now)
+            except Exception as e:
+                print("Time capsule delivery failed for a session:", e)
+                with self._cond:
+                    # try that session again a little later
+                    heapq.heappush(self._heap, (wall + timedelta(seconds=self.journal_poll), sid, None))
+        return delivered
+
+    # --- background thread ---
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return self._thread
+            self._thread = threading.Thread(target=self._run, name="time-capsule-scheduler", daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def _run(self):
+        while True:
+            try:
+                self.deliver_due()
+                with self._cond:
+                    self._sync()
+                    timeout = self.journal_poll
+                    if self._heap:
+                        until_due = (self._heap[0][0] - utc_now().replace(tzinfo=None)).total_seconds()
+                        timeout = max(0.0, min(timeout, until_due))
+                    # woken early by schedule() in this process
+                    self._cond.wait(timeout)
+            except Exception as e:
+                print("Time capsule scheduler error:", e)
+                with self._cond:
+                    self._cond.wait(self.journal_poll)
@@ -0,0 +1,754 @@
+"""
+Full-text search over one session's chat history, delivered time capsules
+included (/search).
+
+The index follows the history log (history_log.py) by position:
+
+    users/<sid>/history/            # the log
+    users/<sid>/search/
+        meta.json                   # segments + how many history positions they cover
+        six-000001.bin              # immutable index segments
+        six-000002.bin
+
+Messages past the last segment are kept in a small in-memory segment that
+is filled from the end of the log (HistoryLog.read_since) whenever the log
+is written (HistoryLog.on_write) or searched. Once `flush_docs` messages
+have collected, they are written as a new segment, and every `merge_factor`
+segments of the same size class are merged into one, so a session with n
+messages has O(log n) segments and each message is rewritten O(log n)
+times. Writes and merges hold the meta file's lock, so several workers can
+share one index; each worker notices a new meta.json with a stat.
+
+A segment file holds the documents (history position, timestamp, role,
+token count, text) and, per term, sorted document ids, term frequencies and
+varint-coded token positions. Segments are memory-mapped and only the term
+list is parsed up front, so a query reads just the postings of its terms.
+
+Queries are words (OR, ranked by BM25), "quoted phrases" (matched on the
+positions) and prefixes (sle*). Results can be filtered by role, source
+(chat or time_capsule) and date, and sorted by relevance or recency.
+"""
+import array
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+from datetime import datetime, timezone
+
+from metrics import SEARCH_SECONDS, instrument
+from response_cache import STOPWORDS, normalize
+from storage import atomic_write_json, file_lock
+
+SEGMENT_PREFIX = "six-"
+SEGMENT_SUFFIX = ".bin"
+META_NAME = "meta.json"
+MAGIC = b"SXIX"
+VERSION = 1
+# magic, version, docs, terms, docs table offset, text offset, text length, term list offset, term list length
+HEADER = struct.Struct("<4sIIIQQQQQ")
+HEADER_SIZE = 64
+
+ROLE_CODES = {"user": 1, "assistant": 2}
+ROLE_NAMES = {v: k for k, v in ROLE_CODES.items()}
+ROLE_MASK = 3
+TIME_CAPSULE = 4  # flag: a delivered time capsule message
+
+K1 = 1.2
+B = 0.75
+MAX_EXPANSIONS = 64  # terms a prefix may expand to, per segment
+MAX_HITS = 5000      # matching messages scored per query, newest first
+SNIPPET_CHARS = 160
+
+QUERY_RE = re.compile(r'"([^"]*)"?|(\S+)')
+
+
+def _segment_name(number: int) -> str:
+    return f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}"
+
+
+def tokens(text):
+    return normalize(text).split()
+
+
+def timestamp(value):
+    """Epoch seconds of an ISO date/time (naive means UTC), or 0."""
+    if not value:
+        return 0
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def document(position, entry):
+    """(position, ts, flags, text) of a history entry."""
+    meta = entry.get("meta") if isinstance(entry.get("meta"), dict) else {}
+    flags = ROLE_CODES.get(entry.get("role"), 0)
+    if meta.get("time_message_id"):
+        flags |= TIME_CAPSULE
+    ts = timestamp(entry.get("ts") or meta.get("delivered_at"))
+    return position, ts, flags, str(entry.get("content") or "")
+
+
+# --- varints (token positions) ---
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varints(buf, offset, count):
+    values, shift, n = [], 0, 0
+    while len(values) < count:
+        byte = buf[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(n)
+            n, shift = 0, 0
+    return values
+
+
+def _pad(out, align):
+    out.extend(b"\0" * (-len(out) % align))
+
+
+# --- segments ---
+def write_segment(path, docs, postings):
+    """
+    Write a segment file. `docs` holds the document columns: "positions" and
+    "ts" (array q), "lengths" (array I), "flags" (bytes), "text" (bytes) and
+    "text_offsets" (array Q, one more than documents). `postings` yields
+    (term, doc ids, term frequencies, position offsets, positions) in term
+    order, the first three as array I with ascending doc ids.
+    """
+    out = bytearray(HEADER_SIZE)
+    terms = []
+    dfs, offsets, pos_lengths = array.array("I"), array.array("I"), array.array("I")
+    for term, doc_ids, tfs, pos_offsets, positions in postings:
+        _pad(out, 4)
+        terms.append(term)
+        dfs.append(len(doc_ids))
+        offsets.append(len(out))
+        pos_lengths.append(len(positions))
+        out += doc_ids.tobytes()
+        out += tfs.tobytes()
+        out += pos_offsets.tobytes()
+        out += positions
+    _pad(out, 8)
+    docs_offset = len(out)
+    n = len(docs["positions"])
+    for column in ("positions", "ts", "text_offsets", "lengths"):
+        out += docs[column].tobytes()
+    out += docs["flags"]
+    text_offset = len(out)
+    out += docs["text"]
+    term_list = json.dumps(terms, ensure_ascii=False).encode("utf-8")
+    terms_offset = len(out)
+    out += term_list
+    _pad(out, 4)
+    out += dfs.tobytes() + offsets.tobytes() + pos_lengths.tobytes()
+    HEADER.pack_into(out, 0, MAGIC, VERSION, n, len(terms), docs_offset, text_offset, len(docs["text"]),
+                     terms_offset, len(term_list))
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(out)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def merge_segments(segments):
+    """(docs, postings) for write_segment: several Segments, in order, as one."""
+    docs = {"positions": array.array("q"), "ts": array.array("q"), "lengths": array.array("I"),
+            "flags": bytearray(), "text": bytearray(), "text_offsets": array.array("Q", [0])}
+    for seg in segments:
+        base = len(docs["text"])
+        docs["positions"].frombytes(seg.doc_positions.tobytes())
+        docs["ts"].frombytes(seg.ts.tobytes())
+        docs["lengths"].frombytes(seg.lengths.tobytes())
+        docs["flags"] += seg.flags
+        docs["text"] += seg.text
+        docs["text_offsets"].extend(o + base for o in seg.text_offsets[1:])
+    bases, base = [], 0
+    for seg in segments:
+        bases.append(base)
+        base += seg.n
+
+    def postings():
+        # terms in order across the segments; doc ids and position offsets rebased
+        for term in _unique(heapq.merge(*(seg.terms for seg in segments))):
+            doc_ids, tfs, pos_offsets, positions = array.array("I"), array.array("I"), array.array("I"), bytearray()
+            for seg, doc_base in zip(segments, bases):
+                raw = seg.raw_postings(term)
+                if raw is None:
+                    continue
+                seg_docs, seg_tfs, seg_offsets, seg_positions = raw
+                pos_base = len(positions)
+                if doc_base:
+                    doc_ids.extend(d + doc_base for d in seg_docs)
+                else:
+                    doc_ids.frombytes(seg_docs.tobytes())
+                if pos_base:
+                    pos_offsets.extend(o + pos_base for o in seg_offsets)
+                else:
+                    pos_offsets.frombytes(seg_offsets.tobytes())
+                tfs.frombytes(seg_tfs.tobytes())
+                positions += seg_positions
+            yield term, doc_ids, tfs, pos_offsets, positions
+
+    return docs, postings()
+
+
+def _unique(sorted_items):
+    previous = None
+    for item in sorted_items:
+        if item != previous:
+            yield item
+            previous = item
+
+
+class Segment:
+    """A memory-mapped segment file (read-only)."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self._mm)
+        (magic, version, n, n_terms, docs_offset, text_offset, text_length,
+         terms_offset, terms_length) = HEADER.unpack_from(mv, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a search segment")
+        self.mv = mv
+        self.n = n
+        o = docs_offset
+        self.doc_positions = mv[o:o + 8 * n].cast("q")
+        self.ts = mv[o + 8 * n:o + 16 * n].cast("q")
+        self.text_offsets = mv[o + 16 * n:o + 24 * n + 8].cast("Q")
+        o += 24 * n + 8
+        self.lengths = mv[o:o + 4 * n].cast("I")
+        self.flags = mv[o + 4 * n:o + 5 * n]
+        self.text = mv[text_offset:text_offset + text_length]
+        self.terms = json.loads(bytes(mv[terms_offset:terms_offset + terms_length]))
+        o = terms_offset + terms_length
+        o += -o % 4
+        self.dfs = mv[o:o + 4 * n_terms].cast("I")
+        self.offsets = mv[o + 4 * n_terms:o + 8 * n_terms].cast("I")
+        self.pos_lengths = mv[o + 8 * n_terms:o + 12 * n_terms].cast("I")
+        self.term_ids = {t: i for i, t in enumerate(self.terms)}
+        self.tokens = sum(self.lengths)
+
+    def postings(self, term):
+        """(doc ids, term frequencies) of `term`, or None."""
+        i = self.term_ids.get(term)
+        if i is None:
+            return None
+        df, o = self.dfs[i], self.offsets[i]
+        return self.mv[o:o + 4 * df].cast("I"), self.mv[o + 4 * df:o + 8 * df].cast("I")
+
+    def df(self, term):
+        i = self.term_ids.get(term)
+        return 0 if i is None else self.dfs[i]
+
+    def raw_postings(self, term):
+        """(doc ids, term frequencies, position offsets, positions) as stored, or None."""
+        i = self.term_ids.get(term)
+        if i is None:
+            return None
+        df, o = self.dfs[i], self.offsets[i]
+        return (self.mv[o:o + 4 * df].cast("I"), self.mv[o + 4 * df:o + 8 * df].cast("I"),
+                self.mv[o + 8 * df:o + 12 * df].cast("I"), self.mv[o + 12 * df:o + 12 * df + self.pos_lengths[i]])
+
+    def token_positions(self, term, k):
+        """Token positions of `term` in its k-th posting."""
+        i = self.term_ids[term]
+        df, o = self.dfs[i], self.offsets[i]
+        tf = self.mv[o + 4 * df:o + 8 * df].cast("I")[k]
+        start = o + 12 * df + self.mv[o + 8 * df:o + 12 * df].cast("I")[k]
+        deltas = _get_varints(self.mv, start, tf)
+        for j in range(1, len(deltas)):
+            deltas[j] += deltas[j - 1]
+        return deltas
+
+    def expand(self, prefix):
+        i = bisect.bisect_left(self.terms, prefix)
+        out = []
+        while i < len(self.terms) and self.terms[i].startswith(prefix) and len(out) < MAX_EXPANSIONS:
+            out.append(self.terms[i])
+            i += 1
+        return out
+
+    def doc_text(self, d):
+        return bytes(self.text[self.text_offsets[d]:self.text_offsets[d + 1]]).decode("utf-8", "replace")
+
+    def doc(self, d):
+        return self.doc_positions[d], self.ts[d], self.flags[d], self.doc_text(d), self.lengths[d]
+
+
+class MemorySegment:
+    """The messages after the last segment file, indexed in memory."""
+
+    def __init__(self, start=0, hint=None):
+        self.start = start  # history position the segment starts at
+        self.end = start    # history position after the last message read
+        self.hint = hint    # HistoryLog.read_since hint for `end`
+        self._docs = []
+        self._postings = {}  # term -> ([doc ids], [tfs], [[positions]])
+        self.tokens = 0
+
+    @property
+    def n(self):
+        return len(self._docs)
+
+    def add(self, position, ts, flags, text):
+        words = tokens(text)
+        d = len(self._docs)
+        self._docs.append((position, ts, flags, text, len(words)))
+        self.tokens += len(words)
+        seen = {}
+        for p, w in enumerate(words):
+            seen.setdefault(w, []).append(p)
+        for w, ps in seen.items():
+            doc_ids, tfs, positions = self._postings.setdefault(w, ([], [], []))
+            doc_ids.append(d)
+            tfs.append(len(ps))
+            positions.append(ps)
+
+    def postings(self, term):
+        p = self._postings.get(term)
+        return (p[0], p[1]) if p else None
+
+    def df(self, term):
+        p = self._postings.get(term)
+        return len(p[0]) if p else 0
+
+    def token_positions(self, term, k):
+        return self._postings[term][2][k]
+
+    def expand(self, prefix):
+        return [t for t in self._postings if t.startswith(prefix)][:MAX_EXPANSIONS]
+
+    def doc(self, d):
+        return self._docs[d]
+
+    def columns(self):
+        """(docs, postings) for write_segment."""
+        texts = [d[3].encode("utf-8") for d in self._docs]
+        text_offsets, total = array.array("Q", [0]), 0
+        for raw in texts:
+            total += len(raw)
+            text_offsets.append(total)
+        docs = {"positions": array.array("q", self.doc_positions), "ts": array.array("q", self.ts),
+                "lengths": array.array("I", self.lengths), "flags": bytes(self.flags),
+                "text": b"".join(texts), "text_offsets": text_offsets}
+
+        def postings():
+            for term in sorted(self._postings):
+                doc_ids, tfs, token_positions = self._postings[term]
+                pos_offsets, positions = array.array("I"), bytearray()
+                for ps in token_positions:
+                    pos_offsets.append(len(positions))
+                    previous = 0
+                    for p in ps:
+                        _put_varint(positions, p - previous)
+                        previous = p
+                yield term, array.array("I", doc_ids), array.array("I", tfs), pos_offsets, positions
+
+        return docs, postings()
+
+    @property
+    def doc_positions(self):
+        return [d[0] for d in self._docs]
+
+    @property
+    def lengths(self):
+        return [d[4] for d in self._docs]
+
+    @property
+    def ts(self):
+        return [d[1] for d in self._docs]
+
+    @property
+    def flags(self):
+        return [d[2] for d in self._docs]
+
+
+# --- queries ---
+def parse_query(query):
+    """[("term", t) | ("prefix", p) | ("phrase", [t, ...])]; stopwords dropped unless that leaves nothing."""
+    parts = []
+    for phrase, word in QUERY_RE.findall(query or ""):
+        if phrase:
+            words = tokens(phrase)
+            if len(words) > 1:
+                parts.append(("phrase", words))
+            elif words:
+                parts.append(("term", words[0]))
+        elif word.endswith("*") and len(word) > 1:
+            words = tokens(word[:-1])
+            parts.extend(("term", w) for w in words[:-1])
+            if words:
+                parts.append(("prefix", words[-1]))
+        else:
+            parts.extend(("term", w) for w in tokens(word))
+    kept = [p for p in parts if p[0] != "term" or p[1] not in STOPWORDS]
+    parts = kept or parts
+    # the same part twice adds nothing
+    unique = []
+    for p in parts:
+        if p not in unique:
+            unique.append(p)
+    return unique
+
+
+def _matches(seg, part, budget):
+    """{doc id: frequency} of one query part in one segment, at most the newest `budget` documents."""
+    kind, value = part
+    if kind == "term":
+        p = seg.postings(value)
+        return dict(zip(p[0][-budget:], p[1][-budget:])) if p else {}
+    if kind == "prefix":
+        out = {}
+        for term in seg.expand(value):
+            doc_ids, tfs = seg.postings(term)
+            for d, tf in zip(doc_ids[-budget:], tfs[-budget:]):
+                out[d] = out.get(d, 0) + tf
+        if len(out) > budget:
+            out = {d: out[d] for d in sorted(out)[-budget:]}
+        return out
+    # phrase: documents with every word, then consecutive positions
+    lists = []
+    for w in value:
+        p = seg.postings(w)
+        if not p:
+            return {}
+        lists.append((w, p[0]))
+    common = set(lists[0][1])
+    for _, doc_ids in lists[1:]:
+        common.intersection_update(doc_ids)
+    out = {}
+    for d in sorted(common, reverse=True):
+        starts = None
+        for offset, (w, doc_ids) in enumerate(lists):
+            k = bisect.bisect_left(doc_ids, d)
+            ps = {p - offset for p in seg.token_positions(w, k)}
+            starts = ps if starts is None else starts & ps
+            if not starts:
+                break
+        if starts:
+            out[d] = len(starts)
+            if len(out) >= budget:
+                break
+    return out
+
+
+def _df(seg, part):
+    """Documents of `seg` that may contain the part (phrases: its rarest word)."""
+    kind, value = part
+    if kind == "term":
+        return seg.df(value)
+    if kind == "prefix":
+        return sum(seg.df(t) for t in seg.expand(value))
+    return min(seg.df(w) for w in value)
+
+
+def _filter(seg, matches, role, capsule, lo, hi):
+    ts, flags = seg.ts, seg.flags
+    out = {}
+    for d, f in matches.items():
+        if role is not None and flags[d] & ROLE_MASK != role:
+            continue
+        if capsule is not None and bool(flags[d] & TIME_CAPSULE) != capsule:
+            continue
+        if (lo is not None or hi is not None) and not ts[d]:
+            continue  # no date recorded
+        if (lo is not None and ts[d] < lo) or (hi is not None and ts[d] >= hi):
+            continue
+        out[d] = f
+    return out
+
+
+def snippet(text, words):
+    lowered = text.lower()
+    hits = [i for i in (lowered.find(w) for w in words) if i >= 0]
+    if len(text) <= SNIPPET_CHARS:
+        return text
+    start = max(0, min(hits) - SNIPPET_CHARS // 4) if hits else 0
+    end = start + SNIPPET_CHARS
+    return ("…" if start else "") + text[start:end].strip() + ("…" if end < len(text) else "")
+
+
+class SearchIndex:
+    """
+        index = SearchIndex(os.path.join(user.directory, "search"), user.history)
+        user.history.on_write = index.note_write
+        index.search('sleep "exam stress" relax*', role="assistant", date_from="2026-01-01")
+    """
+
+    def __init__(self, directory, history, flush_docs: int = 256, merge_factor: int = 4):
+        self.directory = str(directory)
+        self.history = history
+        self.flush_docs = flush_docs
+        self.merge_factor = merge_factor
+        self._lock = threading.RLock()
+        self._meta = None
+        self._meta_mtime = None
+        self._segments = {}    # name -> Segment
+        self._memory = None    # MemorySegment, kept once this worker has searched
+        self._unindexed = 0    # messages written since the last refresh
+        self.searches = 0
+        self.segments_written = 0
+        self.merges = 0
+
+    # --- meta ---
+    def _meta_path(self):
+        return os.path.join(self.directory, META_NAME)
+
+    def _load_meta(self):
+        try:
+            mtime = os.stat(self._meta_path()).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._meta is not None and mtime == self._meta_mtime:
+            return self._meta
+        meta = {"covered": 0, "next": 1, "segments": []}
+        try:
+            with open(self._meta_path(), "r", encoding="utf-8") as f:
+                meta.update(json.load(f) or {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Could not read search index, rebuilding:", e)
+            meta = {"covered": 0, "next": meta.get("next", 1), "segments": []}
+        names = {s["name"] for s in meta["segments"]}
+        self._segments = {k: v for k, v in self._segments.items() if k in names}
+        self._meta = meta
+        self._meta_mtime = mtime
+        return meta
+
+    def _save_meta(self):
+        atomic_write_json(self._meta_path(), self._meta)
+        self._meta_mtime = os.stat(self._meta_path()).st_mtime_ns
+
+    def _segment(self, name):
+        seg = self._segments.get(name)
+        if seg is None:
+            seg = self._segments[name] = Segment(os.path.join(self.directory, name))
+        return seg
+
+    # --- updates ---
+    def note_write(self, entries):
+        """HistoryLog.on_write: index the new messages (or count them until there are enough)."""
+        with self._lock:
+            self._unindexed += len(entries)
+            if self._memory is not None or self._unindexed >= self.flush_docs:
+                self.refresh()
+
+    @instrument(SEARCH_SECONDS, "search.refresh", op="refresh")
+    def refresh(self):
+        """Catch up with the history log; writes a segment once `flush_docs` messages are unindexed."""
+        with self._lock:
+            keep = self._memory is not None
+            self._unindexed = 0
+            meta = self._load_meta()
+            memory = self._memory
+            if memory is None or memory.start != meta["covered"]:
+                memory = MemorySegment(meta["covered"])
+            # a long backlog (first search of an old history) is read and written in large chunks
+            batch = self.flush_docs * self.merge_factor ** 3
+            while True:
+                entries, end, hint = self.history.read_since(memory.end, memory.hint, limit=batch)
+                if end < memory.end:
+                    # the log is shorter than what was indexed: start over
+                    self._reset()
+                    return self.refresh()
+                for position, entry in entries:
+                    memory.add(*document(position, entry))
+                memory.end, memory.hint = end, hint
+                self._memory = memory
+                if memory.n >= self.flush_docs:
+                    self._flush()
+                    memory = self._memory
+                if len(entries) < batch:
+                    break
+            if not keep:
+                self._memory = None  # nobody searches here; don't hold the messages
+            return self._memory
+
+    def _flush(self):
+        memory = self._memory
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self._meta_path()):
+            meta = self._load_meta()
+            if meta["covered"] != memory.start:
+                # another worker indexed these first; read on from where it stopped
+                self._memory = MemorySegment(meta["covered"])
+                return
+            try:
+                entry = self._write(meta, memory)
+                meta["segments"].append(entry)
+                meta["covered"] = memory.end
+                removed = self._merge(meta)
+                self._save_meta()
+            except BaseException:
+                self._meta = None  # the cached copy was changed; read the file again
+                raise
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        self._memory = MemorySegment(memory.end, memory.hint)
+
+    def _write(self, meta, source):
+        """Write a MemorySegment, or merge a list of Segments, into a new segment file."""
+        docs, postings = source.columns() if isinstance(source, MemorySegment) else merge_segments(source)
+        name = _segment_name(meta["next"])
+        meta["next"] += 1
+        write_segment(os.path.join(self.directory, name), docs, postings)
+        self.segments_written += 1
+        ts = [t for t in docs["ts"] if t]
+        return {"name": name, "docs": len(docs["positions"]), "min_ts": min(ts, default=0),
+                "max_ts": max(ts, default=0)}
+
+    def _size_class(self, docs):
+        return int(math.log(max(docs / self.flush_docs, 1), self.merge_factor))
+
+    @instrument(SEARCH_SECONDS, "search.merge", op="merge")
+    def _merge(self, meta):
+        # merge the last `merge_factor` segments while they are the same size class
+        removed = []
+        segments = meta["segments"]
+        while len(segments) >= self.merge_factor:
+            tail = segments[-self.merge_factor:]
+            if len({self._size_class(s["docs"]) for s in tail}) != 1:
+                break
+            merged = self._write(meta, [self._segment(s["name"]) for s in tail])
+            removed.extend(s["name"] for s in tail)
+            segments[-self.merge_factor:] = [merged]
+            self.merges += 1
+        return removed
+
+    def _reset(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self._meta_path()):
+            meta = self._load_meta()
+            removed = [s["name"] for s in meta["segments"]]
+            meta.update(covered=0, segments=[])
+            self._save_meta()
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        self._segments = {}
+        self._memory = MemorySegment(0) if self._memory is not None else None
+
+    # --- queries ---
+    @instrument(SEARCH_SECONDS, "search.query", op="query")
+    def search(self, query, role=None, source=None, date_from=None, date_to=None,
+               sort="relevance", limit: int = 20):
+        """
+        {"total": matching messages, "total_exact": bool, "results": [...]}
+        for `query`, best first (or newest first with sort="recent").
+        date_from/date_to are YYYY-MM-DD, inclusive; messages saved before
+        timestamps were recorded have no date and never match a date filter.
+
+        Segments are read newest first and scoring stops after MAX_HITS
+        matching messages (with sort="recent", as soon as `limit` are found),
+        so a query for a word in most messages costs about as much as a rare
+        one. Results then come from the newest matches and "total" is a lower
+        bound ("total_exact": false). Term weights use the whole index's
+        document frequencies either way.
+        """
+        parts = parse_query(query)
+        if not parts:
+            return {"total": 0, "total_exact": True, "results": []}
+        lo = timestamp(date_from) if date_from else None
+        hi = timestamp(date_to) + 86400 if date_to else None
+        want_role = ROLE_CODES.get(role) if role else None
+        want_capsule = {"time_capsule": True, "chat": False}.get(source) if source else None
+        filtered = want_role is not None or want_capsule is not None or lo is not None or hi is not None
+        # turns still queued for write-behind aren't in the log yet: write them now
+        # (outside our lock, the log calls note_write back)
+        self.history.flush_pending()
+        with self._lock:
+            if self._memory is None:
+                self._memory = MemorySegment(self._load_meta()["covered"])
+            self.refresh()
+            self.searches += 1
+            # newest first: the in-memory segment, then the files from the last
+            segments = [(self._memory, None)] + [(self._segment(s["name"]), s)
+                                                  for s in reversed(self._meta["segments"])]
+            n_docs = sum(seg.n for seg, _ in segments)
+            avg_len = (sum(seg.tokens for seg, _ in segments) / n_docs if n_docs else 0) or 1.0
+            idfs = []
+            for part in parts:
+                df = sum(_df(seg, part) for seg, _ in segments)
+                idfs.append(math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) if df else 0.0)
+
+            hits, exact = [], True
+            for i, (seg, info) in enumerate(segments):
+                if len(hits) >= MAX_HITS or (sort == "recent" and len(hits) >= limit):
+                    exact = False
+                    break
+                if info is not None and ((lo is not None and info["max_ts"] < lo)
+                                         or (hi is not None and info["min_ts"] and info["min_ts"] >= hi)):
+                    continue  # nothing in this segment's date range
+                budget = MAX_HITS - len(hits)
+                per_part = [_matches(seg, part, budget) for part in parts]
+                if any(len(m) >= budget for m in per_part):
+                    exact = False
+                if filtered:
+                    per_part = [_filter(seg, m, want_role, want_capsule, lo, hi) for m in per_part]
+                # BM25
+                lengths, scores = seg.lengths, {}
+                for idf, matches in zip(idfs, per_part):
+                    for d, tf in matches.items():
+                        norm = K1 * (1 - B + B * lengths[d] / avg_len)
+                        scores[d] = scores.get(d, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+                if len(scores) > budget:
+                    # several parts each brought up to `budget` messages; keep the newest
+                    scores = {d: scores[d] for d in sorted(scores)[-budget:]}
+                positions = seg.doc_positions
+                hits.extend((score, positions[d], seg, d) for d, score in scores.items())
+            if sort == "recent":
+                top = heapq.nlargest(limit, hits, key=lambda h: h[1])
+            else:
+                top = heapq.nlargest(limit, hits, key=lambda h: (h[0], h[1]))
+            words = [w for kind, value in parts for w in (value if kind == "phrase" else [value])]
+            results = []
+            for score, position, seg, d in top:
+                _, ts_value, flag, text, _ = seg.doc(d)
+                results.append({
+                    "position": position,
+                    "role": ROLE_NAMES.get(flag & ROLE_MASK),
+                    "source": "time_capsule" if flag & TIME_CAPSULE else "chat",
+                    "ts": datetime.fromtimestamp(ts_value, timezone.utc).isoformat() if ts_value else None,
+                    "score": round(score, 4),
+                    "snippet": snippet(text, words),
+                })
+            return {"total": len(hits), "total_exact": exact, "results": results}
+
+    def stats(self):
+        with self._lock:
+            meta = self._meta or {"segments": [], "covered": 0}
+            return {
+                "segments": len(meta["segments"]),
+                "indexed": meta["covered"],
+                "in_memory": self._memory.n if self._memory is not None else 0,
+                "searches": self.searches,
+                "segments_written": self.segments_written,
+                "merges": self.merges,
+            }
@@ -0,0 +1,391 @@
+"""
+Per-user session state, sharded on disk.
+
+Each visitor gets a random session id (stored in the `saathi_sid` cookie) and
+their own directory:
+
+    data/users/<first 2 chars of id>/<id>/
+        user.json             # name + greeted flag (cached by ProfileStore)
+        planner.json          # STORAGE_BACKEND=json (default)
+        time_messages.json
+        history/              # HistoryLog segments
+        search/               # full-text index of the history (search_index.py)
+
+With STORAGE_BACKEND=sqlite, planner items and time capsule messages live in
+one shared database (SQLITE_PATH) instead, see stores.py.
+
+so writes for different users never touch the same file. Recently used
+sessions are kept in an LRU cache; evicting one only drops memory, since
+everything is already persisted.
+
+History appends and profile writes go through a per-worker write-behind
+queue (writebehind.py, journal in data/journal) unless WRITE_BEHIND=0.
+"""
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.cookies import CookieError, SimpleCookie
+
+import stores
+from context_builder import ContextWindow
+import writebehind
+from history_log import HistoryLog
+from search_index import SearchIndex
+from storage import CorruptFileError, JSONDocument, atomic_write_json, file_lock, read_json
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+SESSION_COOKIE = "saathi_sid"
+SESSION_MAX_AGE = 60 * 60 * 24 * 365
+# pre-sessions data (global files) is moved into a fresh random session on
+# first start; this file holds its id so the owner can claim it (see
+# migrate_legacy_files). Earlier versions used the fixed id below, which
+# anyone could send as a cookie.
+LEGACY_SESSION_FILE = os.path.join(DATA_DIR, "legacy_session")
+LEGACY_SESSION_ID = "legacy"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, "saathi.db"))
+
+# history and profile writes leave the request via a journal (None with WRITE_BEHIND=0)
+write_behind = writebehind.WriteBehind.from_env(os.path.join(DATA_DIR, "journal"))
+
+_SID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def valid_session_id(sid):
+    return bool(sid) and bool(_SID_RE.match(sid))
+
+
+def session_id_from_cookie_header(header):
+    """Session id from a raw Cookie header (for the ASGI mode), or None."""
+    cookie = SimpleCookie()
+    try:
+        cookie.load(header or "")
+    except CookieError:
+        return None
+    morsel = cookie.get(SESSION_COOKIE)
+    sid = morsel.value if morsel else None
+    return sid if valid_session_id(sid) else None
+
+
+def session_cookie_header(sid):
+    """Set-Cookie value matching what the Flask app sends."""
+    return f"{SESSION_COOKIE}={sid}; Max-Age={SESSION_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax"
+
+
+def users_root():
+    return os.path.join(DATA_DIR, "users")
+
+
+def user_dir(sid):
+    return os.path.join(users_root(), sid[:2], sid)
+
+
+def iter_session_ids():
+    """All session ids that have a directory on disk."""
+    root = users_root()
+    if not os.path.isdir(root):
+        return
+    for shard in sorted(os.listdir(root)):
+        shard_dir = os.path.join(root, shard)
+        if os.path.isdir(shard_dir):
+            for sid in sorted(os.listdir(shard_dir)):
+                if valid_session_id(sid):
+                    yield sid
+
+
+def database():
+    return stores.database(SQLITE_PATH)
+
+
+def pending_time_messages():
+    """(session id, message id, scheduled_date) of every undelivered time capsule message."""
+    if STORAGE_BACKEND == "sqlite":
+        yield from stores.pending_messages(database())
+        return
+    for sid in iter_session_ids():
+        path = os.path.join(user_dir(sid), "time_messages.json")
+        if not os.path.exists(path):
+            continue
+        try:
+            items = read_json(path, [])
+        except CorruptFileError as e:
+            print("Skipping unreadable time messages:", e)
+            continue
+        for it in items:
+            if isinstance(it, dict) and not it.get("delivered"):
+                yield sid, it.get("id"), it.get("scheduled_date")
+
+
+class UserState:
+    """Everything one visitor owns; planner and time capsule go through a stores.py store."""
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.directory = user_dir(sid)
+        self.profile_path = os.path.join(self.directory, "user.json")
+        self.planner_path = os.path.join(self.directory, "planner.json")
+        self.time_messages_path = os.path.join(self.directory, "time_messages.json")
+        # only the last few turns are ever read back, so keep the tail cache small
+        self.history = HistoryLog(os.path.join(self.directory, "history"), tail_cache_size=20,
+                                  write_behind=write_behind)
+        # full-text index of the history for /search, updated as messages reach the log
+        self.search = SearchIndex(os.path.join(self.directory, "search"), self.history)
+        self.history.on_write = self.search.note_write
+        self.profile = ProfileStore(self.profile_path, before_write=self.ensure_dir, write_behind=write_behind)
+        # recent turns + rolling summary the prompt is built from (context_builder.py)
+        self.context = ContextWindow()
+        if STORAGE_BACKEND == "sqlite":
+            self.planner = stores.SQLitePlanner(database(), sid)
+            self.time_messages = stores.SQLiteTimeMessages(database(), sid)
+        else:
+            # planner items stay in memory; a stat catches commits made by another worker
+            self.planner = stores.JSONPlanner(
+                JSONDocument(self.planner_path, default=[], before_write=self.ensure_dir))
+            self.time_messages = stores.JSONTimeMessages(
+                JSONDocument(self.time_messages_path, default=[], before_write=self.ensure_dir))
+
+    @property
+    def planner_items(self):
+        return self.planner.all()
+
+    def ensure_dir(self):
+        # created on first write, so cookie-less drive-by requests leave no trace
+        os.makedirs(self.directory, exist_ok=True)
+
+
+class ProfileStore:
+    """
+    user.json behind a write-through cache (a storage.JSONDocument).
+
+    The cached dict is trusted while the file's stat signature is unchanged,
+    so a warm read costs one stat and no parse; a commit from another worker
+    changes the signature and triggers a reload. Inside `with store.batch():`
+    updates are coalesced into a single write on exit.
+    """
+
+    def __init__(self, path, before_write=None, write_behind=None):
+        self.path = path
+        self.doc = JSONDocument(path, default={}, before_write=before_write)
+        self.write_behind = write_behind
+        self.writes = 0
+        self._ops = []  # ("replace" | "update", dict) not yet written, applied in order
+        self._journaled = 0  # how many of _ops the write-behind journal already has
+        self._batch_depth = 0
+        self._lock = threading.RLock()
+
+    def _stored(self):
+        try:
+            data = self.doc.data
+        except CorruptFileError as e:
+            print("Ignoring unreadable profile:", e)
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get(self) -> dict:
+        """Current profile; treat the returned dict as read-only."""
+        with self._lock:
+            if not self._ops:
+                return self._stored()
+            data = dict(self._stored())
+            self._apply(data)
+            return data
+
+    def replace(self, data: dict):
+        with self._lock:
+            self._ops = [("replace", dict(data))]
+            self._journaled = 0
+            self._changed()
+
+    def update(self, **changes):
+        with self._lock:
+            self._ops.append(("update", changes))
+            self._changed()
+
+    def _apply(self, data):
+        for kind, changes in self._ops:
+            if kind == "replace":
+                data.clear()
+            data.update(changes)
+
+    def _changed(self):
+        if not self._batch_depth:
+            self._submit()
+
+    def _submit(self):
+        if self.write_behind is None:
+            return self._flush()
+        ops = self._ops[self._journaled:]
+        if not ops:
+            return
+        try:
+            seq = self.write_behind.journal(self, {"kind": "profile", "path": self.path, "ops": ops})
+        except OSError as e:
+            print("Write-behind journal failed, writing through:", e)
+            return self._flush()
+        self._journaled = len(self._ops)
+        self.write_behind.sync(seq)
+
+    def flush_pending(self):
+        """Write the journaled ops (called by the write-behind thread)."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._ops:
+            return
+        try:
+            # re-applied to the latest data if another worker committed first
+            self.doc.update(self._apply)
+        except CorruptFileError:
+            # an unreadable profile holds nothing worth keeping; replace it
+            data = {}
+            self._apply(data)
+            with file_lock(self.path):
+                atomic_write_json(self.path, data)
+        self._ops = []
+        self._journaled = 0
+        self.writes += 1
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._submit()
+
+
+class SessionCache:
+    """Bounded LRU of UserState objects keyed by session id."""
+
+    def __init__(self, capacity: int = 512):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid) -> UserState:
+        with self._lock:
+            state = self._items.get(sid)
+            if state is not None:
+                self._items.move_to_end(sid)
+                return state
+        state = UserState(sid)
+        with self._lock:
+            # another thread may have loaded the same session meanwhile
+            state = self._items.setdefault(sid, state)
+            self._items.move_to_end(sid)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+        return state
+
+    def __len__(self):
+        return len(self._items)
+
+
+def migrate_legacy_files(history_file, history_dir, user_file, planner_file, time_messages_file):
+    """
+    Move data from the single-user layout into a new random session, once.
+    Source files are copied, not deleted. A shard left under the old fixed
+    LEGACY_SESSION_ID is renamed into the new session instead (with its
+    database rows). The session id is written to LEGACY_SESSION_FILE: set
+    it as the saathi_sid cookie to get that data back.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    sid = new_session_id()
+    try:
+        fd = os.open(LEGACY_SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # already migrated (or another worker is doing it); a history
+        # import that stopped partway picks up where it left off
+        with open(LEGACY_SESSION_FILE, "r") as f:
+            sid = f.read().strip()
+        if valid_session_id(sid) and os.path.isdir(os.path.join(user_dir(sid), "history")):
+            HistoryLog(os.path.join(user_dir(sid), "history")).import_json_array(history_file)
+        return
+    with os.fdopen(fd, "w") as f:
+        f.write(sid + "\n")
+    target = user_dir(sid)
+    old = user_dir(LEGACY_SESSION_ID)
+    if os.path.isdir(old):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(old, target)
+        if STORAGE_BACKEND == "sqlite":
+            stores.rename_user(database(), LEGACY_SESSION_ID, sid)
+        print(f"Moved the legacy session's data to a private session; its id is in {LEGACY_SESSION_FILE}")
+        return
+    sources = [p for p in (history_file, user_file, planner_file, time_messages_file) if os.path.exists(p)]
+    if not sources and not os.path.isdir(history_dir):
+        return
+    os.makedirs(target, exist_ok=True)
+    if os.path.isdir(history_dir):
+        shutil.copytree(history_dir, os.path.join(target, "history"))
+    HistoryLog(os.path.join(target, "history")).import_json_array(history_file)
+    for src, name in ((user_file, "user.json"), (planner_file, "planner.json"),
+                      (time_messages_file, "time_messages.json")):
+        if os.path.exists(src):
+            shutil.copyfile(src, os.path.join(target, name))
+    print(f"Moved the single-user data files to a private session; its id is in {LEGACY_SESSION_FILE}")
+
+
+def migrate_to_sqlite():
+    """
+    With STORAGE_BACKEND=sqlite, copy every session's JSON planner/time capsule
+    files in, once. A marker file next to the database records a complete pass,
+    so later starts skip walking every session directory; sqlite mode writes no
+    such JSON files, and running in json mode removes the marker again.
+    """
+    marker = SQLITE_PATH + ".migrated"
+    if STORAGE_BACKEND != "sqlite":
+        if os.path.exists(marker):
+            os.remove(marker)
+        return 0
+    if os.path.exists(marker) and os.path.exists(SQLITE_PATH):
+        return 0
+    users = ((sid, os.path.join(user_dir(sid), "planner.json"), os.path.join(user_dir(sid), "time_messages.json"))
+             for sid in iter_session_ids())
+    failed = []
+    migrated = stores.migrate_json_files(database(), users, failed)
+    if not failed:  # unreadable files are retried on the next start
+        with open(marker, "w") as f:
+            f.write(str(migrated) + "\n")
+    return migrated
+
+
+# --- Write-behind recovery ---
+def _replay_history(record):
+    log = HistoryLog(record["directory"])
+    entries = record["entries"]
+    # already written if the entries are at the end of the log (the checkpoint was lost)
+    tail = log.tail(len(entries) + 20)
+    for i in range(len(tail) - len(entries), -1, -1):
+        if tail[i:i + len(entries)] == entries:
+            return
+    log.append_many(entries)
+
+
+def _replay_profile(record):
+    path = record["path"]
+    store = ProfileStore(path, before_write=lambda: os.makedirs(os.path.dirname(path), exist_ok=True))
+    with store.batch():
+        for kind, changes in record["ops"]:
+            if kind == "replace":
+                store.replace(changes)
+            else:
+                store.update(**changes)
+
+
+def recover_write_behind():
+    """Apply writes journaled by workers that died before flushing them."""
+    return writebehind.recover(os.path.join(DATA_DIR, "journal"),
+                               {"history": _replay_history, "profile": _replay_profile})
@@ -0,0 +1,280 @@
+"""
+Multi-process-safe JSON file storage shared by every subsystem.
+
+- file_lock(): advisory lock on a `<file>.lock` sidecar (flock), which
+  excludes other gunicorn workers as well as other threads.
+- atomic_write_json(): write to a temp file in the same directory, fsync,
+  then rename over the target, so readers never see half-written JSON.
+- JSONDocument: optimistic versioning. The version is the file's stat
+  signature, which changes on every atomic commit (new inode), so the file
+  format itself stays plain JSON. Commits also compare a content digest,
+  which catches the rare case of a recycled inode with an identical stat.
+"""
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from metrics import STORAGE_SECONDS, instrument
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: fall back to in-process locking only
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held = threading.local()  # lock paths this thread holds -> depth
+
+
+class CorruptFileError(ValueError):
+    """The file exists but is not valid JSON; callers must not overwrite it blindly."""
+
+
+class VersionConflict(Exception):
+    """The file changed since it was read."""
+
+
+def _thread_lock(path):
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(path, threading.RLock())
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive advisory lock for `path`, across processes and threads. Re-entrant per thread."""
+    lock_path = os.path.abspath(path) + ".lock"
+    held = _held.__dict__.setdefault("paths", {})
+    with _thread_lock(lock_path):
+        if fcntl is None or lock_path in held:
+            # flock would deadlock against our own earlier descriptor
+            held[lock_path] = held.get(lock_path, 0) + 1
+            try:
+                yield
+            finally:
+                held[lock_path] -= 1
+                if not held[lock_path]:
+                    del held[lock_path]
+            return
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            held[lock_path] = 1
+            yield
+        finally:
+            held.pop(lock_path, None)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+@instrument(STORAGE_SECONDS, "storage.write", backend="file", op="write")
+def atomic_write_bytes(path, data: bytes):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write_json(path, data):
+    atomic_write_bytes(path, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+def signature(path):
+    """Version token for a file: (mtime_ns, size, inode), or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _digest(raw):
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+@instrument(STORAGE_SECONDS, "storage.read", backend="file", op="read")
+def _read_raw(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _parse(path, raw, default):
+    if raw is None or not raw.strip():
+        return copy.deepcopy(default)
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except ValueError as e:
+        raise CorruptFileError(f"{path}: {e}") from e
+
+
+def read_json(path, default=None):
+    """Parse `path`; `default` if missing or empty, CorruptFileError if unreadable."""
+    return _parse(path, _read_raw(path), default)
+
+
+def iter_json_array(path, chunk_size: int = 1 << 20):
+    """
+    Yield the items of the JSON array in `path` one at a time, reading it in
+    chunks, so a large file is never held in memory whole. Raises
+    CorruptFileError where the file stops being a valid array.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            return not eof
+
+        def next_char():
+            # first non-space character at or after pos (None at the end of the file)
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                if not fill():
+                    return None
+
+        if next_char() is None:
+            return  # empty file
+        if buf[pos] != "[":
+            raise CorruptFileError(f"{path}: not a JSON array")
+        pos += 1
+        first, count = True, 0
+        while True:
+            c = next_char()
+            if c == "]":
+                pos += 1
+                break
+            if not first:
+                if c != ",":
+                    raise CorruptFileError(f"{path}: expected ',' or ']' after item {count}")
+                pos += 1
+                next_char()
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError as e:
+                    if fill():
+                        continue  # the item runs past this chunk
+                    raise CorruptFileError(f"{path}: {e}") from e
+                j = end
+                while j < len(buf) and buf[j].isspace():
+                    j += 1
+                if not eof and (j == len(buf) or buf[j] not in ",]") and fill():
+                    continue  # not followed by ',' or ']' yet: a number can go on in the next chunk
+                break
+            pos = end
+            first = False
+            count += 1
+            yield item
+        if next_char() is not None:
+            raise CorruptFileError(f"{path}: data after the array")
+
+
+class JSONDocument:
+    """
+    One JSON file with a cached, versioned copy.
+
+        items, version = doc.load()
+        doc.commit(new_items, version)      # VersionConflict if someone else wrote
+        doc.update(lambda items: ...)       # read-modify-write, retried on conflict
+    """
+
+    def __init__(self, path, default=None, before_write=None):
+        self.path = path
+        self.default = default
+        self.before_write = before_write
+        self._data = None
+        self._version = None
+        self._digest = None
+        self.reads = 0  # actual file reads; cache hits cost only a stat
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Return (data, version). Data is cached until the file's signature changes."""
+        with self._lock:
+            version = signature(self.path)
+            if self._data is None or version != self._version:
+                raw = _read_raw(self.path)
+                self.reads += 1
+                self._data = _parse(self.path, raw, self.default)
+                if self._data is None:
+                    self._data = copy.deepcopy(self.default)
+                # version from before the read: if the file changed meanwhile we reload next time
+                self._version = version if raw is not None else None
+                self._digest = _digest(raw) if raw is not None else None
+            return self._data, self._version
+
+    @property
+    def data(self):
+        return self.load()[0]
+
+    @property
+    def version(self):
+        return self.load()[1]
+
+    def commit(self, data, expected_version):
+        """Atomically replace the file if it is still at `expected_version`."""
+        with self._lock, file_lock(self.path):
+            if signature(self.path) != expected_version:
+                raise VersionConflict(self.path)
+            if expected_version is not None and expected_version == self._version:
+                raw = _read_raw(self.path)
+                if raw is None or _digest(raw) != self._digest:
+                    raise VersionConflict(self.path)
+            if self.before_write:
+                self.before_write()
+            raw = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+            atomic_write_bytes(self.path, raw)
+            self._data = data
+            self._version = signature(self.path)
+            self._digest = _digest(raw)
+            return self._version
+
+    def update(self, fn, retries: int = 20):
+        """
+        Apply `fn` to a private copy of the data (mutating it in place) and
+        commit it, re-reading and retrying if another writer got there first.
+        Returns whatever `fn` returned.
+        """
+        for _ in range(retries):
+            data, version = self.load()
+            work = copy.deepcopy(data)
+            result = fn(work)
+            try:
+                self.commit(work, version)
+                return result
+            except VersionConflict:
+                continue
+        # heavy contention: do the read-modify-write under the lock instead
+        with self._lock, file_lock(self.path):
+            self._data = None
+            data, version = self.load()
+            work = copy.deepcopy(data)
+            result = fn(work)
+            self.commit(work, version)
+            return result
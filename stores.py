@@ -0,0 +1,676 @@
+"""
+Planner and time capsule stores.
+
+Both backends expose the same small interface, so the routes don't care
+which one is configured (STORAGE_BACKEND=json|sqlite, see sessions.py):
+
+    store.all()                  # list of item dicts, in insertion order
+    store.add(item)
+    store.edit(item_id, fn)      # fn(item) mutates and returns it, or None to skip
+    store.delete(item_id)
+    store.apply(ops)             # several of the above in one write, see apply()
+    store.iter_items()           # every item, in insertion order, without one big list
+    store.query(Query(...))      # one filtered, sorted page + the cursor of the next
+    store.version()              # (token, last modified) for ETag / Last-Modified
+    time_store.deliver_due(now)  # mark due messages delivered, return them
+
+JSON keeps one file per user on top of storage.JSONDocument. SQLite keeps
+every user in one WAL-mode database with indexes on id and on
+(delivered, due_at), so an edit or delete by id and the delivery scan no
+longer read and rewrite a whole list.
+"""
+import base64
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from metrics import STORAGE_SECONDS, instrument, timed
+from storage import CorruptFileError, read_json
+
+
+# --- Due dates ---
+def scheduled_at(value):
+    """Naive datetime for a scheduled_date (full ISO or YYYY-MM-DD), or None if unparsable."""
+    try:
+        scheduled = datetime.fromisoformat(value)
+    except Exception:
+        try:
+            # date-only fallback
+            scheduled = datetime.fromisoformat(value + "T00:00:00")
+        except Exception:
+            return None
+    # scheduled dates are compared as UTC wall-clock time
+    return scheduled.replace(tzinfo=None)
+
+
+def due_key(value):
+    """Sortable string for a datetime or scheduled_date; fixed width, so string order is time order."""
+    when = value if isinstance(value, datetime) else scheduled_at(value)
+    if when is None:
+        return None
+    return when.replace(tzinfo=None).isoformat(timespec="microseconds")
+
+
+def due_messages(items, now):
+    """Undelivered items whose scheduled_date is at or before `now` (UTC)."""
+    now_key = due_key(now)
+    due = []
+    for it in items:
+        if it.get("delivered"):
+            continue
+        key = due_key(it.get("scheduled_date") or "")
+        if key is not None and key <= now_key:
+            due.append(it)
+    return due
+
+
+# --- Listing ---
+class Query:
+    """
+    Parameters of one list request.
+
+    `flags` filters boolean fields ({"completed": False}); `date_from` and
+    `date_to` (YYYY-MM-DD, inclusive) filter the store's date field; `sort`
+    names one of the store's sorts, "-" for descending; `after` is a decoded
+    cursor; `limit` None means everything.
+    """
+
+    def __init__(self, flags=None, date_from=None, date_to=None, sort="created", after=None, limit=None):
+        self.flags = flags or {}
+        self.date_from = date_from
+        self.date_to = date_to
+        self.sort = sort
+        self.after = after
+        self.limit = limit
+
+
+def encode_cursor(key, item_ids):
+    """Opaque cursor: the sort key of a page's last item, plus the ids of its last few items."""
+    raw = json.dumps([list(key), list(item_ids)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(sort key, item ids) from a cursor; ValueError if it was tampered with."""
+    try:
+        key, item_ids = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(key, list) or not isinstance(item_ids, list):
+            raise ValueError
+        return tuple(key), item_ids
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+CURSOR_IDS = 5
+
+
+# a date range ends at the last moment of date_to: "2025-01-31T23:59" <= "2025-01-31~"
+DATE_TO_SUFFIX = "~"
+
+
+class ListingMixin:
+    """Sort / filter metadata shared by the two backends of one collection."""
+    date_field = None
+    flag_fields = ()
+    sorts = {"created": ()}  # name -> fields compared before the insertion position
+
+    def sort_spec(self, sort):
+        desc = sort.startswith("-")
+        return self.sorts[sort.lstrip("-")], desc
+
+
+# --- JSON backend ---
+class JSONListStore(ListingMixin):
+    """A list of items with an "id" key, kept in one storage.JSONDocument."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._sorted_for = None
+        self._sorted_cache = {}
+
+    def version(self):
+        version = self.doc.version
+        if version is None:
+            return "empty", None
+        mtime_ns, size, ino = version
+        return f"{mtime_ns}-{size}-{ino}", datetime.fromtimestamp(mtime_ns / 1e9, timezone.utc)
+
+    def _matches(self, it, q):
+        for field, wanted in q.flags.items():
+            if bool(it.get(field)) != wanted:
+                return False
+        if q.date_from or q.date_to:
+            value = str(it.get(self.date_field) or "")
+            if not value:
+                return False
+            if q.date_from and value < q.date_from:
+                return False
+            if q.date_to and value > q.date_to + DATE_TO_SUFFIX:
+                return False
+        return True
+
+    def _sorted(self, fields):
+        """(keys, items, positions) in ascending key order, cached until the list changes."""
+        items = self.all()
+        if self._sorted_for is not items:
+            # commits and reloads swap in a new list object, so identity is a safe version check
+            self._sorted_cache, self._sorted_for = {}, items
+        hit = self._sorted_cache.get(fields)
+        if hit is None:
+            keyed = sorted((tuple(str(it.get(f) or "") for f in fields) + (pos,), it)
+                           for pos, it in enumerate(items))
+            positions = {it.get("id"): pos for pos, it in enumerate(items)}
+            hit = self._sorted_cache[fields] = ([k for k, _ in keyed], [it for _, it in keyed], positions)
+        return hit
+
+    def query(self, q):
+        """Filtered, sorted page of items and the cursor of the next page (or None)."""
+        fields, desc = self.sort_spec(q.sort)
+        keys, items, positions = self._sorted(fields)
+        if q.after is None:
+            start = len(keys) - 1 if desc else 0
+        else:
+            after_key, after_ids = q.after
+            if len(after_key) != len(fields) + 1:
+                raise ValueError("invalid cursor")
+            # positions shift when earlier items are deleted: re-anchor on the
+            # newest item of the previous page that still exists
+            for n, item_id in enumerate(after_ids):
+                if item_id in positions:
+                    pos = positions[item_id]
+                    if n == 0:
+                        # the page's last item keeps its old sort values even if edited since
+                        after_key = tuple(after_key[:-1]) + (pos,)
+                    else:
+                        after_key = next(k for k in keys if k[-1] == pos)
+                    break
+            after_key = tuple(after_key)
+            start = bisect.bisect_left(keys, after_key) - 1 if desc else bisect.bisect_right(keys, after_key)
+        step = -1 if desc else 1
+        page, i = [], start
+        want = None if q.limit is None else q.limit + 1
+        while 0 <= i < len(items) and (want is None or len(page) < want):
+            if self._matches(items[i], q):
+                page.append(i)
+            i += step
+        next_cursor = None
+        if want is not None and len(page) > q.limit:
+            page = page[:q.limit]
+            next_cursor = encode_cursor(keys[page[-1]], [items[i].get("id") for i in reversed(page[-CURSOR_IDS:])])
+        return [items[i] for i in page], next_cursor
+
+    def all(self):
+        return self.doc.data
+
+    def add(self, item):
+        self.doc.update(lambda items: items.append(item))
+
+    def edit(self, item_id, fn):
+        def apply(items):
+            for it in items:
+                if it.get("id") == item_id:
+                    return fn(it)
+            return None
+        return self.doc.update(apply)
+
+    def delete(self, item_id):
+        def remove(items):
+            before = len(items)
+            items[:] = [i for i in items if i.get("id") != item_id]
+            return len(items) != before
+        return self.doc.update(remove)
+
+    def apply(self, ops):
+        """
+        Run ("add", item), ("edit", item_id, fn) and ("delete", item_id) ops in
+        order with one file write; returns what add/edit/delete would have,
+        one result per op.
+        """
+        def run(items):
+            by_id = {it.get("id"): it for it in items}
+            results, removed = [], set()
+            for op in ops:
+                if op[0] == "add":
+                    item = dict(op[1])
+                    items.append(item)
+                    by_id[item.get("id")] = item
+                    results.append(item)
+                elif op[0] == "edit":
+                    it = by_id.get(op[1])
+                    results.append(op[2](it) if it is not None else None)
+                else:
+                    it = by_id.pop(op[1], None)
+                    if it is not None:
+                        removed.add(op[1])
+                    results.append(it is not None)
+            if removed:
+                items[:] = [it for it in items if it.get("id") not in removed]
+            return results
+        return self.doc.update(run)
+
+    def iter_items(self):
+        # the document is cached whole anyway; commits swap in a new list, so this one stays as it was
+        return iter(self.all())
+
+
+class PlannerListing(ListingMixin):
+    date_field = "date"
+    flag_fields = ("completed",)
+    sorts = {"created": (), "date": ("date", "time")}
+
+
+class TimeMessageListing(ListingMixin):
+    date_field = "scheduled_date"
+    flag_fields = ("delivered",)
+    sorts = {"created": (), "scheduled_date": ("scheduled_date",)}
+
+
+class JSONPlanner(PlannerListing, JSONListStore):
+    pass
+
+
+class JSONTimeMessages(TimeMessageListing, JSONListStore):
+    def deliver_due(self, now):
+        # cheap check on the cached list first so an idle scan never rewrites the file
+        if not due_messages(self.all(), now):
+            return []
+
+        def mark_delivered(items):
+            due = due_messages(items, now)
+            for it in due:
+                it["delivered"] = True
+                it["delivered_at"] = now.isoformat()
+            return due
+
+        # the versioned update makes sure a message racing between workers is delivered once
+        return self.doc.update(mark_delivered)
+
+
+# --- SQLite backend ---
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS planner_items (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    title TEXT DEFAULT '',
+    date TEXT DEFAULT '',
+    time TEXT DEFAULT '',
+    notes TEXT DEFAULT '',
+    completed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS planner_items_user ON planner_items (user_id, seq);
+CREATE INDEX IF NOT EXISTS planner_items_date ON planner_items (user_id, date, time, seq);
+
+CREATE TABLE IF NOT EXISTS time_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    message TEXT DEFAULT '',
+    scheduled_date TEXT DEFAULT '',
+    due_at TEXT,
+    created_at TEXT,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    delivered_at TEXT
+);
+CREATE INDEX IF NOT EXISTS time_messages_user ON time_messages (user_id, seq);
+CREATE INDEX IF NOT EXISTS time_messages_due ON time_messages (delivered, due_at);
+CREATE INDEX IF NOT EXISTS time_messages_date ON time_messages (user_id, scheduled_date, seq);
+
+-- bumped by every write, so a list's ETag costs one lookup
+CREATE TABLE IF NOT EXISTS collection_versions (
+    user_id TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    modified_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, collection)
+);
+
+CREATE TABLE IF NOT EXISTS migrated_users (
+    user_id TEXT PRIMARY KEY,
+    migrated_at TEXT NOT NULL
+);
+"""
+
+
+class SQLiteDB:
+    """
+    One database file, one connection per thread per worker process.
+
+    Connections are opened lazily and reused for the life of the thread
+    (sqlite3 connections must not cross threads or a fork). WAL mode lets
+    readers run while a writer commits; writes use BEGIN IMMEDIATE so two
+    workers queue on the busy timeout instead of failing mid-transaction.
+    """
+
+    def __init__(self, path, busy_timeout: float = 10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._schema_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != pid:
+            conn = self._connect()
+            self._local.conn, self._local.pid = conn, pid
+        return conn
+
+    def _connect(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: a power cut can lose the last commits but never corrupts the file
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            if self._schema_pid != os.getpid():
+                conn.executescript(SCHEMA)
+                self._schema_pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.conn
+        with timed(STORAGE_SECONDS, "sqlite.transaction", backend="sqlite", op="write"):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @instrument(STORAGE_SECONDS, "sqlite.read", backend="sqlite", op="read")
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def database(path):
+    """Shared SQLiteDB for `path` (one per process)."""
+    with _databases_lock:
+        db = _databases.get(path)
+        if db is None:
+            db = _databases[path] = SQLiteDB(path)
+        return db
+
+
+class SQLiteStore:
+    table = None
+    columns = ()        # item keys, stored as-is
+    derived = ()        # extra indexed columns computed from the item
+    bool_columns = ()
+    text_columns = ()   # stored as '' rather than NULL, so they sort and compare simply
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+
+    def _item(self, row):
+        item = {c: row[c] for c in self.columns}
+        for c in self.bool_columns:
+            item[c] = bool(item[c])
+        return item
+
+    def _row(self, item):
+        row = []
+        for c in self.columns:
+            value = item.get(c)
+            if c in self.bool_columns:
+                value = bool(value)
+            elif value is None and c in self.text_columns:
+                value = ""
+            row.append(value)
+        return row
+
+    def _insert_sql(self, verb="INSERT"):
+        names = ("user_id",) + self.columns + self.derived
+        return f"{verb} INTO {self.table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+
+    def _touch(self, conn):
+        conn.execute(
+            "INSERT INTO collection_versions (user_id, collection, version, modified_at) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT (user_id, collection) DO UPDATE SET version = version + 1, modified_at = excluded.modified_at",
+            (self.user_id, self.table, datetime.now(timezone.utc).isoformat()))
+
+    def version(self):
+        row = self.db.execute("SELECT version, modified_at FROM collection_versions WHERE user_id = ? AND collection = ?",
+                              (self.user_id, self.table)).fetchone()
+        if row is None:
+            return "empty", None
+        return str(row["version"]), datetime.fromisoformat(row["modified_at"])
+
+    @instrument(STORAGE_SECONDS, "sqlite.read", backend="sqlite", op="read")
+    def _fetch(self, sql, params):
+        """Items from rows that start with self.columns, each with the rest of its row."""
+        # plain tuples + zip: much cheaper than sqlite3.Row lookups by name on big lists
+        cur = self.db.conn.cursor()
+        cur.row_factory = None
+        columns, n = self.columns, len(self.columns)
+        rows = [(dict(zip(columns, r)), r[n:]) for r in cur.execute(sql, params)]
+        for c in self.bool_columns:
+            for it, _ in rows:
+                it[c] = bool(it[c])
+        return rows
+
+    def all(self):
+        rows = self._fetch(f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE user_id = ? ORDER BY seq",
+                           (self.user_id,))
+        return [it for it, _ in rows]
+
+    def query(self, q):
+        """Filtered, sorted page of items and the cursor of the next page (or None)."""
+        fields, desc = self.sort_spec(q.sort)
+        order = list(fields) + ["seq"]
+        where, params = ["user_id = ?"], [self.user_id]
+        for field, wanted in q.flags.items():
+            where.append(f"{field} = ?")
+            params.append(int(wanted))
+        if q.date_from:
+            where.append(f"{self.date_field} >= ?")
+            params.append(q.date_from)
+        if q.date_to:
+            where.append(f"{self.date_field} <= ?")
+            params.append(q.date_to + DATE_TO_SUFFIX)
+            if not q.date_from:
+                where.append(f"{self.date_field} != ''")
+        if q.after is not None:
+            # seq never changes, so the stored key alone is a stable position
+            after_key, _ = q.after
+            if len(after_key) != len(order):
+                raise ValueError("invalid cursor")
+            where.append(f"({', '.join(order)}) {'<' if desc else '>'} ({', '.join('?' * len(order))})")
+            params.extend(after_key)
+        direction = " DESC" if desc else ""
+        sql = (f"SELECT {', '.join(self.columns + tuple(order))} FROM {self.table} "
+               f"WHERE {' AND '.join(where)} ORDER BY {', '.join(c + direction for c in order)}")
+        if q.limit is None:
+            return [it for it, _ in self._fetch(sql, params)], None
+        rows = self._fetch(sql + " LIMIT ?", params + [q.limit + 1])
+        next_cursor = None
+        if len(rows) > q.limit:
+            rows = rows[:q.limit]
+            next_cursor = encode_cursor(rows[-1][1], [rows[-1][0]["id"]])
+        return [it for it, _ in rows], next_cursor
+
+    ITER_BATCH = 500
+
+    def iter_items(self):
+        """Every item in insertion order, read ITER_BATCH rows at a time."""
+        sql = (f"SELECT {', '.join(self.columns)}, seq FROM {self.table} "
+               f"WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?")
+        last = 0
+        while True:
+            # short reads rather than one open cursor, so a slow download holds no read transaction
+            rows = self._fetch(sql, (self.user_id, last, self.ITER_BATCH))
+            for it, _ in rows:
+                yield it
+            if len(rows) < self.ITER_BATCH:
+                return
+            last = rows[-1][1][0]
+
+    def _add(self, conn, item):
+        conn.execute(self._insert_sql(), [self.user_id] + self._row(item))
+        return True
+
+    def _edit(self, conn, item_id, fn):
+        row = conn.execute(f"SELECT * FROM {self.table} WHERE id = ? AND user_id = ?",
+                           (item_id, self.user_id)).fetchone()
+        if row is None:
+            return None, False
+        item = self._item(row)
+        result = fn(item)
+        if result is None:
+            return None, False
+        assignments = ", ".join(f"{c} = ?" for c in self.columns + self.derived)
+        conn.execute(f"UPDATE {self.table} SET {assignments} WHERE seq = ?", self._row(item) + [row["seq"]])
+        return result, True
+
+    def _delete(self, conn, item_id):
+        cur = conn.execute(f"DELETE FROM {self.table} WHERE id = ? AND user_id = ?", (item_id, self.user_id))
+        return cur.rowcount > 0
+
+    def add(self, item):
+        with self.db.transaction() as conn:
+            self._add(conn, item)
+            self._touch(conn)
+
+    def edit(self, item_id, fn):
+        with self.db.transaction() as conn:
+            result, changed = self._edit(conn, item_id, fn)
+            if changed:
+                self._touch(conn)
+            return result
+
+    def delete(self, item_id):
+        with self.db.transaction() as conn:
+            deleted = self._delete(conn, item_id)
+            if deleted:
+                self._touch(conn)
+            return deleted
+
+    def apply(self, ops):
+        """Run ("add", item), ("edit", item_id, fn) and ("delete", item_id) ops in one transaction."""
+        results, changed = [], False
+        with self.db.transaction() as conn:
+            for op in ops:
+                if op[0] == "add":
+                    self._add(conn, op[1])
+                    result, op_changed = dict(op[1]), True
+                elif op[0] == "edit":
+                    result, op_changed = self._edit(conn, op[1], op[2])
+                else:
+                    result = op_changed = self._delete(conn, op[1])
+                results.append(result)
+                changed = changed or op_changed
+            if changed:
+                self._touch(conn)
+        return results
+
+
+class SQLitePlanner(PlannerListing, SQLiteStore):
+    table = "planner_items"
+    columns = ("id", "title", "date", "time", "notes", "completed")
+    bool_columns = ("completed",)
+    text_columns = ("title", "date", "time", "notes")
+
+
+class SQLiteTimeMessages(TimeMessageListing, SQLiteStore):
+    table = "time_messages"
+    columns = ("id", "message", "scheduled_date", "created_at", "delivered", "delivered_at")
+    derived = ("due_at",)
+    bool_columns = ("delivered",)
+    text_columns = ("message", "scheduled_date")
+
+    def _row(self, item):
+        # due_at is derived, so it can never disagree with scheduled_date
+        return super()._row(item) + [due_key(item.get("scheduled_date") or "")]
+
+    def deliver_due(self, now):
+        now_key = due_key(now)
+        query = (f"SELECT * FROM {self.table} WHERE user_id = ? AND delivered = 0 "
+                 f"AND due_at <= ? ORDER BY seq")
+        # read-only check first so an idle scan never takes the write lock
+        if self.db.execute(query + " LIMIT 1", (self.user_id, now_key)).fetchone() is None:
+            return []
+        delivered_at = now.isoformat()
+        with self.db.transaction() as conn:
+            rows = conn.execute(query, (self.user_id, now_key)).fetchall()
+            conn.executemany(f"UPDATE {self.table} SET delivered = 1, delivered_at = ? WHERE seq = ?",
+                             [(delivered_at, r["seq"]) for r in rows])
+            if rows:
+                self._touch(conn)
+        due = [self._item(r) for r in rows]
+        for it in due:
+            it["delivered"] = True
+            it["delivered_at"] = delivered_at
+        return due
+
+
+def pending_messages(db):
+    """(user_id, id, scheduled_date) of every undelivered message."""
+    rows = db.execute("SELECT user_id, id, scheduled_date FROM time_messages WHERE delivered = 0")
+    return [tuple(r) for r in rows]
+
+
+# --- Migration ---
+def migrate_json_files(db, users, failed=None):
+    """
+    Copy each user's planner.json / time_messages.json into the database, once.
+
+    `users` yields (user_id, planner_path, time_messages_path). Source files
+    are left in place; migrated_users remembers who is done, and ids are
+    inserted with OR IGNORE, so workers starting together can't duplicate rows.
+    Returns the number of users migrated; those whose files could not be read
+    are appended to `failed`, if given.
+    """
+    done = {r["user_id"] for r in db.execute("SELECT user_id FROM migrated_users")}
+    migrated = 0
+    for user_id, planner_path, time_messages_path in users:
+        if user_id in done:
+            continue
+        if not os.path.exists(planner_path) and not os.path.exists(time_messages_path):
+            continue
+        try:
+            planner_items = read_json(planner_path, [])
+            time_messages = read_json(time_messages_path, [])
+        except CorruptFileError as e:
+            # left unmarked, so it is retried once the file is fixed
+            print("Skipping migration of unreadable file:", e)
+            if failed is not None:
+                failed.append(user_id)
+            continue
+        planner = SQLitePlanner(db, user_id)
+        capsule = SQLiteTimeMessages(db, user_id)
+        with db.transaction() as conn:
+            if conn.execute("SELECT 1 FROM migrated_users WHERE user_id = ?", (user_id,)).fetchone():
+                continue
+            for store, items in ((planner, planner_items), (capsule, time_messages)):
+                conn.executemany(store._insert_sql("INSERT OR IGNORE"),
+                                 [[user_id] + store._row(it) for it in items
+                                  if isinstance(it, dict) and it.get("id")])
+                store._touch(conn)
+            conn.execute("INSERT INTO migrated_users (user_id, migrated_at) VALUES (?, ?)",
+                         (user_id, datetime.now().isoformat()))
+        migrated += 1
+    return migrated
+
+
+def rename_user(db, old, new):
+    """Move every row of user `old` to user `new` (which must have none). Returns the rows moved."""
+    moved = 0
+    with db.transaction() as conn:
+        for table in ("planner_items", "time_messages", "collection_versions", "migrated_users"):
+            moved += conn.execute(f"UPDATE {table} SET user_id = ? WHERE user_id = ?", (new, old)).rowcount
+    return moved
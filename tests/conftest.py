@@ -0,0 +1,148 @@
+"""
+The app is imported once per test run, from a scratch working directory, so
+its data files (data/, legacy migrations) never touch the repo checkout.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+WORKDIR = tempfile.mkdtemp(prefix="saathi-tests-")
+os.chdir(WORKDIR)
+os.environ.setdefault("DATA_DIR", os.path.join(WORKDIR, "data"))
+os.environ.setdefault("PERPLEXITY_API_KEY", "")
+# writes stay queued in the write-behind journal unless something flushes them
+os.environ.setdefault("WRITE_BEHIND_INTERVAL", "600")
+
+import pytest  # noqa: E402
+import requests  # noqa: E402
+
+
+class FakeUpstream:
+    """Stands in for the Perplexity client; every reply is `reply`."""
+
+    def __init__(self, breaker, reply="Try to get enough sleep before your exam. How are you?"):
+        self.breaker = breaker
+        self.reply = reply
+        self.calls = 0
+
+    def chat_completion(self, payload):
+        self.calls += 1
+        return {"choices": [{"message": {"content": self.reply}}]}
+
+    def stream_chat_completion(self, payload):
+        self.calls += 1
+        for word in self.reply.split(" "):
+            yield word + " "
+
+
+class FakeAsyncUpstream:
+    """FakeUpstream for asgi.py; `fail` makes every call raise a connection error."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    async def chat_completion(self, payload):
+        if self.fail:
+            raise OSError("connection refused")
+        return {"choices": [{"message": {"content": "Sleep well before the exam. How are you?"}}]}
+
+    async def stream_chat_completion(self, payload):
+        if self.fail:
+            raise OSError("connection refused")
+        yield "Sleep well. "
+        yield "How are you?"
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    import app
+    monkeypatch.setattr(app, "upstream", FakeUpstream(app.upstream.breaker))
+    monkeypatch.setattr(app, "PERPLEXITY_KEY", "test")
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+# --- gunicorn in a subprocess ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(fn, timeout=20):
+    """fn()'s first truthy value, retrying connection errors until `timeout`."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            value = fn()
+            if value:
+                return value
+        except (requests.RequestException, OSError, ValueError):
+            pass
+        time.sleep(0.1)
+    raise AssertionError("timed out")
+
+
+@contextlib.contextmanager
+def gunicorn(workdir, *args, app="app:app", **env):
+    """Serve the app with gunicorn.conf.py from `workdir`; yields the base URL once it answers."""
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPO, PERPLEXITY_API_KEY="", DATA_DIR=os.path.join(workdir, "data"), **env)
+    cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO, "gunicorn.conf.py"),
+           "-b", f"127.0.0.1:{port}", "--log-level", "warning", *args, app]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        wait_until(lambda: requests.get(base + "/metrics", timeout=5).ok)
+        yield base
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+# --- ASGI ---
+async def asgi_request(asgi_app, method, path, body=None, headers=()):
+    """One request through the ASGI app; returns (status, headers dict, body bytes)."""
+    sent = []
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b"",
+                 "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)  # the client stays connected
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(), "root_path": "",
+             "scheme": "http", "server": ("test", 80), "client": ("127.0.0.1", 1), "http_version": "1.1",
+             "headers": [(b"content-type", b"application/json")] + [(k.encode(), v.encode()) for k, v in headers]}
+    await asgi_app(scope, receive, send)
+    start = next(m for m in sent if m["type"] == "http.response.start")
+    response_headers = {k.decode(): v.decode() for k, v in start.get("headers", [])}
+    return start["status"], response_headers, b"".join(m.get("body", b"") for m in sent
+                                                        if m["type"] == "http.response.body")
+
+
+def call_asgi(asgi_app, path, body):
+    """POST `body` to `path`; returns (status, body bytes)."""
+    status, _, data = asyncio.run(asgi_request(asgi_app, "POST", path, body))
+    return status, data
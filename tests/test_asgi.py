@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import FakeAsyncUpstream, asgi_request
+from ratelimit import FairLimiter
+from sessions import SESSION_COOKIE
+
+
+@pytest.fixture
+def asgi(app_module, monkeypatch):
+    import asgi
+    monkeypatch.setattr(asgi, "upstream", FakeAsyncUpstream())
+    return asgi
+
+
+def request(asgi, method, path, body=None, sid=None):
+    headers = [("cookie", f"{SESSION_COOKIE}={sid}")] if sid else []
+    return asyncio.run(asgi_request(asgi.app, method, path, body, headers))
+
+
+def new_sid(headers):
+    cookie = headers["set-cookie"]
+    assert cookie.startswith(f"{SESSION_COOKIE}=")
+    return cookie.split(";", 1)[0].split("=", 1)[1]
+
+
+def test_chat_starts_a_session_and_saves_the_turn(asgi, app_module):
+    status, headers, body = request(asgi, "POST", "/chat", {"message": "revision is going badly"})
+    assert status == 200
+    assert "Sleep well before the exam." in json.loads(body)["reply"]
+    sid = new_sid(headers)
+    history = app_module.session_cache.get(sid).history.tail(2)
+    assert [e["content"] for e in history] == ["revision is going badly",
+                                               "Sleep well before the exam. How are you?"]
+
+    status, headers, _ = request(asgi, "POST", "/chat", {"message": "and I can't sleep"}, sid=sid)
+    assert status == 200 and "set-cookie" not in headers
+
+
+def test_chat_stream_sends_events(asgi):
+    status, headers, body = request(asgi, "POST", "/chat/stream", {"message": "I miss home a lot"})
+    assert status == 200
+    assert headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n")[0] for block in body.decode().strip().split("\n\n")]
+    assert events[0] == "event: delta" and events[-1] == "event: done"
+    assert "How are you?" in json.loads(body.decode().rsplit("data: ", 1)[1])["reply"]
+
+
+def test_other_routes_go_to_the_flask_app(asgi):
+    status, headers, body = request(asgi, "POST", "/planner_items", {"title": "Revise optics"})
+    assert status in (200, 201)
+    sid = new_sid(headers)
+    status, _, body = request(asgi, "GET", "/planner_items", sid=sid)
+    assert status == 200
+    assert [item["title"] for item in json.loads(body)] == ["Revise optics"]
+    status, _, _ = request(asgi, "GET", "/no-such-page")
+    assert status == 404
+
+
+def test_lifespan_closes_the_upstream_client(asgi, monkeypatch):
+    closed = []
+
+    async def aclose():
+        closed.append(True)
+
+    monkeypatch.setattr(asgi.upstream, "aclose", aclose, raising=False)
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(asgi.app({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert closed == [True]
+
+
+def test_rate_limited_turns_do_not_stall_bridged_requests(asgi, app_module, monkeypatch):
+    # every turn waits about a second for the global token
+    limiter = FairLimiter(session_rate=0, global_rate=1, global_burst=1, max_wait=5)
+    limiter.acquire("someone else")
+    monkeypatch.setattr(app_module, "upstream_limiter", limiter)
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(4))
+        turns = [asyncio.ensure_future(asgi_request(asgi.app, "POST", "/chat", {"message": f"turn {i} is hard"}))
+                 for i in range(8)]
+        await asyncio.sleep(0.3)  # all of them queued on the limiter
+        started = time.perf_counter()
+        status, _, _ = await asgi_request(asgi.app, "GET", "/planner_items")
+        took = time.perf_counter() - started
+        for t in turns:
+            t.cancel()
+        await asyncio.gather(*turns, return_exceptions=True)
+        return status, took
+
+    status, took = asyncio.run(run())
+    assert status == 200
+    assert took < 0.5
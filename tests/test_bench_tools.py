@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+import sessions
+from conftest import REPO
+from upstream import CircuitBreaker, UpstreamClient, UpstreamError
+
+sys.path.insert(0, os.path.join(REPO, "bench"))
+import datagen  # noqa: E402
+import fake_llm  # noqa: E402
+
+
+@pytest.fixture
+def llm():
+    servers = []
+
+    def start(**kwargs):
+        server, url = fake_llm.start_fake_llm(latency=0, chunk_delay=0, **kwargs)
+        servers.append(server)
+        return server, UpstreamClient(url, api_key="x", max_retries=0, breaker=CircuitBreaker())
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_fake_llm_speaks_the_upstream_api(llm):
+    server, client = llm()
+    payload = {"model": "sonar-pro", "messages": [{"role": "user", "content": "hi"}]}
+    assert client.chat_completion(payload)["choices"][0]["message"]["content"] == fake_llm.REPLY
+    assert "".join(client.stream_chat_completion(payload)) == fake_llm.REPLY
+    assert server.counters.snapshot() == {"requests": 2, "streams": 1, "errors": 0}
+
+
+def test_fake_llm_error_rate(llm):
+    server, client = llm(error_rate=1.0)
+    with pytest.raises(UpstreamError) as e:
+        client.chat_completion({"messages": []})
+    assert e.value.status_code == 503
+    assert server.counters.snapshot()["errors"] == 1
+
+
+def test_generated_data_loads_as_app_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, "DATA_DIR", str(tmp_path))
+    sids = datagen.generate(str(tmp_path), sessions=2, turns=30, planner=12, capsules=5, seed=3)
+    assert sids == datagen.generate(str(tmp_path / "again"), sessions=2, turns=30, planner=12, capsules=5, seed=3)
+    assert sorted(sessions.iter_session_ids()) == sorted(sids)
+    state = sessions.UserState(sids[0])
+    assert len(state.history.tail(100)) == 60
+    assert len(state.planner.all()) == 12 and len(state.time_messages.all()) == 5
+    assert state.profile.get() == {"name": "Bench"}
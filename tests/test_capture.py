@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+from capture import CaptureWriter, ChatCapture, sanitize
+from conftest import REPO
+
+
+@pytest.mark.parametrize("text", [
+    "my exam is on 2024-05-01",
+    "exam on 2024-05-01 10:30",
+    "from 2024-05-01 - 2024-06-01",
+    "results on 01/05/2024",
+])
+def test_dates_are_not_phone_numbers(text):
+    assert sanitize(text) == text
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("call me on +91 98765 43210", "call me on [phone]"),
+    ("my number is 415-555-0100.", "my number is [phone]."),
+    ("2024-05-01 9876543210", "2024-05-01 [phone]"),
+])
+def test_phone_numbers_are_replaced(text, expected):
+    assert sanitize(text) == expected
+
+
+def test_captured_turns_replay_to_the_same_html(client, app_module, tmp_path, monkeypatch):
+    sys.path.insert(0, os.path.join(REPO, "bench"))
+    import replay
+
+    path = tmp_path / "requests.jsonl"
+    writer = CaptureWriter(str(path))
+    monkeypatch.setattr(app_module, "chat_capture", ChatCapture(writer, salt="test"))
+    messages = ["my name is Kavya", "my phone is 98765 43210 and exams start 2024-05-01", "I can't sleep, Kavya here"]
+    for message in messages:
+        client.post("/chat", json={"message": message})
+    writer.flush()
+
+    text = path.read_text()
+    assert "Kavya" not in text and "98765" not in text and "2024-05-01" in text
+    sessions, skipped = replay.load_sessions([str(path)])
+    assert skipped == 0
+    (turns,) = sessions.values()
+    assert [t["path"] for t in turns] == ["local", "ai", "ai"]
+
+    replay_upstream = replay.ReplayUpstream()
+    monkeypatch.setattr(app_module, "upstream", replay_upstream)
+    results = replay.replay_session(app_module, replay_upstream, turns)
+    assert all(r["same_html"] for r in results)
+    assert replay_upstream.calls == 2 and replay_upstream.missing == 0
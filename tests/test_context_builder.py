@@ -0,0 +1,61 @@
+from context_builder import MESSAGE_OVERHEAD, ContextBuilder, ContextWindow, Turn, estimate_tokens
+
+
+class History:
+    def __init__(self):
+        self.entries = []
+
+    def tail(self, n):
+        return self.entries[-n:] if n else []
+
+    def turn(self, i):
+        self.entries += [{"role": "user", "content": f"Question {i}. " + "I worry about exams a lot. " * 6},
+                         {"role": "assistant", "content": f"Answer {i}. " + "Take short breaks and sleep. " * 6}]
+
+
+def prompt_tokens(messages):
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+def test_long_conversation_fits_the_budget_with_a_summary():
+    builder = ContextBuilder("You are Saathi.", budget=400, recent_messages=6)
+    history, window = History(), ContextWindow()
+    for i in range(30):
+        history.turn(i)
+        messages = builder.build(history, Turn(f"new message {i}", "Limit your reply."), window)
+        assert prompt_tokens(messages) <= 400
+        roles = [m["role"] for m in messages]
+        assert roles[0] == "system" and roles[-1] == "user"
+        assert all(a != b for a, b in zip(roles[1:], roles[2:]))  # alternating turns
+        assert roles[1:2] in (["user"], [])
+    system = messages[0]["content"]
+    assert "Limit your reply." in system
+    assert "Earlier in this conversation:" in system and "Student: Question" in system
+    assert "Answer 29." in messages[-2]["content"]
+    assert messages[-1] == {"role": "user", "content": "new message 29"}
+
+
+def test_incremental_build_matches_a_fresh_one():
+    builder = ContextBuilder("You are Saathi.", budget=600, recent_messages=6)
+    history, window = History(), ContextWindow()
+    for i in range(12):
+        history.turn(i)
+        builder.build(history, Turn("hello again"), window)
+    again = builder.build(history, Turn("hello again"), window)
+    fresh = ContextBuilder("You are Saathi.", budget=600, recent_messages=6).build(history, Turn("hello again"),
+                                                                                   ContextWindow())
+    assert again[1:] == fresh[1:]
+    stats = builder.stats()
+    assert stats["rebuilds"] == 1
+    assert stats["incremental"] == 11
+    assert stats["prefix_hits"] == 1
+
+
+def test_time_capsule_notes_go_to_the_summary():
+    builder = ContextBuilder("You are Saathi.")
+    history, window = History(), ContextWindow()
+    history.turn(0)
+    history.entries.append({"role": "assistant", "content": "[Time Capsule] You can do this!"})
+    messages = builder.build(history, Turn("thanks"), window)
+    assert all("[Time Capsule]" not in m["content"] for m in messages[1:])
+    assert "Time capsule delivered: You can do this!" in messages[0]["content"]
@@ -0,0 +1,55 @@
+import json
+import sys
+import tempfile
+
+import pytest
+import requests
+
+import sessions
+from conftest import gunicorn
+
+
+def read_events(response):
+    """(event, data) pairs of an open text/event-stream response."""
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[7:]
+        elif line.startswith("data: "):
+            yield event, line[6:]
+
+
+def test_single_threaded_servers_answer_204(client):
+    assert client.get("/events", environ_overrides={"wsgi.multithread": False}).status_code == 204
+
+
+def test_events_stream_this_sessions_deliveries(client, app_module):
+    client.get("/planner_items")  # sets the session cookie
+    sid = client.get_cookie(sessions.SESSION_COOKIE).value
+    r = client.get("/events", buffered=False, environ_overrides={"wsgi.multithread": True})
+    assert r.mimetype == "text/event-stream"
+    chunks = (chunk.decode() for chunk in r.response)
+    assert "event: ready" in next(chunks)
+    app_module.notifier.publish("someone-else", "delivered", {"ids": ["x"]})
+    app_module.notifier.publish(sid, "delivered", {"ids": ["m1"]})
+    event = next(chunks)
+    assert event.startswith("event: delivered\n") and json.loads(event.split("data: ")[1]) == {"ids": ["m1"]}
+    r.close()
+    assert app_module.notifier.stats()["subscribers"] == 0
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs gunicorn")
+def test_default_gunicorn_config_pushes_deliveries():
+    workdir = tempfile.mkdtemp(prefix="saathi-events-")
+    with gunicorn(workdir, "-w", "2", SSE_HEARTBEAT="1") as base:
+        with requests.Session() as s:
+            stream = s.get(base + "/events", stream=True, timeout=10)
+            assert stream.status_code == 200
+            events = read_events(stream)
+            assert next(events)[0] == "ready"
+            r = s.post(base + "/time_messages", json={"message": "well done", "scheduled_date": "2000-01-01"})
+            msg_id = r.json()["id"]
+            requests.post(base + "/run_deliveries", timeout=10).raise_for_status()
+            event, data = next(events)
+            assert event == "delivered" and msg_id in data
+            stream.close()
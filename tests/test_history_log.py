@@ -0,0 +1,47 @@
+import json
+
+from history_log import HistoryLog
+
+
+def write_array(path, items, tail=""):
+    path.write_text("[" + ",".join(json.dumps(i) for i in items) + tail)
+
+
+def messages(n, start=0):
+    return [{"role": "user", "content": f"message {i}"} for i in range(start, start + n)]
+
+
+def test_import_that_stops_partway_resumes(tmp_path):
+    source = tmp_path / "chat_history.json"
+    write_array(source, messages(25), ', {"role": "user", "cont')  # cut off mid-file
+    log = HistoryLog(str(tmp_path / "history"))
+    assert log.import_json_array(str(source), batch_size=10) == 20
+    assert log._load_index().get("imported_from") is None
+
+    write_array(source, messages(25) + messages(5, start=25), "]")  # the rest arrives
+    log = HistoryLog(str(tmp_path / "history"))
+    assert log.import_json_array(str(source), batch_size=10) == 10
+    assert [m["content"] for m in log.tail(100)] == [m["content"] for m in messages(30)]
+    assert log._load_index()["imported_from"] == "chat_history.json"
+    assert log.import_json_array(str(source), batch_size=10) == 0
+
+
+def test_resume_skips_a_batch_written_before_a_crash(tmp_path):
+    source = tmp_path / "chat_history.json"
+    write_array(source, messages(30), "]")
+    log = HistoryLog(str(tmp_path / "history"))
+    log.append_many(messages(20))  # two batches written ...
+    log._load_index()["importing"] = {"from": "chat_history.json", "done": 10}  # ... one recorded
+    log._save_index()
+
+    assert log.import_json_array(str(source), batch_size=10) == 20
+    assert [m["content"] for m in log.tail(100)] == [m["content"] for m in messages(30)]
+
+
+def test_tail_longer_than_the_cache_after_it_overflows(tmp_path):
+    log = HistoryLog(str(tmp_path / "history"), tail_cache_size=20)
+    log.append_many(messages(5))
+    assert len(log.tail(30)) == 5  # cache now holds the whole log
+    for i in range(30):
+        log.append(messages(1, start=5 + i)[0])
+    assert [m["content"] for m in log.tail(30)] == [m["content"] for m in messages(30, start=5)]
@@ -0,0 +1,46 @@
+import pytest
+
+from intents import IntentRouter
+
+
+@pytest.fixture
+def router():
+    return IntentRouter(tips={"relaxation": ["Stretch."], "motivation": ["You can do it."]})
+
+
+@pytest.mark.parametrize("message,intent", [
+    ("Hello!", "greeting"), ("hey there saathi", "greeting"), ("thank you so much", "thanks"),
+    ("ok bye", "goodbye"), ("can you give me a breathing exercise please", "breathing"),
+    ("motivate me", "motivation"), ("any tips?", "tip"),
+])
+def test_simple_requests_are_answered_locally(router, message, intent):
+    routed = router.route(message)
+    assert routed is not None and routed.intent == intent
+    assert routed.reply
+    assert routed.end_conversation == (intent == "goodbye")
+
+
+@pytest.mark.parametrize("message", [
+    "",
+    "I failed my exam and I don't know what to tell my parents",
+    "I don't want a breathing exercise",
+    "hello, I feel hopeless",
+    "bye, I want to die",
+    "what is the capital of France",
+])
+def test_everything_else_goes_to_the_ai(router, message):
+    assert router.route(message) is None
+
+
+def test_stats_and_disabled_routing(router, monkeypatch):
+    router.route("hi")
+    router.route("my roommate keeps me up all night")
+    assert router.stats() == {"routed": {"greeting": 1}, "fallbacks": 1, "routed_rate": 0.5}
+    monkeypatch.setenv("INTENT_ROUTING", "0")
+    assert IntentRouter.from_env().route("hi") is None
+
+
+def test_chat_answers_a_greeting_without_the_ai(client, app_module):
+    reply = client.post("/chat", json={"message": "hi there"}).get_json()["reply"]
+    assert "I'm Saathi" in reply
+    assert app_module.upstream.calls == 0
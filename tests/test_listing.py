@@ -0,0 +1,64 @@
+import pytest
+
+
+def add_items(client, *specs):
+    ids = []
+    for title, day in specs:
+        r = client.post("/planner_items", json={"title": title, "date": day})
+        ids.append(r.get_json()["id"])
+    return ids
+
+
+def test_cursor_pages_cover_the_list_once(client):
+    add_items(client, *((f"task {i}", f"2025-05-{10 - i:02d}") for i in range(7)))
+    seen, url = [], "/planner_items?sort=date&limit=3"
+    while True:
+        r = client.get(url)
+        page = r.get_json()
+        assert len(page) <= 3
+        seen += [it["title"] for it in page]
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            assert "Link" not in r.headers
+            break
+        assert 'rel="next"' in r.headers["Link"]
+        url = f"/planner_items?sort=date&limit=3&cursor={cursor}"
+    assert seen == [f"task {i}" for i in reversed(range(7))]
+
+
+def test_filters(client):
+    first, second, _ = add_items(client, ("April", "2025-04-30"), ("May", "2025-05-01"), ("June", "2025-06-01"))
+    client.patch(f"/planner_items/{second}", json={"completed": True})
+    titles = lambda url: [it["title"] for it in client.get(url).get_json()]
+    assert titles("/planner_items?completed=true") == ["May"]
+    assert titles("/planner_items?completed=false&sort=-date") == ["June", "April"]
+    assert titles("/planner_items?date_from=2025-05-01&date_to=2025-05-31") == ["May"]
+
+
+def test_etag_gives_304_until_the_list_changes(client):
+    add_items(client, ("Revise", "2025-05-01"))
+    r = client.get("/planner_items")
+    etag = r.headers["ETag"]
+    assert r.headers["Cache-Control"] == "private, no-cache"
+    assert client.get("/planner_items", headers={"If-None-Match": etag}).status_code == 304
+    # another query of the same list is another representation
+    assert client.get("/planner_items?limit=1", headers={"If-None-Match": etag}).status_code == 200
+    add_items(client, ("Sleep", "2025-05-02"))
+    r = client.get("/planner_items", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and len(r.get_json()) == 2
+
+
+def test_time_messages_pending_filter_and_304(client):
+    client.post("/time_messages", json={"message": "well done", "scheduled_date": "2001-01-01"})
+    client.post("/time_messages", json={"message": "later", "scheduled_date": "2100-01-01"})
+    client.post("/run_deliveries")
+    r = client.get("/time_messages?q=pending")
+    assert [m["message"] for m in r.get_json()] == ["later"]
+    assert client.get("/time_messages?q=pending", headers={"If-None-Match": r.headers["ETag"]}).status_code == 304
+
+
+@pytest.mark.parametrize("query", ["completed=maybe", "sort=title", "date_from=May", "limit=x", "cursor=zz"])
+def test_malformed_queries_are_rejected(client, query):
+    r = client.get(f"/planner_items?{query}")
+    assert r.status_code == 400
+    assert "error" in r.get_json()
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from conftest import FakeAsyncUpstream, call_asgi
+import metrics
+from metrics import LLM_SECONDS
+
+
+def llm_count(mode, outcome):
+    row = LLM_SECONDS._values.get((mode, outcome))
+    return row[-1] if row else 0
+
+
+def test_wsgi_chat_records_llm_latency(client):
+    before = llm_count("complete", "ok"), llm_count("stream", "ok")
+    client.post("/chat", json={"message": "exams are stressing me out"})
+    client.post("/chat/stream", json={"message": "my friends ignore me"}).get_data()
+    assert (llm_count("complete", "ok"), llm_count("stream", "ok")) == (before[0] + 1, before[1] + 1)
+
+
+@pytest.mark.parametrize("fail,outcome", [(False, "ok"), (True, "offline")])
+def test_asgi_chat_records_llm_latency(app_module, monkeypatch, fail, outcome):
+    import asgi
+    monkeypatch.setattr(asgi, "upstream", FakeAsyncUpstream(fail))
+    before = llm_count("complete", outcome), llm_count("stream", outcome)
+
+    status, _ = call_asgi(asgi.app, "/chat", {"message": f"I can't focus on revision ({outcome})"})
+    assert status == 200
+    status, _ = call_asgi(asgi.app, "/chat/stream", {"message": f"I feel lonely at college ({outcome})"})
+    assert status == 200
+    assert (llm_count("complete", outcome), llm_count("stream", outcome)) == (before[0] + 1, before[1] + 1)
+
+
+def test_metrics_route_exposes_request_counts(client, monkeypatch):
+    client.get("/planner_items?limit=1").close()  # counted once the body is sent
+    body = client.get("/metrics").get_data(as_text=True)
+    assert "# TYPE saathi_http_requests_total counter" in body
+    assert 'saathi_http_requests_total{route="/planner_items",method="GET",status="200"}' in body
+    assert 'saathi_http_request_duration_seconds_bucket{route="/planner_items",method="GET",le="+Inf"}' in body
+    assert "saathi_sessions_cached " in body and "saathi_rate_limit_granted " in body
+
+    monkeypatch.setenv("METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = metrics.Registry()
+    h = registry.histogram("t_seconds", "Test.", ("op",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        h.observe(value, op="read")
+    lines = registry.render().splitlines()
+    assert 't_seconds_bucket{op="read",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{op="read",le="1.0"} 3' in lines
+    assert 't_seconds_bucket{op="read",le="+Inf"} 4' in lines
+    assert 't_seconds_count{op="read"} 4' in lines
+
+
+def test_traces_are_written_with_spans(client, tmp_path, monkeypatch):
+    path = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(metrics, "tracer", metrics.Tracer(str(path)))
+    client.post("/planner_items", json={"title": "Revise"}).close()
+    record = json.loads(path.read_text().splitlines()[-1])
+    assert record["name"] == "POST /planner_items" and record["status"] == 201
+    assert any(span["name"].startswith("storage.") for span in record["spans"])
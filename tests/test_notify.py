@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import socket
+
+import pytest
+
+from notify import Notifier
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+
+
+def test_local_subscribers_by_session(tmp_path):
+    notifier, heard = Notifier(str(tmp_path)), []
+    token = notifier.subscribe("a", lambda event, data: heard.append((event, data)))
+    notifier.publish("a", "delivered", {"ids": [1]})
+    notifier.publish("b", "delivered", {"ids": [2]})
+    notifier.unsubscribe(token)
+    notifier.publish("a", "delivered", {"ids": [3]})
+    assert heard == [("delivered", {"ids": [1]})]
+    assert notifier.stats()["subscribers"] == 0 and notifier.stats()["sent"] == 0  # no other workers
+    notifier.close()
+
+
+def other_worker(directory, ready, heard, stop):
+    notifier = Notifier(directory)
+    notifier.subscribe("a", lambda event, data: heard.put((event, data)))
+    ready.set()
+    stop.wait(10)
+    notifier.close()
+
+
+def test_events_reach_subscribers_in_other_workers(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    ready, heard, stop = ctx.Event(), ctx.Queue(), ctx.Event()
+    worker = ctx.Process(target=other_worker, args=(str(tmp_path), ready, heard, stop))
+    worker.start()
+    try:
+        assert ready.wait(10)
+        notifier = Notifier(str(tmp_path))
+        notifier.publish("a", "delivered", {"ids": ["m1"]})
+        assert heard.get(timeout=10) == ("delivered", {"ids": ["m1"]})
+        assert notifier.stats()["sent"] == 1
+    finally:
+        stop.set()
+        worker.join(10)
+
+
+def test_a_dead_workers_socket_is_removed(tmp_path):
+    stale = tmp_path / "999999999.sock"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(str(stale))
+    sock.close()  # bound and abandoned, as by a killed worker
+    notifier = Notifier(str(tmp_path))
+    notifier.publish("a", "delivered")
+    assert os.listdir(tmp_path) == []
+
+
+def test_disabled_fan_out_stays_in_process(tmp_path, monkeypatch):
+    monkeypatch.setenv("NOTIFY", "0")
+    notifier = Notifier.from_env(str(tmp_path / "notify"))
+    notifier.subscribe("a", lambda event, data: None)
+    notifier.publish("a", "delivered")
+    assert not (tmp_path / "notify").exists()
+    assert notifier.stats()["published"] == 1
@@ -0,0 +1,81 @@
+import pytest
+
+
+def batch(client, *ops):
+    return client.post("/planner_items/batch", json={"ops": list(ops)})
+
+
+def test_batch_applies_ops_in_order(client):
+    r = batch(client, {"op": "create", "title": "Revise"}, {"op": "create", "title": "Sleep"})
+    first, second = r.get_json()["results"]
+    r = batch(client, {"op": "update", "id": first["id"], "notes": "ch. 4"},
+              {"op": "complete", "id": second["id"]}, {"op": "delete", "id": "missing"})
+    updated, completed, deleted = r.get_json()["results"]
+    assert updated["notes"] == "ch. 4"
+    assert completed["completed"] is True
+    assert deleted == {"ok": False}
+
+
+@pytest.mark.parametrize("op", [
+    {"op": "update", "id": "x", "notes": 5},
+    {"op": "update", "id": "x", "title": ["a"]},
+    {"op": "create", "title": "Revise", "date": 20240501},
+    {"op": "update", "id": "x", "completed": "yes"},
+    {"op": "complete", "id": "x", "completed": 1},
+])
+def test_batch_rejects_wrongly_typed_fields(client, op):
+    before = client.get("/planner_items").get_json()
+    r = batch(client, {"op": "create", "title": "kept out"}, op)
+    assert r.status_code == 400
+    assert r.get_json()["error"].startswith("op 1: ")
+    assert client.get("/planner_items").get_json() == before
+
+
+def plan(client):
+    return batch(client, {"op": "create", "title": "Revise, ch. 4", "date": "2025-05-02", "time": "18:30",
+                          "notes": "formulas\nand graphs"},
+                 {"op": "create", "title": "Call home", "date": "2025-05-03"},
+                 {"op": "create", "title": "Sleep early"}).get_json()["results"]
+
+
+def test_text_export(client):
+    assert client.get("/download_planner").get_data(as_text=True) == "Planner is empty.\n"
+    plan(client)
+    r = client.get("/download_planner_text")
+    assert r.headers["Content-Disposition"] == 'attachment; filename="planner.txt"'
+    text = r.get_data(as_text=True)
+    assert "Title : Revise, ch. 4" in text and "Notes : formulas\n        and graphs" in text
+    assert text.count("Status: Pending") == 3
+
+
+def test_ics_export_has_events_and_todos(client):
+    plan(client)
+    r = client.get("/download_planner_ics")
+    assert r.mimetype == "text/calendar"
+    ics = r.get_data(as_text=True)
+    assert ics.startswith("BEGIN:VCALENDAR\r\n") and ics.endswith("END:VCALENDAR\r\n")
+    assert "DTSTART:20250502T183000\r\n" in ics and "DTSTART;VALUE=DATE:20250503\r\n" in ics
+    assert "SUMMARY:Revise\\, ch. 4\r\n" in ics and "DESCRIPTION:formulas\\nand graphs\r\n" in ics
+    assert ics.count("BEGIN:VEVENT") == 2 and ics.count("BEGIN:VTODO") == 1
+
+
+def test_csv_export_imports_back(client):
+    created = plan(client)
+    batch(client, {"op": "complete", "id": created[2]["id"]})
+    exported = client.get("/download_planner_csv").get_data()
+    r = client.post("/planner_items/import", data=exported, content_type="text/csv")
+    assert r.status_code == 201 and r.get_json() == {"imported": 3}
+
+    def fields(item):
+        return {k: item.get(k) for k in ("title", "date", "time", "notes", "completed")}
+    items = client.get("/planner_items", query_string={"limit": 100}).get_json()
+    originals, copies = items[:3], items[3:]
+    assert sorted(map(str, map(fields, copies))) == sorted(map(str, map(fields, originals)))
+    assert not {i["id"] for i in copies} & {i["id"] for i in originals}
+
+
+def test_ndjson_import_reports_how_far_it_got(client):
+    body = '{"title": "Revise"}\n\n{"title": "Walk", "completed": true}\nnot json\n'
+    r = client.post("/planner_items/import", data=body, content_type="application/x-ndjson")
+    assert r.status_code == 400 and r.get_json()["error"] == "item 3: not valid JSON"
+    assert client.post("/planner_items/import?format=xml", data="").status_code == 400
@@ -0,0 +1,43 @@
+import json
+
+from sessions import ProfileStore
+from storage import atomic_write_json
+
+
+def test_warm_reads_do_not_reparse_the_file(tmp_path):
+    store = ProfileStore(str(tmp_path / "user.json"))
+    store.replace({"name": "Asha", "greeted": False})
+    for _ in range(10):
+        assert store.get()["name"] == "Asha"
+    assert store.doc.reads <= 1
+
+
+def test_batch_writes_once(tmp_path):
+    store = ProfileStore(str(tmp_path / "user.json"))
+    with store.batch():
+        store.replace({"name": "Asha", "greeted": False})
+        store.update(greeted=True)
+        assert store.writes == 0
+        assert store.get() == {"name": "Asha", "greeted": True}
+    assert store.writes == 1
+    assert json.loads((tmp_path / "user.json").read_text()) == {"name": "Asha", "greeted": True}
+
+
+def test_another_workers_write_is_picked_up(tmp_path):
+    path = str(tmp_path / "user.json")
+    store = ProfileStore(path)
+    store.replace({"name": "Asha"})
+    assert store.get() == {"name": "Asha"}
+    atomic_write_json(path, {"name": "Ravi", "greeted": True})  # committed by another process
+    assert store.get() == {"name": "Ravi", "greeted": True}
+    store.update(greeted=False)
+    assert json.loads((tmp_path / "user.json").read_text()) == {"name": "Ravi", "greeted": False}
+
+
+def test_unreadable_profile_is_treated_as_empty(tmp_path):
+    path = tmp_path / "user.json"
+    path.write_text("{not json")
+    store = ProfileStore(str(path))
+    assert store.get() == {}
+    store.update(name="Asha")
+    assert json.loads(path.read_text()) == {"name": "Asha"}
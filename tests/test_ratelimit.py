@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from ratelimit import Coalescer, FairLimiter, RateLimited
+
+
+def test_duplicates_share_the_leaders_result():
+    coalescer, calls, results = Coalescer(linger=1.0), [], []
+    started = threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return "reply"
+
+    first = threading.Thread(target=lambda: results.append(coalescer.run("key", slow)))
+    first.start()
+    started.wait(5)
+    dupes = [threading.Thread(target=lambda: results.append(coalescer.run("key", slow))) for _ in range(3)]
+    for t in dupes:
+        t.start()
+    for t in [first, *dupes]:
+        t.join(5)
+    assert results == ["reply"] * 4 and len(calls) == 1
+    assert coalescer.run("key", slow) == "reply" and len(calls) == 1  # still within linger
+    assert coalescer.stats()["coalesced"] == 4
+
+
+def test_a_failed_leader_lets_a_waiter_retry():
+    coalescer = Coalescer(linger=0)
+    leader, flight = coalescer.join("key")
+    outcome = []
+    waiter = threading.Thread(target=lambda: outcome.append(coalescer.join("key")))
+    waiter.start()
+    time.sleep(0.05)
+    coalescer.release(flight)  # the leader failed without a result
+    waiter.join(5)
+    assert outcome[0][0] is True  # the waiter does the work itself
+
+
+def test_session_rate_paces_one_session_only():
+    limiter = FairLimiter(session_rate=20, session_burst=1, global_rate=0, max_wait=1)
+    started = time.monotonic()
+    limiter.acquire("busy")
+    limiter.acquire("busy")  # waits ~1/20 s for the next token
+    limiter.acquire("other")
+    assert 0.03 < time.monotonic() - started < 0.5
+    stats = limiter.stats()
+    assert stats["granted"] == 3 and stats["queued"] == 1
+
+
+def test_requests_past_max_wait_are_rejected():
+    limiter = FairLimiter(session_rate=0.1, session_burst=1, global_rate=0, max_wait=0.5)
+    limiter.acquire("busy")
+    with pytest.raises(RateLimited) as e:
+        limiter.acquire("busy")
+    assert e.value.retry_after > 5
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_global_tokens_go_round_robin_across_sessions():
+    limiter = FairLimiter(session_rate=0, global_rate=20, global_burst=1, max_wait=5)
+    limiter.acquire("warmup")  # the bucket is empty from here on
+    order, lock = [], threading.Lock()
+
+    def ask(sid):
+        limiter.acquire(sid)
+        with lock:
+            order.append(sid)
+
+    threads = [threading.Thread(target=ask, args=("bursty",)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.02)  # the bursty session queues first
+    threads.append(threading.Thread(target=ask, args=("quiet",)))
+    threads[-1].start()
+    for t in threads:
+        t.join(5)
+    # the quiet session is served after at most one more bursty request, not after all of them
+    assert order.index("quiet") <= 2
+    assert limiter.stats()["max_queue"] == 5
+
+
+def test_chat_over_the_limit_gets_the_busy_reply(client, app_module, monkeypatch):
+    limiter = FairLimiter(session_rate=0.01, session_burst=1, global_rate=0, max_wait=0)
+    monkeypatch.setattr(app_module, "upstream_limiter", limiter)
+    client.post("/chat", json={"message": "first question about my thesis"})
+    reply = client.post("/chat", json={"message": "second question about my thesis"}).get_json()["reply"]
+    assert "getting a lot of messages" in reply
+    assert app_module.upstream.calls == 1
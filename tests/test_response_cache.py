@@ -0,0 +1,40 @@
+from response_cache import ResponseCache, context_fingerprint
+
+
+def test_near_duplicate_messages_share_a_reply():
+    cache = ResponseCache()
+    cache.put("I am stressed about my exams", "Exams are hard.", "ctx")
+    assert cache.get("im stressed about my exams!!", "ctx") == "Exams are hard."
+    assert cache.get("im stressed about my exams!!", "other") is None
+    assert cache.get("I am not stressed about my exams", "ctx") is None
+
+
+def test_fingerprint_depends_on_every_prompt_message_and_the_owner():
+    system = [{"role": "system", "content": "You are Saathi."}]
+    history = system + [{"role": "user", "content": "my dog died"}, {"role": "assistant", "content": "I'm sorry."}]
+    assert context_fingerprint(system) == context_fingerprint(list(system))
+    assert context_fingerprint(history) != context_fingerprint(system)
+    assert context_fingerprint(history, owner="a") != context_fingerprint(history, owner="b")
+
+
+def test_first_turns_are_shared_between_sessions(app_module):
+    upstream = app_module.upstream
+    for _ in range(2):
+        app_module.app.test_client().post("/chat", json={"message": "I am stressed about my exams today"})
+    assert upstream.calls == 1
+
+
+def test_sessions_with_history_do_not_share_replies(app_module):
+    upstream = app_module.upstream
+    a, b = app_module.app.test_client(), app_module.app.test_client()
+    a.post("/chat", json={"message": "my grandmother passed away last week"})
+    b.post("/chat", json={"message": "my football team lost the final"})
+    for client in (a, b):  # the same last message, after different conversations
+        client.post("/chat", json={"message": "honestly I just feel low today"})
+    calls = upstream.calls
+    upstream.reply = "Reply for A, about your grandmother. How are you?"
+    a.post("/chat", json={"message": "what should I do now"})
+    upstream.reply = "Reply for B, about football. How are you?"
+    r = b.post("/chat", json={"message": "what should I do now"})
+    assert upstream.calls == calls + 2
+    assert "grandmother" not in r.get_json()["reply"]
@@ -0,0 +1,29 @@
+import json
+from datetime import datetime
+
+from scheduler import DeliveryScheduler
+
+
+def test_compaction_keeps_lines_other_workers_appended(tmp_path):
+    journal = str(tmp_path / "schedule.jsonl")
+    delivered = []
+    sched = DeliveryScheduler(lambda sid, now: delivered.append(sid) or [], lambda: [], journal,
+                              journal_max_bytes=200)
+    for i in range(5):
+        sched.schedule(f"{i:032x}", f"m{i}", "2999-01-01")
+    sched.next_due()  # synced up to here
+
+    compact = sched._compact_journal
+
+    def append_then_compact():
+        # another worker schedules a due message between our read and the rotation
+        with open(journal, "a") as f:
+            f.write(json.dumps({"sid": "f" * 32, "id": "other", "due": "2000-01-01T00:00:00", "pid": 0}) + "\n")
+        compact()
+
+    sched._compact_journal = append_then_compact
+    sched.deliver_due(datetime(2000, 6, 1))
+    assert open(journal).read() == ""
+    sched._compact_journal = compact
+    sched.deliver_due(datetime(2000, 6, 1))
+    assert delivered == ["f" * 32]
@@ -0,0 +1,65 @@
+import re
+
+from history_log import HistoryLog
+from search_index import SearchIndex
+
+
+def test_search_sees_a_turn_still_queued_for_write_behind(client):
+    client.post("/chat", json={"message": "my name is Priya"})
+    r = client.post("/chat", json={"message": "I keep worrying about my chemistry exam"})
+    assert r.status_code == 200
+
+    found = client.get("/search", query_string={"q": "chemistry"}).get_json()
+    assert found["total"] == 1
+    assert found["results"][0]["role"] == "user"
+
+
+def build_index(tmp_path, n=120):
+    log = HistoryLog(tmp_path / "history")
+    index = SearchIndex(str(tmp_path / "search"), log, flush_docs=8, merge_factor=2)
+    log.on_write = index.note_write
+    words = ["exam", "sleep", "friends", "hostel", "physics"]
+    for i in range(0, n, 2):
+        day = f"2025-03-{1 + i // 8:02d}T10:00:00+00:00"
+        log.append_many([
+            {"role": "user", "content": f"message {i} about {words[i % 5]} and {words[(i // 2) % 5]}", "ts": day},
+            {"role": "assistant", "content": f"reply {i + 1}: try a short walk before {words[i % 5]}", "ts": day},
+        ])
+    log.append_many([{"role": "assistant", "content": "[Time Capsule] Good luck with physics finals!",
+                      "meta": {"time_message_id": "t1", "delivered_at": "2025-04-01T08:00:00"}}])
+    return log, index
+
+
+def test_index_finds_what_a_scan_of_the_log_finds(tmp_path):
+    log, index = build_index(tmp_path)
+    entries = log.tail(1000)
+    for word in ("exam", "hostel", "walk", "physics"):
+        expected = {i for i, e in enumerate(entries) if word in re.findall(r"\w+", e["content"].lower())}
+        found = index.search(word, limit=1000)
+        assert found["total"] == len(expected) and found["total_exact"]
+        assert {r["position"] for r in found["results"]} == expected
+    stats = index.stats()
+    assert stats["merges"] > 0 and stats["segments"] <= 6  # merged as it grew
+
+
+def test_phrases_prefixes_and_filters(tmp_path):
+    log, index = build_index(tmp_path)
+    assert index.search('"short walk before sleep"', limit=1000)["total"] == 12
+    assert index.search("phys*", limit=1000)["total"] == index.search("physics", limit=1000)["total"]
+    assert all(r["role"] == "user" for r in index.search("exam", role="user")["results"])
+    capsule = index.search("physics", source="time_capsule")
+    assert capsule["total"] == 1 and capsule["results"][0]["source"] == "time_capsule"
+    dated = index.search("exam", date_from="2025-03-02", date_to="2025-03-02", limit=1000)["results"]
+    assert dated and all(r["ts"].startswith("2025-03-02") for r in dated)
+    recent = index.search("exam", sort="recent", limit=3)["results"]
+    assert [r["position"] for r in recent] == sorted((r["position"] for r in recent), reverse=True)
+
+    # another worker's index over the same files
+    other = SearchIndex(str(tmp_path / "search"), HistoryLog(tmp_path / "history"), flush_docs=8, merge_factor=2)
+    assert other.search("hostel", limit=1000)["total"] == index.search("hostel", limit=1000)["total"]
+
+
+def test_search_route_validates_its_query(client):
+    assert client.get("/search").status_code == 400
+    for bad in ({"q": "x", "role": "system"}, {"q": "x", "sort": "oldest"}, {"q": "x", "date_from": "May"}):
+        assert client.get("/search", query_string=bad).status_code == 400
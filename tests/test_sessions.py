@@ -0,0 +1,62 @@
+import json
+import os
+
+import sessions
+
+
+def test_legacy_id_is_not_a_valid_cookie(client):
+    assert not sessions.valid_session_id(sessions.LEGACY_SESSION_ID)
+    assert sessions.session_id_from_cookie_header(f"saathi_sid={sessions.LEGACY_SESSION_ID}") is None
+    client.set_cookie(sessions.SESSION_COOKIE, sessions.LEGACY_SESSION_ID)
+    r = client.get("/time_messages")
+    assert f"{sessions.SESSION_COOKIE}=" in r.headers.get("Set-Cookie", "")  # got a fresh session instead
+
+
+def use_data_dir(monkeypatch, path):
+    monkeypatch.setattr(sessions, "DATA_DIR", str(path / "data"))
+    monkeypatch.setattr(sessions, "LEGACY_SESSION_FILE", str(path / "data" / "legacy_session"))
+
+
+def test_single_user_files_move_to_a_random_session(tmp_path, monkeypatch):
+    use_data_dir(monkeypatch, tmp_path)
+    (tmp_path / "user.json").write_text(json.dumps({"name": "Priya"}))
+    (tmp_path / "chat_history.json").write_text(json.dumps([{"role": "user", "content": "hello"}]))
+    files = [str(tmp_path / n) for n in ("chat_history.json", "history", "user.json", "planner.json", "tm.json")]
+    sessions.migrate_legacy_files(*files)
+    sessions.migrate_legacy_files(*files)  # once only
+
+    sid = (tmp_path / "data" / "legacy_session").read_text().strip()
+    assert sessions.valid_session_id(sid)
+    assert list(sessions.iter_session_ids()) == [sid]
+    state = sessions.UserState(sid)
+    assert state.profile.get().get("name") == "Priya"
+    assert [e["content"] for e in state.history.tail(5)] == ["hello"]
+
+
+def test_old_legacy_shard_is_renamed(tmp_path, monkeypatch):
+    use_data_dir(monkeypatch, tmp_path)
+    old = sessions.user_dir(sessions.LEGACY_SESSION_ID)
+    os.makedirs(old)
+    with open(os.path.join(old, "user.json"), "w") as f:
+        json.dump({"name": "Asha"}, f)
+    sessions.migrate_legacy_files(*(str(tmp_path / "missing") for _ in range(5)))
+
+    sid = (tmp_path / "data" / "legacy_session").read_text().strip()
+    assert not os.path.exists(old)
+    assert sessions.UserState(sid).profile.get().get("name") == "Asha"
+
+
+def test_sessions_do_not_see_each_other(app_module):
+    asha, ravi = app_module.app.test_client(), app_module.app.test_client()
+    asha.post("/chat", json={"message": "my name is Asha"})
+    asha.post("/planner_items", json={"title": "Revise optics"})
+    ravi.post("/planner_items", json={"title": "Call home"})
+
+    assert [i["title"] for i in asha.get("/planner_items").get_json()] == ["Revise optics"]
+    assert [i["title"] for i in ravi.get("/planner_items").get_json()] == ["Call home"]
+    sids = [c.get_cookie(sessions.SESSION_COOKIE).value for c in (asha, ravi)]
+    assert sids[0] != sids[1]
+    asha_state, ravi_state = (app_module.session_cache.get(sid) for sid in sids)
+    assert asha_state.profile.get().get("name") == "Asha"
+    assert ravi_state.profile.get() == {}
+    assert ravi_state.history.tail(5) == []
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import REPO, gunicorn
+
+PROBE = """
+import json, os, sys
+import app
+print(json.dumps({"modules": sorted(m for m in ("dotenv", "requests", "httpx") if m in sys.modules),
+                  "legacy_session": os.path.exists(os.path.join(os.environ["DATA_DIR"], "legacy_session"))}))
+"""
+
+
+def import_app(workdir, **env):
+    env = dict(os.environ, PYTHONPATH=REPO, DATA_DIR=os.path.join(workdir, "data"), **env)
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=workdir, env=env, capture_output=True, text=True,
+                         timeout=60, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def test_import_leaves_heavy_modules_for_later(tmp_path):
+    assert import_app(str(tmp_path))["modules"] == []
+
+
+def test_data_steps_wait_for_when_ready_under_preload(tmp_path):
+    (tmp_path / "user.json").write_text(json.dumps({"name": "Asha"}))
+    assert import_app(str(tmp_path), SAATHI_PRELOAD="1")["legacy_session"] is False
+    assert import_app(str(tmp_path))["legacy_session"] is True
+
+
+def test_dotenv_is_loaded_when_there_is_a_env_file(tmp_path):
+    (tmp_path / ".env").write_text("PERPLEXITY_API_KEY=from-dotenv\n")
+    env = {k: v for k, v in os.environ.items() if k != "PERPLEXITY_API_KEY"}
+    out = subprocess.run([sys.executable, "-c", "import app; print(app.PERPLEXITY_KEY)"], cwd=tmp_path,
+                         env=dict(env, PYTHONPATH=REPO, DATA_DIR=str(tmp_path / "data")),
+                         capture_output=True, text=True, timeout=60, check=True).stdout
+    assert out.strip().splitlines()[-1] == "from-dotenv"
+
+
+def test_gunicorn_runs_the_data_steps_before_serving(tmp_path):
+    (tmp_path / "user.json").write_text(json.dumps({"name": "Asha"}))
+    with gunicorn(str(tmp_path), "-w", "1"):
+        assert (tmp_path / "data" / "legacy_session").exists()
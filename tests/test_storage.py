@@ -0,0 +1,54 @@
+import json
+import multiprocessing
+
+import pytest
+
+from storage import CorruptFileError, JSONDocument, VersionConflict, iter_json_array, read_json
+
+
+def append_many(path, n):
+    doc = JSONDocument(path, default=[])
+    for i in range(n):
+        doc.update(lambda items: items.append(i))
+
+
+def test_concurrent_writers_lose_no_updates(tmp_path):
+    path = str(tmp_path / "planner.json")
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=append_many, args=(path, 25)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+    assert [p.exitcode for p in procs] == [0] * 4
+    assert len(read_json(path)) == 100
+    assert list(tmp_path.glob("*.tmp")) == []  # every write was renamed into place
+
+
+def test_stale_commit_conflicts(tmp_path):
+    path = str(tmp_path / "doc.json")
+    mine, theirs = JSONDocument(path, default=[]), JSONDocument(path, default=[])
+    data, version = mine.load()
+    theirs.update(lambda items: items.append("theirs"))
+    with pytest.raises(VersionConflict):
+        mine.commit(data + ["mine"], version)
+    mine.update(lambda items: items.append("mine"))
+    assert read_json(path) == ["theirs", "mine"]
+
+
+def test_corrupt_file_is_reported_not_overwritten(tmp_path):
+    path = tmp_path / "doc.json"
+    path.write_text("[1, 2,")
+    with pytest.raises(CorruptFileError):
+        JSONDocument(str(path), default=[]).load()
+    assert path.read_text() == "[1, 2,"
+
+
+def test_iter_json_array_streams_across_chunks(tmp_path):
+    items = [{"role": "user", "content": "x" * i} for i in range(50)] + [12345, "end"]
+    path = tmp_path / "big.json"
+    path.write_text(json.dumps(items))
+    assert list(iter_json_array(str(path), chunk_size=7)) == items
+    path.write_text(json.dumps(items)[:-20])
+    with pytest.raises(CorruptFileError):
+        list(iter_json_array(str(path), chunk_size=7))
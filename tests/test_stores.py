@@ -0,0 +1,84 @@
+import json
+from datetime import datetime
+
+import pytest
+
+import stores
+from storage import JSONDocument
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path):
+    """(planner, time capsule) factories for one user id, on either backend."""
+    if request.param == "json":
+        return (lambda uid: stores.JSONPlanner(JSONDocument(str(tmp_path / uid / "planner.json"), default=[])),
+                lambda uid: stores.JSONTimeMessages(JSONDocument(str(tmp_path / uid / "tm.json"), default=[])))
+    db = stores.SQLiteDB(str(tmp_path / "saathi.db"))
+    return lambda uid: stores.SQLitePlanner(db, uid), lambda uid: stores.SQLiteTimeMessages(db, uid)
+
+
+def planner_item(item_id, title, completed=False):
+    return {"id": item_id, "title": title, "date": "2025-05-01", "time": "", "notes": "", "completed": completed}
+
+
+def test_crud_and_batch(backend):
+    planner = backend[0]("asha")
+    planner.add(planner_item("a", "Revise"))
+    planner.add(planner_item("b", "Sleep"))
+    assert planner.edit("a", lambda it: it.update(completed=True) or it)["completed"] is True
+    assert planner.edit("missing", lambda it: it) is None
+    assert planner.delete("b") is True
+    assert planner.delete("b") is False
+    results = planner.apply([("add", planner_item("c", "Walk")), ("delete", "a"),
+                             ("edit", "c", lambda it: it.update(notes="after lunch") or it)])
+    assert results[1] is True and results[2]["notes"] == "after lunch"
+    assert [(it["id"], it["notes"]) for it in planner.all()] == [("c", "after lunch")]
+    assert list(planner.iter_items()) == planner.all()
+
+
+def test_users_are_kept_apart(backend):
+    make_planner = backend[0]
+    make_planner("asha").add(planner_item("a", "Revise"))
+    make_planner("ravi").add(planner_item("r", "Call home"))
+    assert [it["id"] for it in make_planner("asha").all()] == ["a"]
+    assert make_planner("ravi").delete("a") is False
+
+
+def test_version_changes_on_write(backend):
+    planner = backend[0]("asha")
+    before = planner.version()
+    planner.add(planner_item("a", "Revise"))
+    assert planner.version()[0] != before[0]
+
+
+def test_deliver_due_marks_each_message_once(backend):
+    capsule = backend[1]("asha")
+    for item_id, when in (("past", "2025-01-01T08:00"), ("today", "2025-03-01"), ("future", "2030-01-01")):
+        capsule.add({"id": item_id, "message": "hi", "scheduled_date": when, "created_at": "2024-12-01",
+                     "delivered": False})
+    now = datetime(2025, 3, 1, 12, 0)
+    assert sorted(it["id"] for it in capsule.deliver_due(now)) == ["past", "today"]
+    assert capsule.deliver_due(now) == []
+    assert {it["id"]: it["delivered"] for it in capsule.all()} == {"past": True, "today": True, "future": False}
+
+
+def test_delivery_scan_uses_the_due_index(tmp_path):
+    db = stores.SQLiteDB(str(tmp_path / "saathi.db"))
+    plan = db.execute("EXPLAIN QUERY PLAN SELECT * FROM time_messages WHERE delivered = 0 AND due_at <= ?",
+                      ("2025-01-01",)).fetchall()
+    assert "time_messages_due" in " ".join(row["detail"] for row in plan)
+
+
+def test_json_files_migrate_once(tmp_path):
+    db = stores.SQLiteDB(str(tmp_path / "saathi.db"))
+    planner_path, tm_path = tmp_path / "planner.json", tmp_path / "tm.json"
+    planner_path.write_text(json.dumps([planner_item("a", "Revise"), {"title": "no id, skipped"}]))
+    users = [("asha", str(planner_path), str(tm_path))]
+    assert stores.migrate_json_files(db, users) == 1
+    assert stores.migrate_json_files(db, users) == 0
+    assert [it["title"] for it in stores.SQLitePlanner(db, "asha").all()] == ["Revise"]
+
+    (tmp_path / "bad.json").write_text("[{")
+    failed = []
+    assert stores.migrate_json_files(db, [("ravi", str(tmp_path / "bad.json"), str(tm_path))], failed) == 0
+    assert failed == ["ravi"]
@@ -0,0 +1,47 @@
+import json
+
+
+def sse_events(body):
+    """[(event, data), ...] from a text/event-stream body."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_stream_sends_deltas_then_the_formatted_reply(client, app_module):
+    r = client.post("/chat/stream", json={"message": "I can't focus on my physics revision"})
+    assert r.mimetype == "text/event-stream"
+    events = sse_events(r.get_data(as_text=True))
+    kinds = [event for event, _ in events]
+    assert kinds[-1] == "done" and kinds.count("done") == 1
+    assert "delta" in kinds
+    blocks = [html for event, d in events if event == "delta" for _, html in d["blocks"]]
+    assert blocks == ["Try to get enough sleep before your exam. How are you?"]
+    reply = events[-1][1]["reply"]
+    assert "enough sleep" in reply
+    assert app_module.upstream.calls == 1
+
+
+def test_stream_saves_the_turn_like_chat(client, app_module):
+    client.post("/chat/stream", json={"message": "my hostel room is too noisy to study"}).get_data()
+    sid = client.get_cookie(app_module.SESSION_COOKIE).value
+    history = app_module.session_cache.get(sid).history.tail(2)
+    assert [e["role"] for e in history] == ["user", "assistant"]
+    assert history[0]["content"] == "my hostel room is too noisy to study"
+    assert history[1]["content"].startswith("Try to get enough sleep")
+
+
+def test_empty_stream_message_is_answered_without_upstream(client, app_module):
+    r = client.post("/chat/stream", json={"message": "   "})
+    assert sse_events(r.get_data(as_text=True)) == [("done", {"reply": "Please enter a message."})]
+    assert app_module.upstream.calls == 0
+
+
+def test_stream_without_api_key_yields_the_offline_reply(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "PERPLEXITY_KEY", "")
+    events = sse_events(client.post("/chat/stream", json={"message": "exams are close and I panic"})
+                        .get_data(as_text=True))
+    assert events[-1][0] == "done"
+    assert "(Offline Mode) API key not set." in events[-1][1]["reply"]
@@ -0,0 +1,73 @@
+import random
+import re
+
+import pytest
+
+from textproc import FOLLOWUPS, KeywordMatcher, StreamingFormatter, choose_followup, format_reply, store_name
+
+
+def test_format_reply_cleans_and_caps():
+    html = format_reply("You did **well** [1][2]. Keep *going*. " + "More. " * 10, max_sentences=3,
+                        followup="Want a plan?")
+    assert html == "<p>You did <strong>well</strong>. Keep going. More. … Want a plan?</p>"
+    assert format_reply("See you soon", end_conversation=True) == "<p>See you soon.</p>"
+    assert format_reply("How was the exam?") == "<p>How was the exam?</p>"
+    assert format_reply("") == "<p>Sorry, I couldn't generate a reply right now.</p>"
+
+
+def test_format_reply_lists():
+    assert format_reply("Try these\n- water\n- a walk", end_conversation=True) == \
+        "<p>Try these</p>\n<ul>\n<li>water</li>\n<li>a walk.</li>\n</ul>"
+
+
+def streamed(text, size):
+    formatter, blocks = StreamingFormatter(max_sentences=7), []
+    for i in range(0, len(text), size):
+        blocks += formatter.feed(text[i:i + size])[0]
+    blocks += formatter.finish()
+    assert formatter.text == text
+    return blocks
+
+
+def html_blocks(html):
+    return [(m.group(1), m.group(2)) for m in re.finditer(r"<(p|li)>(.*?)</\1>", html)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 64])
+@pytest.mark.parametrize("text", [
+    "Hi **Asha** [1]. Exams are hard! Try this:\n- sleep early\n- 1. breaks [2]\nYou've got this.",
+    "Plan:\n1. Revise\n2. Rest\nGood luck!",
+])
+def test_streamed_blocks_match_format_reply(text, size):
+    assert streamed(text, size) == html_blocks(format_reply(text, end_conversation=True))
+
+
+def test_streaming_stops_at_the_sentence_cap():
+    blocks = streamed(" ".join(f"Sentence {i}." for i in range(12)), 3)
+    assert blocks == [("p", " ".join(f"Sentence {i}." for i in range(7)))]
+
+
+@pytest.mark.parametrize("text,name", [
+    ("my name is priya", "Priya"), ("Call me Arjun!", "Arjun"), ("I'm Li", "Li"),
+    ("Meera", "Meera"), ("I am tired", None), ("ok", None), ("hello there friend", None), ("xkcd", None),
+])
+def test_store_name(text, name):
+    assert store_name(text) == name
+
+
+def test_choose_followup_takes_the_first_matching_group():
+    assert choose_followup("worried about my exam results") == FOLLOWUPS["exams"]
+    assert choose_followup("so tired lately") == FOLLOWUPS["sleep"]
+    assert choose_followup("nothing much").startswith("Would you like to tell me more")
+
+
+def test_keyword_matcher_is_plain_substring_matching():
+    groups = {"a": ["exam", "test"], "b": ["sleep", "tired", "rest"], "c": ["friend", "c++", "a.b"]}
+    matcher = KeywordMatcher(groups)
+    rng = random.Random(7)
+    vocab = ["exam", "Tested", "rEST", "friendship", "c++", "aXb", "a.b", "calm", "sleeping", "x"]
+    for _ in range(500):
+        text = " ".join(rng.choice(vocab) for _ in range(rng.randint(0, 6)))
+        expected = {label for label, words in groups.items() if any(w in text.lower() for w in words)}
+        assert matcher.groups(text) == expected
+        assert matcher.first(text) == next((label for label in groups if label in expected), None)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from upstream import AsyncUpstreamClient, CircuitBreaker, CircuitOpenError, UpstreamClient, UpstreamError
+
+
+class Stub:
+    """A local chat-completions server answering with the queued statuses, then 200."""
+
+    def __init__(self):
+        self.statuses = []
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                stub.requests += 1
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                self.send_response(status)
+                if body.get("stream") and status == 200:
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.end_headers()
+                    for word in ("Hello ", "there"):
+                        delta = {"choices": [{"delta": {"content": word}}]}
+                        self.wfile.write(f"data: {json.dumps(delta)}\n\n".encode())
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    return
+                data = json.dumps({"choices": [{"message": {"content": "Hello there"}}]}).encode()
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/chat/completions"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+
+@pytest.fixture
+def stub():
+    s = Stub()
+    yield s
+    s.server.shutdown()
+
+
+def client(url, **kw):
+    return UpstreamClient(url, backoff_base=0.001, backoff_max=0.01, **kw)
+
+
+def half_open(breaker):
+    breaker.record_failure()
+    breaker._opened_at = time.monotonic() - breaker.reset_after
+    assert breaker.state == "half-open"
+
+
+def test_retries_5xx_then_succeeds(stub):
+    stub.statuses = [503, 500]
+    c = client(stub.url, max_retries=2)
+    assert c.chat_completion({})["choices"][0]["message"]["content"] == "Hello there"
+    assert stub.requests == 3
+
+
+def test_4xx_fails_at_once_without_tripping_the_breaker(stub):
+    stub.statuses = [400]
+    c = client(stub.url, breaker=CircuitBreaker(failure_threshold=1))
+    with pytest.raises(UpstreamError) as e:
+        c.chat_completion({})
+    assert e.value.status_code == 400 and stub.requests == 1
+    assert c.breaker.state == "closed"
+
+
+def test_breaker_opens_and_a_half_open_trial_closes_it(stub):
+    stub.statuses = [500, 500]
+    c = client(stub.url, max_retries=1, breaker=CircuitBreaker(failure_threshold=1, reset_after=60))
+    with pytest.raises(UpstreamError):
+        c.chat_completion({})
+    with pytest.raises(CircuitOpenError):
+        c.chat_completion({})
+    assert stub.requests == 2  # the open circuit never touched the network
+    c.breaker._opened_at -= 60
+    assert c.chat_completion({})["choices"]
+    assert c.breaker.state == "closed"
+
+
+def test_streams_deltas(stub):
+    assert list(client(stub.url).stream_chat_completion({})) == ["Hello ", "there"]
+
+
+@pytest.mark.parametrize("url", ["http://", "notaurl"])
+def test_unexpected_error_in_a_half_open_trial_does_not_wedge_the_breaker(stub, url):
+    c = client(url, breaker=CircuitBreaker(failure_threshold=1, reset_after=60))
+    half_open(c.breaker)
+    with pytest.raises(Exception):
+        c.chat_completion({})
+    assert c.breaker.state == "open"  # the failed trial re-opened it ...
+    c.url = stub.url
+    c.breaker._opened_at -= 60
+    assert c.chat_completion({})["choices"]  # ... and the next trial goes through
+    assert c.breaker.state == "closed"
+
+
+def test_cancelled_async_trial_frees_the_slot(stub):
+    c = AsyncUpstreamClient(stub.url, breaker=CircuitBreaker(failure_threshold=1, reset_after=60))
+    half_open(c.breaker)
+
+    async def run():
+        task = asyncio.ensure_future(c.chat_completion({}))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        result = await c.chat_completion({})
+        await c.aclose()
+        return result
+
+    assert asyncio.run(run())["choices"]
@@ -0,0 +1,75 @@
+import glob
+import json
+import os
+import signal
+import sys
+import tempfile
+
+import pytest
+import requests
+
+from conftest import gunicorn, wait_until
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs gunicorn")
+
+
+def worker_pid(base):
+    for line in requests.get(base + "/metrics", timeout=5).text.splitlines():
+        if line.startswith("saathi_process_info"):
+            return int(line.split('pid="')[1].split('"')[0])
+    raise AssertionError("no saathi_process_info")
+
+
+def test_journaled_write_survives_a_killed_worker():
+    workdir = tempfile.mkdtemp(prefix="saathi-respawn-")
+    # a long flush interval keeps the write in the journal only
+    with gunicorn(workdir, "-w", "1", WRITE_BEHIND_INTERVAL="600", GUNICORN_PRELOAD="1") as base:
+        pid = worker_pid(base)
+        r = requests.post(base + "/chat", json={"message": "my name is Priya"}, timeout=10)
+        assert r.ok
+        profiles = glob.glob(os.path.join(workdir, "data", "users", "**", "user.json"), recursive=True)
+        assert not profiles  # still only journaled
+
+        os.kill(pid, signal.SIGKILL)
+        new_pid = wait_until(lambda: (p := worker_pid(base)) != pid and p)
+        assert new_pid != pid
+        profiles = glob.glob(os.path.join(workdir, "data", "users", "**", "user.json"), recursive=True)
+        assert len(profiles) == 1
+        with open(profiles[0], encoding="utf-8") as f:
+            assert json.load(f).get("name") == "Priya"
+        assert not os.listdir(os.path.join(workdir, "data", "journal"))
+
+
+def test_queued_writes_are_read_back_and_written_once(tmp_path):
+    from sessions import ProfileStore
+    from writebehind import WriteBehind
+
+    wb = WriteBehind(str(tmp_path / "journal"), interval=600)
+    path = tmp_path / "user.json"
+    store = ProfileStore(str(path), write_behind=wb)
+    store.replace({"name": "Asha"})
+    store.update(greeted=True)
+    store.update(theme="dark")
+    assert store.get() == {"name": "Asha", "greeted": True, "theme": "dark"}
+    assert not path.exists()  # the request returned before the file was written
+    assert wb.stats()["submitted"] == 3 and wb.stats()["fsyncs"] >= 1
+
+    assert wb.flush() == 1
+    assert json.loads(path.read_text()) == {"name": "Asha", "greeted": True, "theme": "dark"}
+    assert store.writes == 1
+    assert wb.stats()["journal_bytes"] == 0  # everything applied: journal truncated
+    wb.close()
+
+
+def test_recovery_replays_only_unapplied_records(tmp_path):
+    from writebehind import recover
+
+    journal = tmp_path / "journal"
+    journal.mkdir()
+    lines = [{"kind": "note", "text": "a", "seq": 1}, {"applied": 1},
+             {"kind": "note", "text": "b", "seq": 2}, {"kind": "note", "text": "c", "seq": 3}]
+    (journal / "wb-99999-1.jsonl").write_text("\n".join(json.dumps(r) for r in lines) + '\n{"kind": "no')
+    replayed = []
+    assert recover(str(journal), {"note": lambda record: replayed.append(record["text"])}) == 2
+    assert replayed == ["b", "c"]
+    assert os.listdir(journal) == []
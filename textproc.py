@@ -0,0 +1,315 @@
+"""
+Text processing for chat turns: reply formatting, name extraction and
+keyword-based follow-up selection.
+
+Every pattern is compiled once at import. format_reply strips citations,
+converts bold and removes stray stars in one substitution, then walks the
+sentence gaps only as far as `max_sentences` needs. Keyword lookups go
+through a KeywordMatcher, which scans the message once per keyword group
+instead of once per keyword.
+
+bench/bench_textproc.py checks the output against the previous
+implementation and times both.
+"""
+import re
+
+CITATION_RE = re.compile(r'(?:\s*\[\d+\])+')
+BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+# bold first, otherwise a lone star: same result as BOLD_RE.sub followed by removing every '*'
+MARKUP_RE = re.compile(r'\*\*(.+?)\*\*|\*')
+SENTENCE_GAP_RE = re.compile(r'(?<=[\.!\?…])\s+')
+LIST_ITEM_RE = re.compile(r'^(-|\d+\.)\s+')
+QUESTION_END_RE = re.compile(r'\?\s*$')
+# trailing text that may still become a citation marker or a bold marker
+HOLD_BACK_RE = re.compile(r'(?:\s*\[\d*|\s+|\*)$')
+
+
+def _markup(m):
+    inner = m.group(1)
+    if inner is None:
+        return ''
+    return f"<strong>{inner.replace('*', '')}</strong>"
+
+
+# --- Format AI reply to HTML ---
+def format_reply(ai_text, max_sentences: int = 7, followup: str = None, end_conversation: bool = False):
+    """
+    Clean AI text, limit to `max_sentences`, convert simple markdown (bold)
+    and list lines to safe HTML paragraphs / lists.
+    If end_conversation is True, do not append any follow-up question.
+    """
+    if not ai_text:
+        return "<p>Sorry, I couldn't generate a reply right now.</p>"
+
+    # remove citation-style markers and convert simple markdown
+    text = CITATION_RE.sub('', ai_text) if '[' in ai_text else ai_text
+    if '*' in text:
+        text = MARKUP_RE.sub(_markup, text)
+    text = text.strip()
+
+    # sentences (keeping punctuation), scanned only up to one past the cap
+    sentences = []
+    more = False
+    pos = 0
+    for m in SENTENCE_GAP_RE.finditer(text):
+        s = text[pos:m.start()].strip()
+        pos = m.end()
+        if s:
+            if len(sentences) == max_sentences:
+                more = True
+                break
+            sentences.append(s)
+    else:
+        s = text[pos:].strip()
+        if s:
+            if len(sentences) == max_sentences:
+                more = True
+            else:
+                sentences.append(s)
+
+    truncated_text = " ".join(sentences).strip()
+
+    # Ensure we end cleanly with punctuation
+    if truncated_text and truncated_text[-1] not in ".!?…":
+        truncated_text = truncated_text + "."
+
+    # if original had more sentences, append an ellipsis to show continuation
+    if more:
+        truncated_text = truncated_text.rstrip() + " …"
+
+    # ensure there is a follow-up question unless this is an end-of-conversation reply
+    if not end_conversation and not QUESTION_END_RE.search(truncated_text):
+        truncated_text = truncated_text + " " + (followup or "Would you like to tell me more?")
+
+    # Convert simple lists / paragraphs into HTML
+    out = []
+    in_list = False
+    for line in truncated_text.splitlines():
+        line = line.strip()
+        m = LIST_ITEM_RE.match(line) if line[:1] == "-" or line[:1].isdigit() else None
+        if m:
+            if not in_list:
+                in_list = True
+                out.append("<ul>")
+            out.append(f'<li>{line[m.end():]}</li>')
+        else:
+            if in_list:
+                out.append("</ul>")
+                in_list = False
+            if line:
+                out.append(f"<p>{line}</p>")
+    if in_list:
+        out.append("</ul>")
+
+    return "\n".join(out) if out else f"<p>{truncated_text}</p>"
+
+
+class StreamingFormatter:
+    """
+    Incremental counterpart of format_reply for streamed replies.
+    feed() takes raw upstream text and returns (blocks, line): the blocks
+    finished by this chunk as (kind, html) pairs, kind being "p" or "li", and
+    the current unfinished line (or None). Citation stripping, bold conversion,
+    the sentence cap and list detection are applied chunk by chunk; text that
+    could still turn into a marker is held back until the next chunk.
+    format_reply() over the full text remains the final rendering.
+    """
+
+    def __init__(self, max_sentences: int = 7):
+        self.max_sentences = max_sentences
+        self.text = ""          # full raw reply received so far
+        self.capped = False     # True once max_sentences is reached
+        self._pending = ""
+        self._line = ""
+        self._sentences = 0
+        self._last_char = ""
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        raw = self._pending + chunk
+        cut = self._safe_length(raw)
+        self._pending = raw[cut:]
+        blocks = self._consume(raw[:cut])
+        return blocks, self._block(self._line)
+
+    def finish(self):
+        rest, self._pending = self._pending, ""
+        blocks = self._consume(rest.rstrip())
+        last = self._block(self._line)
+        if last:
+            blocks.append(last)
+        self._line = ""
+        return blocks
+
+    def _safe_length(self, raw):
+        m = HOLD_BACK_RE.search(raw)
+        cut = m.start() if m else len(raw)
+        # an unmatched ** waits for its closing marker (bold never spans lines)
+        start = raw.rfind("\n", 0, cut) + 1
+        for m in BOLD_RE.finditer(raw, start):
+            if m.end() > cut:
+                break
+            start = m.end()
+        opener = raw.find("**", start)
+        return min(opener, cut) if opener != -1 else cut
+
+    def _consume(self, text):
+        if self.capped or not text:
+            return []
+        text = CITATION_RE.sub('', text)
+        text = MARKUP_RE.sub(_markup, text)
+        blocks = []
+        # prefix the previous char so a gap right at the chunk start is still seen
+        probe = self._last_char + text
+        pos = len(self._last_char)
+        for m in SENTENCE_GAP_RE.finditer(probe, pos):
+            self._append(probe[pos:m.start()], blocks)
+            pos = m.end()
+            if probe[:m.start()].strip() or self._line.strip() or blocks:
+                self._sentences += 1
+            if self._sentences >= self.max_sentences:
+                self.capped = True
+                return blocks
+            # whitespace between sentences collapses to one space, as in format_reply
+            self._append(" ", blocks)
+        self._append(probe[pos:], blocks)
+        if text:
+            self._last_char = text[-1]
+        return blocks
+
+    def _append(self, s, blocks):
+        parts = s.split("\n")
+        self._line += parts[0]
+        for part in parts[1:]:
+            block = self._block(self._line)
+            if block:
+                blocks.append(block)
+            self._line = part
+
+    @staticmethod
+    def _block(line):
+        line = line.strip()
+        if not line:
+            return None
+        m = LIST_ITEM_RE.match(line)
+        if m:
+            return ("li", line[m.end():])
+        return ("p", line)
+
+
+# --- Multi-keyword matching ---
+class KeywordMatcher:
+    """
+    Groups of keywords, each compiled into one alternation.
+
+        matcher = KeywordMatcher({"exams": ["exam", "test"], "sleep": ["sleep", "tired"]})
+        matcher.groups("so tired before my test")   # {"exams", "sleep"}
+        matcher.first("so tired before my test")    # "exams" (groups are tried in order)
+
+    Matching is plain substring matching on the lowercased text, exactly like
+    `any(k in text.lower() for k in keywords)`, but each group is one scan in
+    the regex engine instead of one Python-level search per keyword.
+    """
+
+    def __init__(self, groups):
+        self._patterns = [
+            (label, re.compile("|".join(re.escape(w.lower()) for w in sorted(words, key=len, reverse=True))))
+            for label, words in groups.items() if words
+        ]
+
+    def groups(self, text):
+        """Labels of every group with at least one keyword in `text`."""
+        lowered = (text or "").lower()
+        return {label for label, pattern in self._patterns if pattern.search(lowered)}
+
+    def first(self, text):
+        """Label of the first group (in definition order) with a keyword in `text`, or None."""
+        lowered = (text or "").lower()
+        for label, pattern in self._patterns:
+            if pattern.search(lowered):
+                return label
+        return None
+
+
+INVALID_NAMES = {
+    "no","yes","ok","okay","maybe","nah","nope",
+    "i","me","my","mine","student","everyone","none",
+    # common emotion/adjective words — don't treat these as names
+    "happy","sad","angry","anxious","excited","stressed","calm","lonely",
+    "relaxed","tired","bored","scared","afraid","depressed","upset",
+    # common short replies / fillers/affirmations that should never become names
+    "yeah","yep","yup","sure","right","okey","okeydokey","kk","k","thanks","thankyou","thank","cool","nice"
+}
+
+# common patterns: "my name is X", "call me X", "I'm X", "I am X"
+NAME_PATTERNS = [
+    re.compile(r"\bmy\s+name\s+is\s+([A-Za-z][A-Za-z'\-]*)\b", re.IGNORECASE),
+    re.compile(r"\bcall\s+me\s+([A-Za-z][A-Za-z'\-]*)\b", re.IGNORECASE),
+    re.compile(r"\bi\s*(?:'m|am)\s+([A-Za-z][A-Za-z'\-]*)\b", re.IGNORECASE),
+]
+NAME_CHARS_RE = re.compile(r"[^A-Za-z'\-]")
+VOWEL_RE = re.compile(r"[aeiou]", re.IGNORECASE)
+
+
+def store_name(user_input: str):
+    """
+    Extracts and cleans a likely user name from input text.
+    Handles formats like 'my name is X', 'I am X', "I'm X", or single-word names.
+    Rejects values in INVALID_NAMES and common filler words.
+    """
+    if not user_input:
+        return None
+
+    text = user_input.strip()
+
+    for pattern in NAME_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            candidate = NAME_CHARS_RE.sub("", match.group(1)).strip().capitalize()
+            if candidate and candidate.lower() not in INVALID_NAMES:
+                return candidate
+
+    # single-word input -> treat as name only if alphabetic, reasonable length,
+    # not in INVALID_NAMES, and likely a real name (simple vowel check)
+    tokens = text.split()
+    if len(tokens) == 1:
+        token = NAME_CHARS_RE.sub("", tokens[0]).strip()
+        if token and token.isalpha() and 2 <= len(token) <= 30 and token.lower() not in INVALID_NAMES:
+            # require at least one vowel OR allow very short names (<=3) to accommodate e.g. "Li"
+            if VOWEL_RE.search(token) or len(token) <= 3:
+                return token.capitalize()
+
+    return None
+
+
+# checked in this order, first match wins
+FOLLOWUP_KEYWORDS = KeywordMatcher({
+    "exams": ["exam", "exams", "test", "tests", "grade", "grades", "marks", "result", "results"],
+    "happy": ["happy", "excited", "great", "celebrate", "good marks", "good grade", "got"],
+    "stress": ["anxious", "anxiety", "worried", "worried about",
+               "stress", "stressed", "stressing", "overwhelmed", "pressure", "deadline"],
+    "sleep": ["sleep", "tired", "rest", "insomnia"],
+    "social": ["friend", "friends", "relationship", "peer", "classmate", "roommate"],
+})
+FOLLOWUPS = {
+    "exams": "Congrats — would you like tips to keep the momentum or plan next study steps?",
+    "happy": "That’s wonderful — want ideas to celebrate or channels to share this with friends?",
+    "stress": "Would you like a short breathing exercise now or a few quick strategies to manage this stress?",
+    "sleep": "Would you like some quick sleep tips you can try tonight?",
+    "social": "Do you want help thinking through how to talk to them or what to say?",
+}
+
+
+def choose_followup(user_input: str):
+    """
+    Return a short student-focused follow-up question based on user_input.
+    Keep it concise and actionable.
+    """
+    if not user_input:
+        return "Would you like to tell me more or try a short grounding exercise?"
+
+    label = FOLLOWUP_KEYWORDS.first(user_input)
+    if label:
+        return FOLLOWUPS[label]
+    # default
+    return "Would you like to tell me more, or try a short grounding exercise?"
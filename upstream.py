@@ -0,0 +1,370 @@
+"""
+Shared HTTP client for the Perplexity chat-completions API.
+
+One pooled keep-alive session per worker process, connect/read timeouts,
+bounded retries with jittered backoff on 429/5xx, and a circuit breaker so a
+dead upstream is skipped straight away instead of tying up a worker.
+Point PERPLEXITY_API_URL at a local stub server to exercise it offline.
+
+AsyncUpstreamClient is the asyncio twin used by the ASGI mode (asgi.py); it
+needs httpx, which is imported only when that client is created. requests
+is likewise imported on the first call, keeping it out of app start-up.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+from metrics import UPSTREAM_ATTEMPTS, UPSTREAM_RETRIES, UPSTREAM_SECONDS, record
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """Raised when the upstream call fails after all retries."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without touching the network while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and stays open for
+    `reset_after` seconds; then lets a single trial request through (half-open).
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_after:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._failures >= self.failure_threshold or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """A call ended without a verdict (cancelled): free the half-open trial slot."""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+def settings_from_env():
+    env = os.environ.get
+    return {
+        "url": env("PERPLEXITY_API_URL", "https://api.perplexity.ai/chat/completions"),
+        "connect_timeout": float(env("PERPLEXITY_CONNECT_TIMEOUT", "3.05")),
+        "read_timeout": float(env("PERPLEXITY_READ_TIMEOUT", "30")),
+        "max_retries": int(env("PERPLEXITY_MAX_RETRIES", "2")),
+        "backoff_base": float(env("PERPLEXITY_BACKOFF_BASE", "0.5")),
+        "backoff_max": float(env("PERPLEXITY_BACKOFF_MAX", "4")),
+        "pool_size": int(env("PERPLEXITY_POOL_SIZE", "10")),
+        "breaker": CircuitBreaker(
+            failure_threshold=int(env("PERPLEXITY_BREAKER_THRESHOLD", "5")),
+            reset_after=float(env("PERPLEXITY_BREAKER_RESET", "30")),
+        ),
+    }
+
+
+def parse_sse_line(line):
+    """
+    Parse one line of a streamed completion.
+    Returns None at the end of the stream, otherwise a list of content deltas.
+    """
+    if not line or not line.startswith("data:"):
+        return []
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return []
+    return [c for c in ((ch.get("delta") or {}).get("content") for ch in event.get("choices") or []) if c]
+
+
+def backoff_delay(attempt, base, cap, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, cap)
+    # "full jitter": spreads retries from many workers over the window
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def record_attempt(started, status, retrying=False):
+    UPSTREAM_ATTEMPTS.inc(status=status)
+    record(UPSTREAM_SECONDS, started, "upstream.attempt", status=status)
+    if retrying:
+        UPSTREAM_RETRIES.inc()
+
+
+def parse_retry_after(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamClient:
+    def __init__(self, url, api_key=None, connect_timeout: float = 3.05, read_timeout: float = 30.0,
+                 max_retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 4.0,
+                 pool_size: int = 10, breaker: CircuitBreaker = None):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, api_key=None, **overrides):
+        return cls(api_key=api_key, **dict(settings_from_env(), **overrides))
+
+    @property
+    def session(self):
+        # sessions must not be shared across a fork (gunicorn --preload), so one per pid
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._lock:
+                if self._session is None or self._session_pid != pid:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    s = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    s.mount("https://", adapter)
+                    s.mount("http://", adapter)
+                    self._session = s
+                    self._session_pid = pid
+        return self._session
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def post(self, payload, **kwargs):
+        """
+        POST `payload` and return the successful `requests.Response`.
+        Retries connection errors, timeouts and 429/5xx; other statuses fail at once.
+        """
+        import requests
+
+        if not self.breaker.allow():
+            UPSTREAM_ATTEMPTS.inc(status="circuit_open")
+            raise CircuitOpenError("circuit open")
+        last_error = None
+        settled = False  # the breaker has heard how this call went
+        try:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                started = time.perf_counter()
+                try:
+                    r = self.session.post(self.url, headers=self._headers(), json=payload,
+                                          timeout=self.timeout, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    last_error = UpstreamError(f"connection failed: {e}")
+                    record_attempt(started, "error", attempt < self.max_retries)
+                else:
+                    record_attempt(started, str(r.status_code),
+                                   r.status_code in RETRY_STATUSES and attempt < self.max_retries)
+                    if r.status_code == 200:
+                        self.breaker.record_success()
+                        settled = True
+                        return r
+                    last_error = UpstreamError(f"HTTP {r.status_code}: {r.text[:200]}", r.status_code)
+                    if r.status_code not in RETRY_STATUSES:
+                        # a 4xx is our fault, not an outage; don't trip the breaker
+                        self.breaker.record_success()
+                        settled = True
+                        raise last_error
+                    retry_after = parse_retry_after(r.headers)
+                    r.close()
+                if attempt < self.max_retries:
+                    time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after))
+            raise last_error
+        except Exception:
+            # out of retries, or any other error (bad URL, SSL, a broken response):
+            # a failure, which also ends a half-open trial
+            if not settled:
+                self.breaker.record_failure()
+            raise
+        except BaseException:
+            # interrupted (the worker is shutting down): no verdict on the upstream
+            if not settled:
+                self.breaker.release()
+            raise
+
+    def chat_completion(self, payload):
+        return self.post(payload).json()
+
+    def stream_chat_completion(self, payload):
+        """
+        Yield content deltas from a streamed (SSE) completion. Retries only apply
+        before the first byte; a failure mid-stream raises UpstreamError.
+        """
+        import requests
+
+        r = self.post(dict(payload, stream=True), stream=True)
+        if r.encoding is None:
+            r.encoding = "utf-8"
+        try:
+            for line in r.iter_lines(decode_unicode=True):
+                deltas = parse_sse_line(line)
+                if deltas is None:
+                    break
+                yield from deltas
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise UpstreamError(f"stream interrupted: {e}")
+        finally:
+            r.close()
+
+
+class AsyncUpstreamClient:
+    """Same behaviour as UpstreamClient, on an httpx.AsyncClient (one per event loop)."""
+
+    def __init__(self, url, api_key=None, connect_timeout: float = 3.05, read_timeout: float = 30.0,
+                 max_retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 4.0,
+                 pool_size: int = 100, breaker: CircuitBreaker = None):
+        import httpx
+
+        self._httpx = httpx
+        self.url = url
+        self.api_key = api_key
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._client = None
+
+    @classmethod
+    def from_env(cls, api_key=None, **overrides):
+        settings = dict(settings_from_env(), pool_size=int(os.environ.get("PERPLEXITY_ASYNC_POOL_SIZE", "100")))
+        return cls(api_key=api_key, **dict(settings, **overrides))
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = self._httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    async def post(self, payload, stream: bool = False):
+        import asyncio
+
+        if not self.breaker.allow():
+            UPSTREAM_ATTEMPTS.inc(status="circuit_open")
+            raise CircuitOpenError("circuit open")
+        last_error = None
+        settled = False
+        try:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                request = self.client.build_request("POST", self.url, headers=self._headers(), json=payload)
+                started = time.perf_counter()
+                try:
+                    r = await self.client.send(request, stream=stream)
+                except (self._httpx.TransportError, self._httpx.TimeoutException) as e:
+                    last_error = UpstreamError(f"connection failed: {e}")
+                    record_attempt(started, "error", attempt < self.max_retries)
+                else:
+                    record_attempt(started, str(r.status_code),
+                                   r.status_code in RETRY_STATUSES and attempt < self.max_retries)
+                    if r.status_code == 200:
+                        self.breaker.record_success()
+                        settled = True
+                        return r
+                    await r.aread()
+                    await r.aclose()
+                    last_error = UpstreamError(f"HTTP {r.status_code}: {r.text[:200]}", r.status_code)
+                    if r.status_code not in RETRY_STATUSES:
+                        self.breaker.record_success()
+                        settled = True
+                        raise last_error
+                    retry_after = parse_retry_after(r.headers)
+                if attempt < self.max_retries:
+                    await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after))
+            raise last_error
+        except Exception:
+            if not settled:
+                self.breaker.record_failure()
+            raise
+        except BaseException:
+            # cancelled (the client went away): no verdict on the upstream
+            if not settled:
+                self.breaker.release()
+            raise
+
+    async def chat_completion(self, payload):
+        r = await self.post(payload)
+        return r.json()
+
+    async def stream_chat_completion(self, payload):
+        r = await self.post(dict(payload, stream=True), stream=True)
+        try:
+            async for line in r.aiter_lines():
+                deltas = parse_sse_line(line)
+                if deltas is None:
+                    break
+                for delta in deltas:
+                    yield delta
+        except self._httpx.HTTPError as e:
+            self.breaker.record_failure()
+            raise UpstreamError(f"stream interrupted: {e}")
+        finally:
+            await r.aclose()
@@ -0,0 +1,277 @@
+"""
+Write-behind persistence for chat history and profiles.
+
+A /chat turn used to wait for its history append and profile rewrites. With
+write-behind the request only appends a small record to this worker's
+journal and returns; a background thread writes the real files every
+`interval` seconds, so consecutive writes to the same history log or
+user.json become one write.
+
+    seq = write_behind.journal(target, {"kind": "history", ...})   # under the target's lock
+    write_behind.sync(seq)                                         # durable once this returns
+
+Journal appends are fsync'd (group commit: concurrent requests share one
+fsync) before sync() returns, so an acknowledged write survives a crash.
+After each flush an {"applied": seq} line marks what reached the real
+files; once everything has, the journal is truncated. Each worker holds an
+flock on its own journal files. On start, recover() replays the journals
+nobody holds any more, i.e. those of workers that died, past their last
+checkpoint, and deletes them.
+
+A target is any object with flush_pending(), which writes what it has
+queued, e.g. HistoryLog and ProfileStore when given a write_behind. Reads
+in the same worker see queued writes; another worker sees them after the
+next flush (`interval`, 50 ms by default).
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class WriteBehind:
+    def __init__(self, journal_dir, interval: float = 0.05, fsync: bool = True,
+                 journal_max_bytes: int = 4 * 1024 * 1024):
+        self.journal_dir = journal_dir
+        self.interval = interval
+        self.fsync = fsync
+        self.journal_max_bytes = journal_max_bytes
+        self._lock = threading.Lock()        # journal writes, seq, dirty set
+        self._sync_lock = threading.Lock()   # one fsync at a time
+        self._pid = None
+        self._fd = None
+        self._path = None
+        self._retired = []                   # (path, fd, last seq) of rotated journals
+        self._dirty = {}                     # id(target) -> target
+        self._seq = 0
+        self._synced = 0
+        self._applied = 0
+        self._size = 0
+        self._files = 0
+        self.submitted = 0
+        self.flushes = 0
+        self.writes = 0                      # target flushes (real file writes)
+        self.fsyncs = 0
+        self.errors = 0
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls, journal_dir):
+        env = os.environ.get
+        if env("WRITE_BEHIND", "1") == "0":
+            return None
+        return cls(journal_dir, interval=float(env("WRITE_BEHIND_INTERVAL", "0.05")),
+                   fsync=env("WRITE_BEHIND_FSYNC", "1") == "1")
+
+    # --- journal ---
+    def _open_journal(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._files += 1
+        path = os.path.join(self.journal_dir, f"wb-{os.getpid()}-{self._files}.jsonl")
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)  # ours while this worker lives
+        self._fd, self._path, self._size = fd, path, 0
+
+    def _ensure_started(self):
+        # lazily, so each forked worker gets its own journal and thread
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._fd = None
+        self._retired = []
+        self._dirty = {}
+        self._seq = self._synced = self._applied = 0
+        self._files = 0
+        self._open_journal()
+        threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    def journal(self, target, record):
+        """
+        Append `record` to the journal and queue `target` for the next flush.
+        Call it holding the lock that target.flush_pending() takes, and stage
+        the data on the target before releasing it. Returns the seq for sync().
+        Raises OSError if the journal can't be written (then write through).
+        """
+        with self._lock:
+            self._ensure_started()
+            self._seq += 1
+            line = (json.dumps(dict(record, seq=self._seq), ensure_ascii=False) + "\n").encode("utf-8")
+            try:
+                os.write(self._fd, line)
+            except OSError:
+                self._seq -= 1
+                self.errors += 1
+                raise
+            self._size += len(line)
+            self._dirty[id(target)] = target
+            self.submitted += 1
+            return self._seq
+
+    def sync(self, seq):
+        """Return once the journal holds everything up to `seq` durably."""
+        if not self.fsync:
+            return
+        with self._sync_lock:
+            if self._synced >= seq:
+                return  # covered by an fsync another request just did
+            with self._lock:
+                fd, target = self._fd, self._seq
+            os.fsync(fd)
+            self.fsyncs += 1
+            self._synced = target
+
+    # --- flushing ---
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print("Write-behind flush failed:", e)
+
+    def flush(self):
+        """Write every queued target now; returns the number written."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return 0
+            upto = self._seq
+            targets, self._dirty = list(self._dirty.values()), {}
+        written = 0
+        failed = []
+        for target in targets:
+            try:
+                target.flush_pending()
+                written += 1
+            except Exception as e:
+                print("Write-behind could not write, will retry:", e)
+                failed.append(target)
+        with self._lock:
+            self.flushes += 1
+            self.writes += written
+            if failed:
+                self.errors += len(failed)
+                for target in failed:
+                    self._dirty.setdefault(id(target), target)
+                return written
+            self._applied = max(self._applied, upto)
+            self._checkpoint()
+        return written
+
+    def _checkpoint(self):
+        # under self._lock; everything up to self._applied is in the real files
+        for path, fd, last in list(self._retired):
+            if last <= self._applied:
+                os.remove(path)
+                os.close(fd)
+                self._retired.remove((path, fd, last))
+        if self._applied >= self._seq and not self._dirty:
+            if self._size:
+                os.ftruncate(self._fd, 0)
+                self._size = 0
+            return
+        line = (json.dumps({"applied": self._applied}) + "\n").encode("utf-8")
+        os.write(self._fd, line)
+        self._size += len(line)
+        if self._size > self.journal_max_bytes:
+            # never idle long enough to truncate: continue in a new file
+            os.fsync(self._fd)  # sync() only covers the current file
+            self._retired.append((self._path, self._fd, self._seq))
+            self._open_journal()
+
+    def close(self):
+        """Flush everything and drop the journal (at exit)."""
+        if self._pid != os.getpid():
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            print("Write-behind final flush failed:", e)
+            return
+        with self._lock:
+            if not self._size and not self._dirty and self._path:
+                os.remove(self._path)
+                self._path = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "flushes": self.flushes,
+                "writes": self.writes,
+                "fsyncs": self.fsyncs,
+                "errors": self.errors,
+                "queued": len(self._dirty),
+                "journal_bytes": self._size,
+            }
+
+
+# --- Recovery ---
+def read_journal(path):
+    """Records of one journal file not yet marked applied, in order."""
+    records, applied = [], 0
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # torn last line of a crashed worker
+            if "applied" in record:
+                applied = max(applied, record["applied"])
+            elif "seq" in record:
+                records.append(record)
+    return [r for r in records if r["seq"] > applied]
+
+
+def recover(journal_dir, handlers):
+    """
+    Replay the journals of workers that are gone. `handlers` maps a record's
+    "kind" to a function applying it; they must tolerate records that were
+    already written. Returns the number of records replayed.
+    """
+    if not os.path.isdir(journal_dir):
+        return 0
+    replayed = 0
+    for name in sorted(os.listdir(journal_dir)):
+        if not (name.startswith("wb-") and name.endswith(".jsonl")):
+            continue
+        path = os.path.join(journal_dir, name)
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # a live worker's journal
+            elif name.startswith(f"wb-{os.getpid()}-"):
+                continue
+            started = time.perf_counter()
+            records = read_journal(path)
+            try:
+                for record in records:
+                    handler = handlers.get(record.get("kind"))
+                    if handler is None:
+                        print("Write-behind recovery: unknown record kind", record.get("kind"))
+                        continue
+                    handler(record)
+                    replayed += 1
+            except Exception as e:
+                # left in place, so the next start tries again
+                print(f"Write-behind recovery of {name} failed:", e)
+                continue
+            os.remove(path)
+            if records:
+                print(f"Write-behind recovery: replayed {len(records)} writes from {name} "
+                      f"in {time.perf_counter() - started:.2f}s")
+        finally:
+            os.close(fd)
+    return replayed